@@ -0,0 +1,377 @@
+'''
+End-to-end benchmark of the pipeline on synthetic Hi-Plex data.
+
+For each requested number of samples, a work directory is filled with
+synthetic tumour/normal FASTQ pairs named like Hi-Plex output (so that they
+match the align_bwa filename pattern), a small reference, a panel BED of
+amplicons and the matching primer BEDPE. The pipeline built by
+make_pipeline is then run there with every stage local, and the telemetry
+database of the run gives the wall time of each stage and the time each
+job spent in the pipeline around its command (the scheduling overhead).
+Throughput is reported in samples per hour.
+
+With --tools stub (the default) every stage still goes through run_stage,
+but its command is replaced by one that sleeps --stub_seconds and creates
+the outputs the stage declares (BAM outputs are minimal valid BAM files),
+so the run measures ruffus, run_stage and job overhead rather than tools.
+With --tools real the tools configured in --config are run instead; they
+must be on the PATH or loadable as modules, and the synthetic reference is
+indexed with bwa and samtools first.
+
+Each size runs in a subprocess of its own, in its own work directory:
+
+    python benchmarks/pipeline_benchmark.py --samples 10 100 1000 --jobs 16
+'''
+
+from __future__ import print_function
+import argparse
+import json
+import os
+import random
+import shutil
+import sqlite3
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'src')
+sys.path.insert(0, SRC_DIR)
+
+import yaml
+
+DEFAULT_SAMPLES = [10, 100, 1000]
+CHROM = 'chr1'
+READ_LENGTH = 100
+AMPLICON_LENGTH = 150
+PRIMER_LENGTH = 20
+AMPLICON_SPACING = 500
+# Stages named in calls to run_stage, all of which need a configuration
+STAGES = ['align_bwa', 'align_bwa_fused', 'primary_bam',
+          'index_sort_bam_picard', 'clip_bam', 'coverage_bam',
+          'summarize_coverage', 'call_mutect2_gatk', 'merge_mutect2_gatk',
+          'apply_vt', 'apply_vep', 'apply_vcfanno', 'apply_snpeff',
+          'apply_tabix', 'apply_cat_vcf', 'apply_bcf', 'apply_undr_rover',
+          'split_fastq_chunks', 'merge_bwa_chunks', 'annotate_vcf_fused',
+          'build_cohort_store']
+# Global options read by Stages that the synthetic data does not provide
+PLACEHOLDER_OPTIONS = ['dbsnp_hg19', 'mills_hg19', 'one_k_g_snps',
+    'one_k_g_indels', 'one_k_g_highconf_snps', 'hapmap', 'snpeff_conf',
+    'bamclipper', 'vep_path', 'vt_path', 'proportionthresh', 'absthresh',
+    'maxvariants', 'annolua', 'anno', 'hrfile', 'vep_cache', 'snpeff_path',
+    'mutect2_gnomad', 'vcfanno']
+# Empty BGZF block marking the end of a BAM file
+BGZF_EOF = bytearray.fromhex('1f8b08040000000000ff0600424302001b0003000000000000000000')
+COMPLEMENT = {'A': 'T', 'C': 'G', 'G': 'C', 'T': 'A'}
+
+
+def reverse_complement(sequence):
+    return ''.join(COMPLEMENT[base] for base in reversed(sequence))
+
+
+def bgzf_block(data):
+    '''Compress data into a single BGZF block'''
+    import zlib
+    compressor = zlib.compressobj(6, zlib.DEFLATED, -15)
+    deflated = compressor.compress(data) + compressor.flush()
+    header = struct.pack('<BBBBIBBHBBHH', 31, 139, 8, 4, 0, 0, 255, 6,
+                         66, 67, 2, len(deflated) + 25)
+    trailer = struct.pack('<II', zlib.crc32(data) & 0xffffffff, len(data))
+    return header + deflated + trailer
+
+
+def write_minimal_bam(path, reference_length):
+    '''Write a BAM file with a header (including a read group, which the
+    MuTect2 stage reads) and no alignments'''
+    text = '@HD\tVN:1.6\tSO:coordinate\n@SQ\tSN:{chrom}\tLN:{length}\n' \
+           '@RG\tID:stub\tSM:stub\n'.format(chrom=CHROM, length=reference_length)
+    text = text.encode('ascii')
+    name = CHROM.encode('ascii') + b'\0'
+    data = b'BAM\1' + struct.pack('<i', len(text)) + text + struct.pack('<i', 1) + \
+        struct.pack('<i', len(name)) + name + struct.pack('<i', reference_length)
+    with open(path, 'wb') as bam:
+        bam.write(bgzf_block(data))
+        bam.write(bytes(BGZF_EOF))
+
+
+def write_reference(path, rng, num_amplicons):
+    '''Write a random reference sequence with room for the amplicons'''
+    length = num_amplicons * AMPLICON_SPACING + AMPLICON_SPACING
+    sequence = ''.join(rng.choice('ACGT') for _ in range(length))
+    with open(path, 'w') as fasta:
+        fasta.write('>{}\n'.format(CHROM))
+        for start in range(0, length, 60):
+            fasta.write(sequence[start:start + 60] + '\n')
+    return sequence
+
+
+def amplicon_starts(num_amplicons):
+    return [AMPLICON_SPACING * (number + 1) for number in range(num_amplicons)]
+
+
+def write_panel(bed_path, bedpe_path, num_amplicons):
+    '''Write the amplicons as a BED file and their primers as a BEDPE file'''
+    with open(bed_path, 'w') as bed, open(bedpe_path, 'w') as bedpe:
+        for start in amplicon_starts(num_amplicons):
+            end = start + AMPLICON_LENGTH
+            bed.write('{}\t{}\t{}\n'.format(CHROM, start, end))
+            bedpe.write('{chrom}\t{start}\t{primer1_end}\t{chrom}\t{primer2_start}\t{end}\n'.format(
+                chrom=CHROM, start=start, primer1_end=start + PRIMER_LENGTH,
+                primer2_start=end - PRIMER_LENGTH, end=end))
+
+
+def write_fastq_pair(read1_path, read2_path, rng, sequence, num_amplicons,
+                     reads_per_amplicon, tumour):
+    '''Write read pairs covering every amplicon. Tumour samples carry an
+    SNV in a third of the amplicons, in 30% of their reads.'''
+    quality = 'I' * READ_LENGTH
+    with open(read1_path, 'w') as read1, open(read2_path, 'w') as read2:
+        for number, start in enumerate(amplicon_starts(num_amplicons)):
+            amplicon = sequence[start:start + AMPLICON_LENGTH]
+            for read in range(reads_per_amplicon):
+                fragment = amplicon
+                if tumour and number % 3 == 0 and rng.random() < 0.3:
+                    middle = AMPLICON_LENGTH // 2
+                    alternative = rng.choice([base for base in 'ACGT'
+                                              if base != fragment[middle]])
+                    fragment = fragment[:middle] + alternative + fragment[middle + 1:]
+                name = '@amplicon{}_read{}'.format(number, read)
+                read1.write('{}/1\n{}\n+\n{}\n'.format(
+                    name, fragment[:READ_LENGTH], quality))
+                read2.write('{}/2\n{}\n+\n{}\n'.format(
+                    name, reverse_complement(fragment[-READ_LENGTH:]), quality))
+
+
+def generate_data(workdir, num_samples, num_amplicons, reads_per_amplicon, seed):
+    '''Write the synthetic reference, panel and FASTQ files, returning the
+    paths of the reference, BED, BEDPE and FASTQ files'''
+    rng = random.Random(seed)
+    reference_dir = os.path.join(workdir, 'reference')
+    fastq_dir = os.path.join(workdir, 'fastqs')
+    for directory in (reference_dir, fastq_dir):
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+    reference = os.path.join(reference_dir, 'synthetic.fasta')
+    sequence = write_reference(reference, rng, num_amplicons)
+    bed = os.path.join(reference_dir, 'panel.bed')
+    bedpe = os.path.join(reference_dir, 'primers.bedpe')
+    write_panel(bed, bedpe, num_amplicons)
+    fastqs = []
+    for number in range(num_samples):
+        for kind in 'TN':
+            # Hi-Plex style names: <sample>-<T|N>_<read id>_<lane>_R1_<lib>.fastq
+            prefix = os.path.join(fastq_dir, 'BENCH{:04d}-{}_S{}_L001'.format(
+                number, kind, number + 1))
+            read1, read2 = prefix + '_R1_001.fastq', prefix + '_R2_001.fastq'
+            write_fastq_pair(read1, read2, rng, sequence, num_amplicons,
+                             reads_per_amplicon, kind == 'T')
+            fastqs.extend([read1, read2])
+    return reference, len(sequence), bed, bedpe, fastqs
+
+
+def write_config(path, options, pipeline_id, reference, bed, bedpe, fastqs):
+    '''Write a pipeline configuration running every stage locally'''
+    if options.tools == 'real':
+        with open(options.config) as base:
+            config = yaml.safe_load(base)
+    else:
+        config = dict((option, 'unused') for option in PLACEHOLDER_OPTIONS)
+        config['defaults'] = dict(cores=1, mem=1, account='none', queue='none',
+                                  walltime='1:00', modules=[])
+        config['stages'] = dict((stage, {}) for stage in STAGES)
+        # Run the optional stages too
+        config['coverage'] = True
+        config['cohort_store'] = True
+    config['defaults']['local'] = True
+    config['ref_grch37'] = reference
+    config['gatk_bed'] = bed
+    config['primer_bedpe_file'] = bedpe
+    config['fastqs'] = fastqs
+    config['pipeline_id'] = pipeline_id
+    with open(path, 'w') as config_file:
+        yaml.safe_dump(config, config_file, default_flow_style=False)
+
+
+def stub_command(outputs, template_bam, seconds):
+    '''A command that takes seconds and creates the outputs of a stage'''
+    parts = ['sleep {}'.format(seconds)] if seconds else []
+    for output in outputs or []:
+        directory = os.path.dirname(output)
+        if directory:
+            parts.append('mkdir -p {}'.format(directory))
+        if output.endswith('.bam'):
+            parts.append('cp {} {}'.format(template_bam, output))
+        else:
+            parts.append('touch {}'.format(output))
+    return ' && '.join(parts) or 'true'
+
+
+def install_stubs(template_bam, seconds):
+    '''Replace the command of every stage with a stub, keeping the rest of
+    run_stage (job scripts, local reservations, telemetry) as it is'''
+    import runner
+    import stages
+
+    def run_stub_stage(state, stage, command, inputs=None, outputs=None,
+                       **options):
+        runner.run_stage(state, stage, stub_command(outputs, template_bam, seconds),
+                         inputs=inputs, outputs=outputs, **options)
+    stages.run_stage = run_stub_stage
+
+
+def index_reference(reference):
+    '''Index the synthetic reference for the real tools'''
+    subprocess.check_call(['bwa', 'index', reference])
+    subprocess.check_call(['samtools', 'faidx', reference])
+    subprocess.check_call(['samtools', 'dict', '-o',
+                           os.path.splitext(reference)[0] + '.dict', reference])
+
+
+def stage_times(telemetry_db, pipeline_id):
+    '''Jobs, total command wall time, mean overhead per job and elapsed
+    time of each stage of a run, in the order the stages started'''
+    connection = sqlite3.connect(telemetry_db)
+    try:
+        return connection.execute(
+            'SELECT stage, COUNT(*), SUM(wall_time), '
+            'AVG(finished - submitted - wall_time), MAX(finished) - MIN(submitted) '
+            'FROM jobs WHERE pipeline_id = ? GROUP BY stage ORDER BY MIN(submitted)',
+            (pipeline_id,)).fetchall()
+    finally:
+        connection.close()
+
+
+def run_single(options):
+    '''Generate the data for one size, run the pipeline on it in the
+    current process and write the results as JSON'''
+    from config import Config
+    from state import State
+    from logger import Logger
+    from local_executor import ResourcePool
+    from pipeline import make_pipeline
+
+    num_samples = options.samples[0]
+    workdir = os.path.abspath(options.workdir)
+    os.chdir(workdir)
+    pipeline_id = 'bench{}'.format(num_samples)
+    reference, reference_length, bed, bedpe, fastqs = generate_data(
+        workdir, num_samples, options.amplicons, options.reads_per_amplicon,
+        options.seed)
+    if options.tools == 'real':
+        index_reference(reference)
+    else:
+        template_bam = os.path.join(workdir, 'reference', 'stub.bam')
+        write_minimal_bam(template_bam, reference_length)
+        install_stubs(template_bam, options.stub_seconds)
+    write_config('pipeline.config', options, pipeline_id, reference, bed,
+                 bedpe, fastqs)
+    config = Config('pipeline.config')
+    config.validate()
+    run_options = argparse.Namespace(jobscripts='jobscripts',
+                                     telemetry='telemetry.sqlite',
+                                     job_logs='job_logs')
+    logger = Logger('pipeline_benchmark', 'pipeline.log', 0)
+    state = State(options=run_options, config=config, logger=logger,
+                  drmaa_session=None, local_pool=ResourcePool.from_config(config))
+    pipeline = make_pipeline(state)
+    started = time.time()
+    try:
+        pipeline.run(multithread=options.jobs, verbose=0)
+    finally:
+        logger.close()
+    elapsed = time.time() - started
+    stages = stage_times(run_options.telemetry, pipeline_id)
+    result = dict(samples=num_samples, elapsed=elapsed,
+                  samples_per_hour=num_samples * 3600.0 / elapsed,
+                  jobs=sum(jobs for _stage, jobs, _wall, _overhead, _span in stages),
+                  stages=[dict(stage=stage, jobs=jobs, wall=wall,
+                               overhead=overhead, elapsed=span)
+                          for stage, jobs, wall, overhead, span in stages])
+    with open('result.json', 'w') as result_file:
+        json.dump(result, result_file, indent=2)
+
+
+def format_seconds(value):
+    return '-' if value is None else '{:.2f}'.format(value)
+
+
+def print_result(result):
+    print('{samples} samples: {elapsed:.1f}s, {jobs} jobs, '
+          '{samples_per_hour:.1f} samples/hour'.format(**result))
+    print('  {:<24} {:>6} {:>10} {:>12} {:>10}'.format(
+        'stage', 'jobs', 'wall', 'overhead/job', 'elapsed'))
+    for stage in result['stages']:
+        print('  {:<24} {:>6} {:>10} {:>12} {:>10}'.format(
+            stage['stage'], stage['jobs'], format_seconds(stage['wall']),
+            format_seconds(stage['overhead']), format_seconds(stage['elapsed'])))
+
+
+def parse_args(args=None):
+    parser = argparse.ArgumentParser(
+        description='Benchmark the pipeline on synthetic Hi-Plex data')
+    parser.add_argument('--samples', type=int, nargs='+', default=DEFAULT_SAMPLES,
+        help='Numbers of tumour/normal pairs to benchmark, defaults to '
+             '{}'.format(' '.join(map(str, DEFAULT_SAMPLES))))
+    parser.add_argument('--amplicons', type=int, default=50,
+        help='Amplicons in the synthetic panel, defaults to 50')
+    parser.add_argument('--reads_per_amplicon', type=int, default=50,
+        help='Read pairs per amplicon and sample, defaults to 50')
+    parser.add_argument('--jobs', type=int, default=8,
+        help='Jobs ruffus runs at once, defaults to 8')
+    parser.add_argument('--tools', choices=['stub', 'real'], default='stub',
+        help='Run stub commands (the default) or the real tools')
+    parser.add_argument('--stub_seconds', type=float, default=0,
+        help='Seconds each stub command takes, defaults to 0')
+    parser.add_argument('--config', type=str,
+        help='Pipeline configuration with the tool settings, for --tools real')
+    parser.add_argument('--workdir', type=str,
+        help='Directory to run in, kept afterwards; defaults to a '
+             'temporary directory that is removed')
+    parser.add_argument('--seed', type=int, default=1, help='Random seed')
+    parser.add_argument('--output', type=str,
+        help='Write the results of all sizes to this JSON file')
+    parser.add_argument('--single', action='store_true', help=argparse.SUPPRESS)
+    options = parser.parse_args(args)
+    if options.tools == 'real' and not options.config:
+        parser.error('--tools real needs --config')
+    return options
+
+
+def main():
+    options = parse_args()
+    if options.single:
+        run_single(options)
+        return
+    base = options.workdir or tempfile.mkdtemp(prefix='pipeline_benchmark_')
+    results = []
+    try:
+        for num_samples in options.samples:
+            workdir = os.path.join(base, 'samples_{}'.format(num_samples))
+            if os.path.exists(workdir):
+                shutil.rmtree(workdir)
+            os.makedirs(workdir)
+            arguments = [sys.executable, os.path.abspath(__file__), '--single',
+                '--samples', str(num_samples), '--workdir', workdir,
+                '--amplicons', str(options.amplicons),
+                '--reads_per_amplicon', str(options.reads_per_amplicon),
+                '--jobs', str(options.jobs), '--tools', options.tools,
+                '--stub_seconds', str(options.stub_seconds),
+                '--seed', str(options.seed)]
+            if options.config:
+                arguments += ['--config', os.path.abspath(options.config)]
+            subprocess.check_call(arguments)
+            with open(os.path.join(workdir, 'result.json')) as result_file:
+                result = json.load(result_file)
+            print_result(result)
+            results.append(result)
+    finally:
+        if not options.workdir:
+            shutil.rmtree(base, ignore_errors=True)
+    if options.output:
+        with open(options.output, 'w') as output:
+            json.dump(results, output, indent=2)
+
+
+if __name__ == '__main__':
+    main()
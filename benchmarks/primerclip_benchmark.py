@@ -0,0 +1,103 @@
+'''
+Compare the pysam primer clipper (src/primerclip.py) with bamclipper.
+
+Both engines clip the same BAM file with the same primer pairs, each run is
+timed, and the clipped alignments are compared record by record (header
+@PG lines aside, which necessarily differ).
+
+    python benchmarks/primerclip_benchmark.py --bamclipper /path/to/bamclipper.sh \
+        --threads 4 --repeat 3 primers.bedpe sample.primary.bam
+'''
+
+from __future__ import print_function
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir, 'src'))
+
+import pysam
+from primerclip import clip_bam
+
+
+def run_bamclipper(bamclipper, bedpe, bam_in, threads, directory):
+    '''Clip with bamclipper, returning the path of its output'''
+    subprocess.check_call([bamclipper, '-b', os.path.abspath(bam_in),
+                           '-p', os.path.abspath(bedpe), '-n', str(threads),
+                           '-o', directory])
+    name = os.path.basename(bam_in)[:-len('.bam')] + '.primerclipped.bam'
+    return os.path.join(directory, name)
+
+
+def run_primerclip(bedpe, bam_in, threads, directory):
+    '''Clip with the pysam engine, returning the path of its output'''
+    bam_out = os.path.join(directory, 'pysam.primerclipped.bam')
+    clip_bam(bedpe, bam_in, bam_out, threads)
+    return bam_out
+
+
+def timed(repeat, function, *args):
+    '''Run function repeat times, returning its last result and the
+    fastest wall time'''
+    best, result = None, None
+    for _ in range(repeat):
+        start = time.time()
+        result = function(*args)
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return result, best
+
+
+def records(bam_path):
+    '''Alignments of a BAM file in a canonical order'''
+    with pysam.AlignmentFile(bam_path, 'rb') as bam:
+        return sorted(read.to_string() for read in bam)
+
+
+def compare(expected_path, actual_path):
+    '''Number of alignments of both files, and the number that differ'''
+    expected, actual = records(expected_path), records(actual_path)
+    differ = len(set(expected).symmetric_difference(actual))
+    return len(expected), len(actual), differ
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark the pysam primer clipper against bamclipper')
+    parser.add_argument('--bamclipper', default='bamclipper.sh',
+        help='Path of bamclipper.sh, defaults to the one on the PATH')
+    parser.add_argument('--threads', type=int, default=1,
+        help='Threads given to each engine, defaults to 1')
+    parser.add_argument('--repeat', type=int, default=1,
+        help='Runs of each engine, the fastest is reported, defaults to 1')
+    parser.add_argument('bedpe', help='Primer pairs in BEDPE format')
+    parser.add_argument('bam', help='Coordinate sorted primary alignments')
+    options = parser.parse_args()
+    directory = tempfile.mkdtemp(prefix='primerclip_benchmark_')
+    try:
+        bamclipper_out, bamclipper_time = timed(
+            options.repeat, run_bamclipper, options.bamclipper, options.bedpe,
+            options.bam, options.threads, directory)
+        pysam_out, pysam_time = timed(
+            options.repeat, run_primerclip, options.bedpe, options.bam,
+            options.threads, directory)
+        expected, actual, differ = compare(bamclipper_out, pysam_out)
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+    print('{:<12} {:>10}'.format('engine', 'seconds'))
+    print('{:<12} {:>10.2f}'.format('bamclipper', bamclipper_time))
+    print('{:<12} {:>10.2f}'.format('pysam', pysam_time))
+    print('speedup: {:.2f}x'.format(bamclipper_time / pysam_time))
+    print('alignments: bamclipper {}, pysam {}, differing {}'.format(
+        expected, actual, differ))
+    if differ:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -18,6 +18,8 @@ setup(
     install_requires=[
         "ruffus == 2.6.3",
         "drmaa == 0.7.6",
-        "PyYAML >= 4.2b1"
+        "PyYAML >= 4.2b1",
+        "pysam >= 0.15",
+        "numpy"
     ],
 )
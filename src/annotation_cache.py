@@ -0,0 +1,169 @@
+'''
+Persistent cross-run cache of variant annotations.
+
+Hi-Plex panels see the same few thousand variants over and over, so the
+INFO fields that VEP and vcfanno add to a normalised record are kept in a
+local SQLite database, keyed by the normalised allele (CHROM, POS, REF,
+ALT) together with the VEP/cache version and a hash of the vcfanno
+configuration. Only records missing from the cache are sent to VEP and
+vcfanno; the annotations of the others are taken from the cache.
+
+The cache is bounded: once it holds more than max_entries alleles the least
+recently used ones are evicted. Hit and miss counts are accumulated in the
+database so that they can be reported in the log.
+'''
+
+import hashlib
+import sqlite3
+import time
+
+# Default bound on the number of cached alleles
+DEFAULT_MAX_ENTRIES = 1000000
+# Seconds to wait for other pipeline jobs holding the database lock
+LOCK_TIMEOUT = 600
+
+
+def info_fields(info):
+    '''Split a VCF INFO column into a list of fields'''
+    if info in ('', '.'):
+        return []
+    return info.split(';')
+
+
+def info_key(field):
+    '''The key of an INFO field, such as CSQ for CSQ=...'''
+    return field.split('=', 1)[0]
+
+
+def record_key(record):
+    '''The (CHROM, POS, REF, ALT) of a VCF record line'''
+    fields = record.split('\t', 5)
+    return (fields[0], int(fields[1]), fields[3], fields[4])
+
+
+def added_annotation(original_record, annotated_record):
+    '''The INFO fields of annotated_record that are not in original_record'''
+    original_keys = set(info_key(field) for field in
+                        info_fields(original_record.split('\t')[7]))
+    added = [field for field in
+             info_fields(annotated_record.rstrip('\n').split('\t')[7])
+             if info_key(field) not in original_keys]
+    return ';'.join(added)
+
+
+def with_annotation(record, annotation):
+    '''Append cached annotation fields to the INFO column of a record'''
+    if not annotation:
+        return record
+    fields = record.rstrip('\n').split('\t')
+    fields[7] = ';'.join(info_fields(fields[7]) + [annotation])
+    return '\t'.join(fields) + '\n'
+
+
+def file_digest(*paths):
+    '''MD5 hex digest of the contents of the given files'''
+    digest = hashlib.md5()
+    for path in paths:
+        with open(path, 'rb') as handle:
+            digest.update(handle.read())
+    return digest.hexdigest()
+
+
+class AnnotationCache(object):
+    '''Annotations of normalised alleles for one VEP and vcfanno version'''
+    def __init__(self, path, vep_version, anno_hash,
+                 max_entries=DEFAULT_MAX_ENTRIES):
+        self.path = path
+        self.vep_version = vep_version
+        self.anno_hash = anno_hash
+        self.max_entries = max_entries
+        self.connection = sqlite3.connect(path, timeout=LOCK_TIMEOUT)
+        # Return annotations as plain strings, like the VCF lines they join
+        self.connection.text_factory = str
+        with self.connection:
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS annotations ('
+                'chrom TEXT, pos INTEGER, ref TEXT, alt TEXT, '
+                'vep_version TEXT, anno_hash TEXT, annotation TEXT, '
+                'last_used REAL, '
+                'PRIMARY KEY (chrom, pos, ref, alt, vep_version, anno_hash))')
+            self.connection.execute(
+                'CREATE INDEX IF NOT EXISTS annotations_last_used '
+                'ON annotations (last_used)')
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS headers ('
+                'vep_version TEXT, anno_hash TEXT, line TEXT, '
+                'PRIMARY KEY (vep_version, anno_hash, line))')
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS counters ('
+                'name TEXT PRIMARY KEY, value INTEGER)')
+
+    def close(self):
+        self.connection.close()
+
+    def lookup(self, keys):
+        '''Return a dictionary of the cached annotations of keys, marking
+        them as recently used and counting hits and misses.
+        '''
+        found = {}
+        now = time.time()
+        with self.connection:
+            for key in set(keys):
+                row = self.connection.execute(
+                    'SELECT annotation FROM annotations WHERE chrom = ? AND '
+                    'pos = ? AND ref = ? AND alt = ? AND vep_version = ? AND '
+                    'anno_hash = ?', key + (self.vep_version, self.anno_hash)).fetchone()
+                if row is not None:
+                    found[key] = row[0]
+                    self.connection.execute(
+                        'UPDATE annotations SET last_used = ? WHERE chrom = ? '
+                        'AND pos = ? AND ref = ? AND alt = ? AND '
+                        'vep_version = ? AND anno_hash = ?',
+                        (now,) + key + (self.vep_version, self.anno_hash))
+            self._count('hits', len(found))
+            self._count('misses', len(set(keys)) - len(found))
+        return found
+
+    def store(self, annotations):
+        '''Add a dictionary of key to annotation to the cache, then evict the
+        least recently used entries beyond max_entries.
+        '''
+        now = time.time()
+        with self.connection:
+            self.connection.executemany(
+                'INSERT OR REPLACE INTO annotations VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                [key + (self.vep_version, self.anno_hash, annotation, now)
+                 for key, annotation in annotations.items()])
+            excess = self.connection.execute(
+                'SELECT COUNT(*) FROM annotations').fetchone()[0] - self.max_entries
+            if excess > 0:
+                self.connection.execute(
+                    'DELETE FROM annotations WHERE rowid IN (SELECT rowid '
+                    'FROM annotations ORDER BY last_used LIMIT ?)', (excess,))
+                self._count('evictions', excess)
+
+    def header_lines(self):
+        '''Header lines added by VEP and vcfanno, as stored by store_header'''
+        rows = self.connection.execute(
+            'SELECT line FROM headers WHERE vep_version = ? AND anno_hash = ? '
+            'ORDER BY rowid', (self.vep_version, self.anno_hash))
+        return [row[0] for row in rows]
+
+    def store_header(self, lines):
+        '''Remember the header lines added by VEP and vcfanno'''
+        with self.connection:
+            self.connection.executemany(
+                'INSERT OR IGNORE INTO headers VALUES (?, ?, ?)',
+                [(self.vep_version, self.anno_hash, line) for line in lines])
+
+    def counters(self):
+        '''Cumulative hit, miss and eviction counts over all runs'''
+        rows = self.connection.execute('SELECT name, value FROM counters')
+        return dict((name, value) for name, value in rows)
+
+    def _count(self, name, increment):
+        self.connection.execute(
+            'INSERT OR IGNORE INTO counters VALUES (?, 0)', (name,))
+        self.connection.execute(
+            'UPDATE counters SET value = value + ? WHERE name = ?',
+            (increment, name))
@@ -0,0 +1,70 @@
+'''
+Grouping of jobs that ruffus worker threads submit at about the same time.
+
+ruffus runs each job of a stage in a thread of its own, so jobs that could
+share one submission to the cluster arrive one at a time. A Batcher collects
+the items added under the same key until the batch holds max_size items or
+window seconds have passed since its first item, then hands the whole batch
+to its flush function in one call. Each thread that added an item blocks
+until the batch has been flushed and gets back the result of flush for its
+own item, or the exception flush raised.
+'''
+
+import threading
+
+
+class Batch(object):
+    '''Items collected under one key, and the outcome of flushing them'''
+    def __init__(self):
+        self.items = []
+        self.results = None
+        self.error = None
+        self.timer = None
+        self.flushed = threading.Event()
+
+
+class Batcher(object):
+    '''Collects items from many threads and flushes them in batches'''
+    def __init__(self, flush):
+        # flush(key, items) returns a list with one result per item
+        self.flush = flush
+        self.open_batches = {}
+        self.lock = threading.Lock()
+
+    def add(self, key, item, window, max_size):
+        '''Add item to the open batch of key, and return the result of
+        flush for item once the batch has been flushed.
+        '''
+        with self.lock:
+            batch = self.open_batches.get(key)
+            if batch is None:
+                batch = Batch()
+                self.open_batches[key] = batch
+                batch.timer = threading.Timer(window, self._flush, (key, batch))
+                batch.timer.daemon = True
+                batch.timer.start()
+            index = len(batch.items)
+            batch.items.append(item)
+            full = len(batch.items) >= max_size
+        if full:
+            self._flush(key, batch)
+        # Wait in short steps so that the thread stays interruptible
+        while not batch.flushed.wait(1):
+            pass
+        if batch.error is not None:
+            raise batch.error
+        return batch.results[index]
+
+    def _flush(self, key, batch):
+        with self.lock:
+            # Flushed already, by its timer or by filling up
+            if self.open_batches.get(key) is not batch:
+                return
+            del self.open_batches[key]
+        batch.timer.cancel()
+        try:
+            batch.results = self.flush(key, batch.items)
+        except Exception as error:
+            batch.error = error
+        finally:
+            batch.flushed.set()
@@ -0,0 +1,451 @@
+'''
+Columnar store of the annotated somatic variants of the whole cohort.
+
+Reporting on the cohort used to mean parsing every annotated VCF again, CSQ
+strings and all. Instead, the last stage of the pipeline streams each
+annotated VCF once into a store of NumPy arrays, one row per sample and
+variant, with the VEP annotation of the transcript VEP picked (PICK=1, or
+else the most severe IMPACT):
+
+    sample, chrom, ref, alt, filter, symbol, consequence
+        dictionary-encoded strings (integer codes into dictionaries.json)
+    pos          1-based position (int32)
+    impact       MODIFIER, LOW, MODERATE or HIGH, as 0 to 3 (uint8)
+    gnomad_af    gnomAD allele frequency, NaN where there is none (float32)
+
+The store is a directory:
+
+    <store>/manifest.json       the segments, and the segment and VCF of
+                                each sample
+    <store>/dictionaries.json   the strings of each dictionary
+    <store>/segment_NNNN/       the columns of a segment as .npy files
+
+Adding samples writes a new segment and never touches the existing ones.
+Dictionaries only ever grow, so earlier segments keep their codes. A
+sample added again, because its VCF changed, is taken from its newest
+segment only. The rows of each segment are sorted by chrom and position,
+which indexes them by position, and by_symbol.npy and by_sample.npy hold
+the rows of each symbol and sample, with offsets into them by code, so
+queries by gene, region or sample read only the rows they need. The arrays
+are memory-mapped when read. compact rewrites all segments as one.
+
+Queries go through CohortStore.query, for instance
+
+    store = CohortStore('variants/cohort_store')
+    rows = store.query(symbol='TP53', impacts=['HIGH', 'MODERATE'],
+                       max_gnomad_af=0.001)
+
+Run as a script, from the jobs of the build_cohort_store stage:
+
+    python cohort_store.py add store_dir annotated.vcf[.gz]...
+    python cohort_store.py compact store_dir
+    python cohort_store.py query store_dir [--symbol S] [--sample S]
+        [--region chrom:start-end] [--impact I...] [--max_gnomad_af F]
+'''
+
+from __future__ import print_function
+from array import array
+import argparse
+import gzip
+import json
+import os
+import shutil
+import sys
+import numpy
+from annotation_cache import info_fields
+
+MANIFEST = 'manifest.json'
+DICTIONARIES = 'dictionaries.json'
+# VEP IMPACT values, least severe first; the code of each is its position
+IMPACTS = ['MODIFIER', 'LOW', 'MODERATE', 'HIGH']
+# Dictionary-encoded columns, the dictionary of each and its code type
+STRING_COLUMNS = [('sample', 'sample', numpy.uint32),
+                  ('chrom', 'chrom', numpy.uint16),
+                  ('ref', 'allele', numpy.uint32),
+                  ('alt', 'allele', numpy.uint32),
+                  ('filter', 'filter', numpy.uint16),
+                  ('symbol', 'symbol', numpy.uint32),
+                  ('consequence', 'consequence', numpy.uint16)]
+COLUMN_DICTIONARIES = dict((name, dictionary)
+                          for name, dictionary, _dtype in STRING_COLUMNS)
+NUMERIC_COLUMNS = [('pos', numpy.int32), ('impact', numpy.uint8),
+                   ('gnomad_af', numpy.float32)]
+COLUMNS = [name for name, _dictionary, _dtype in STRING_COLUMNS] + \
+          [name for name, _dtype in NUMERIC_COLUMNS]
+# Columns with an index of their rows by code
+INDEXED_COLUMNS = ['symbol', 'sample']
+# Names of the gnomAD allele frequency in the CSQ or INFO fields, in order
+GNOMAD_AF_FIELDS = ['gnomAD_AF', 'gnomADe_AF', 'gnomad_AF', 'gnomad_af']
+ANNOTATED_SUFFIXES = ['.mutect2.annotated.vcf.gz', '.mutect2.annotated.vcf']
+
+
+def sample_name(vcf_path):
+    '''The sample of an annotated VCF, from its file name'''
+    name = os.path.basename(vcf_path)
+    for suffix in ANNOTATED_SUFFIXES:
+        if name.endswith(suffix):
+            return name[:-len(suffix)]
+    return name.split('.')[0]
+
+
+def open_vcf(vcf_path):
+    '''Open a plain or gzip (bgzip) compressed VCF'''
+    if vcf_path.endswith('.gz'):
+        return gzip.open(vcf_path)
+    return open(vcf_path)
+
+
+def csq_format(header_line):
+    '''The field names of CSQ, from its ##INFO header line'''
+    description = header_line.split('Format: ', 1)[1]
+    return description.split('"', 1)[0].strip().split('|')
+
+
+def picked_annotation(csq, fields):
+    '''The CSQ entry VEP picked, as a dict, or the most severe one'''
+    entries = [dict(zip(fields, entry.split('|'))) for entry in csq.split(',')]
+    for entry in entries:
+        if entry.get('PICK') == '1':
+            return entry
+    return max(entries, key=lambda entry: impact_code(entry.get('IMPACT')))
+
+
+def impact_code(impact):
+    try:
+        return IMPACTS.index(impact)
+    except ValueError:
+        return 0
+
+
+def parse_af(value):
+    '''An allele frequency, the first of several, or NaN'''
+    try:
+        return float(value.split('&')[0].split(',')[0])
+    except (AttributeError, ValueError):
+        return float('nan')
+
+
+def read_variants(vcf_path):
+    '''Yield (chrom, pos, ref, alt, filter, symbol, consequence, impact,
+    gnomad_af) for each alternate allele of each record of an annotated VCF,
+    reading it as a stream'''
+    fields = []
+    with open_vcf(vcf_path) as vcf_file:
+        for line in vcf_file:
+            if line.startswith('#'):
+                if line.startswith('##INFO=<ID=CSQ,'):
+                    fields = csq_format(line)
+                continue
+            chrom, pos, _id, ref, alts, _qual, filters, info = \
+                line.rstrip('\n').split('\t', 8)[:8]
+            info = dict(field.split('=', 1) if '=' in field else (field, '')
+                        for field in info_fields(info))
+            annotation = {}
+            if 'CSQ' in info and fields:
+                annotation = picked_annotation(info['CSQ'], fields)
+            gnomad_af = float('nan')
+            for name in GNOMAD_AF_FIELDS:
+                value = annotation.get(name) or info.get(name)
+                if value:
+                    gnomad_af = parse_af(value)
+                    break
+            for alt in alts.split(','):
+                yield (chrom, int(pos), ref, alt, filters,
+                       annotation.get('SYMBOL', ''),
+                       annotation.get('Consequence', ''),
+                       impact_code(annotation.get('IMPACT')), gnomad_af)
+
+
+def write_json(path, value):
+    '''Write value to path as JSON, replacing the file in one step'''
+    temporary = path + '.tmp'
+    with open(temporary, 'w') as json_file:
+        json.dump(value, json_file)
+    os.rename(temporary, path)
+
+
+class Dictionary(object):
+    '''Strings of a dictionary-encoded column and their codes'''
+    def __init__(self, strings=()):
+        self.strings = list(strings)
+        self.codes = dict((string, code) for code, string in enumerate(self.strings))
+
+    def code(self, string):
+        code = self.codes.get(string)
+        if code is None:
+            code = self.codes[string] = len(self.strings)
+            self.strings.append(string)
+        return code
+
+
+def row_index(codes, num_codes):
+    '''The rows of each code, in row order, and the offset of the rows of
+    each code into them'''
+    order = numpy.argsort(codes, kind='mergesort').astype(numpy.uint32)
+    offsets = numpy.searchsorted(codes[order], numpy.arange(num_codes + 1))
+    return order, offsets.astype(numpy.int64)
+
+
+class CohortStore(object):
+    '''A columnar store of annotated variants, one row per sample and
+    variant'''
+    def __init__(self, path):
+        self.path = path
+        manifest_path = os.path.join(path, MANIFEST)
+        if os.path.exists(manifest_path):
+            with open(manifest_path) as manifest_file:
+                self.manifest = json.load(manifest_file)
+            with open(os.path.join(path, DICTIONARIES)) as dictionaries_file:
+                strings = json.load(dictionaries_file)
+        else:
+            self.manifest = dict(segments=[], samples={}, next_segment=0)
+            strings = {}
+        self.dictionaries = dict(
+            (name, Dictionary(strings.get(name, [])))
+            for name in set(COLUMN_DICTIONARIES.values()))
+        self.segment_columns = {}
+
+    def segment_path(self, segment):
+        return os.path.join(self.path, segment)
+
+    def write_segment(self, columns):
+        '''Write the columns of new rows as a new segment, sorted and
+        indexed, and return its name'''
+        segment = 'segment_{:04d}'.format(self.manifest['next_segment'])
+        self.manifest['next_segment'] += 1
+        order = numpy.lexsort((columns['pos'], columns['chrom']))
+        temporary = self.segment_path(segment) + '.tmp'
+        if os.path.exists(temporary):
+            shutil.rmtree(temporary)
+        os.makedirs(temporary)
+        for name in COLUMNS:
+            numpy.save(os.path.join(temporary, name + '.npy'), columns[name][order])
+        for name in INDEXED_COLUMNS:
+            dictionary = self.dictionaries[COLUMN_DICTIONARIES[name]]
+            rows, offsets = row_index(columns[name][order], len(dictionary.strings))
+            numpy.save(os.path.join(temporary, 'by_{}.npy'.format(name)), rows)
+            numpy.save(os.path.join(temporary, 'by_{}_offsets.npy'.format(name)), offsets)
+        os.rename(temporary, self.segment_path(segment))
+        return segment
+
+    def save(self):
+        '''Write the dictionaries, then the manifest that refers to them'''
+        write_json(os.path.join(self.path, DICTIONARIES),
+                   dict((name, dictionary.strings)
+                        for name, dictionary in self.dictionaries.items()))
+        write_json(os.path.join(self.path, MANIFEST), self.manifest)
+
+    def add(self, vcf_paths):
+        '''Add the samples of vcf_paths that are new, or whose VCF changed,
+        as one new segment. Returns the samples added.'''
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        samples = self.manifest['samples']
+        string_columns = dict((name, array('L')) for name in COLUMN_DICTIONARIES)
+        pos, impact, gnomad_af = array('l'), array('B'), array('f')
+        added = {}
+        for vcf_path in vcf_paths:
+            sample = sample_name(vcf_path)
+            status = os.stat(vcf_path)
+            source = dict(vcf=vcf_path, size=status.st_size, mtime=status.st_mtime)
+            known = samples.get(sample)
+            if known is not None and all(known.get(key) == value
+                                         for key, value in source.items()):
+                continue
+            sample_code = self.dictionaries['sample'].code(sample)
+            for chrom, position, ref, alt, filters, symbol, consequence, \
+                    impact_value, af in read_variants(vcf_path):
+                for name, value in [('chrom', chrom), ('ref', ref), ('alt', alt),
+                                    ('filter', filters), ('symbol', symbol),
+                                    ('consequence', consequence)]:
+                    dictionary = self.dictionaries[COLUMN_DICTIONARIES[name]]
+                    string_columns[name].append(dictionary.code(value))
+                string_columns['sample'].append(sample_code)
+                pos.append(position)
+                impact.append(impact_value)
+                gnomad_af.append(af)
+            added[sample] = source
+        if not added:
+            return []
+        columns = dict((name, numpy.array(string_columns[name], dtype=dtype))
+                       for name, _dictionary, dtype in STRING_COLUMNS)
+        columns['pos'] = numpy.array(pos, dtype=numpy.int32)
+        columns['impact'] = numpy.array(impact, dtype=numpy.uint8)
+        columns['gnomad_af'] = numpy.array(gnomad_af, dtype=numpy.float32)
+        segment = self.write_segment(columns)
+        self.manifest['segments'].append(segment)
+        for sample, source in added.items():
+            source['segment'] = segment
+            samples[sample] = source
+        self.save()
+        return sorted(added)
+
+    def load(self, segment, name):
+        '''A column or index array of a segment, memory-mapped'''
+        key = (segment, name)
+        if key not in self.segment_columns:
+            self.segment_columns[key] = numpy.load(
+                os.path.join(self.segment_path(segment), name + '.npy'),
+                mmap_mode='r')
+        return self.segment_columns[key]
+
+    def live_samples(self, segment):
+        '''Codes of the samples whose newest rows are in segment'''
+        codes = self.dictionaries['sample'].codes
+        return numpy.array(sorted(codes[sample] for sample, source in
+                                  self.manifest['samples'].items()
+                                  if source['segment'] == segment),
+                           dtype=numpy.uint32)
+
+    def indexed_rows(self, segment, name, code):
+        '''Rows of segment with code in the indexed column name'''
+        offsets = self.load(segment, 'by_{}_offsets'.format(name))
+        if code is None or code + 1 >= len(offsets):
+            return numpy.zeros(0, dtype=numpy.uint32)
+        rows = self.load(segment, 'by_' + name)
+        return numpy.sort(rows[offsets[code]:offsets[code + 1]])
+
+    def region_rows(self, segment, chrom_code, start, end):
+        '''Rows of segment on the chrom with chrom_code between start and
+        end (1-based, inclusive)'''
+        if chrom_code is None:
+            return numpy.zeros(0, dtype=numpy.uint32)
+        chroms = self.load(segment, 'chrom')
+        first = numpy.searchsorted(chroms, chrom_code, side='left')
+        last = numpy.searchsorted(chroms, chrom_code, side='right')
+        positions = self.load(segment, 'pos')[first:last]
+        low = first + numpy.searchsorted(positions, start, side='left')
+        high = first + numpy.searchsorted(positions, end, side='right')
+        return numpy.arange(low, high, dtype=numpy.uint32)
+
+    def query(self, symbol=None, sample=None, region=None, impacts=None,
+              max_gnomad_af=None):
+        '''The rows matching all the filters given, as a dict of column
+        arrays, with strings decoded. region is (chrom, start, end), impacts
+        a list of IMPACT values, and max_gnomad_af keeps variants at most
+        that frequent in gnomAD, or not in it at all.'''
+        chrom_codes = self.dictionaries['chrom'].codes
+        found = dict((name, []) for name in COLUMNS)
+        for segment in self.manifest['segments']:
+            selections = []
+            if symbol is not None:
+                selections.append(self.indexed_rows(
+                    segment, 'symbol', self.dictionaries['symbol'].codes.get(symbol)))
+            if sample is not None:
+                selections.append(self.indexed_rows(
+                    segment, 'sample', self.dictionaries['sample'].codes.get(sample)))
+            if region is not None:
+                chrom, start, end = region
+                selections.append(self.region_rows(
+                    segment, chrom_codes.get(chrom), start, end))
+            if selections:
+                rows = selections[0]
+                for selection in selections[1:]:
+                    rows = numpy.intersect1d(rows, selection, assume_unique=True)
+            else:
+                rows = numpy.arange(len(self.load(segment, 'pos')), dtype=numpy.uint32)
+            keep = numpy.in1d(self.load(segment, 'sample')[rows],
+                              self.live_samples(segment))
+            if impacts is not None:
+                keep &= numpy.in1d(self.load(segment, 'impact')[rows],
+                                   [IMPACTS.index(impact) for impact in impacts])
+            if max_gnomad_af is not None:
+                af = self.load(segment, 'gnomad_af')[rows]
+                # Variants absent from gnomAD (NaN) pass
+                with numpy.errstate(invalid='ignore'):
+                    keep &= ~(af > max_gnomad_af)
+            rows = rows[keep]
+            for name in COLUMNS:
+                found[name].append(numpy.asarray(self.load(segment, name)[rows]))
+        result = {}
+        for name, dictionary, dtype in STRING_COLUMNS:
+            codes = numpy.concatenate(found[name]) if found[name] else \
+                numpy.zeros(0, dtype=dtype)
+            strings = numpy.array(self.dictionaries[dictionary].strings,
+                                  dtype=object)
+            result[name] = strings[codes]
+        for name, dtype in NUMERIC_COLUMNS:
+            result[name] = numpy.concatenate(found[name]) if found[name] else \
+                numpy.zeros(0, dtype=dtype)
+        result['impact'] = numpy.array(IMPACTS, dtype=object)[result['impact']]
+        return result
+
+    def compact(self):
+        '''Rewrite the live rows of all segments as a single segment'''
+        old_segments = list(self.manifest['segments'])
+        if len(old_segments) < 2:
+            return
+        columns = dict((name, []) for name in COLUMNS)
+        for segment in old_segments:
+            keep = numpy.in1d(self.load(segment, 'sample'),
+                              self.live_samples(segment))
+            for name in COLUMNS:
+                columns[name].append(numpy.asarray(self.load(segment, name))[keep])
+        columns = dict((name, numpy.concatenate(arrays))
+                       for name, arrays in columns.items())
+        segment = self.write_segment(columns)
+        self.manifest['segments'] = [segment]
+        for source in self.manifest['samples'].values():
+            source['segment'] = segment
+        self.save()
+        self.segment_columns = {}
+        for old_segment in old_segments:
+            shutil.rmtree(self.segment_path(old_segment))
+
+
+def parse_region(region):
+    '''Parse chrom:start-end, or chrom alone'''
+    if ':' not in region:
+        return region, 0, numpy.iinfo(numpy.int32).max
+    chrom, span = region.rsplit(':', 1)
+    start, end = span.replace(',', '').split('-')
+    return chrom, int(start), int(end)
+
+
+def print_rows(rows, stream=sys.stdout):
+    '''Print query results as tab separated values'''
+    print('\t'.join(COLUMNS), file=stream)
+    for values in zip(*[rows[name] for name in COLUMNS]):
+        print('\t'.join(str(value) for value in values), file=stream)
+
+
+def parse_args(args=None):
+    parser = argparse.ArgumentParser(
+        description='Columnar store of the annotated variants of the cohort')
+    commands = parser.add_subparsers(dest='command')
+    add = commands.add_parser('add',
+        help='Add new or changed samples from their annotated VCFs')
+    add.add_argument('store', help='Store directory')
+    add.add_argument('vcfs', nargs='+', help='Annotated VCF files')
+    compact = commands.add_parser('compact',
+        help='Rewrite all segments of the store as one')
+    compact.add_argument('store', help='Store directory')
+    query = commands.add_parser('query', help='Print matching variants')
+    query.add_argument('store', help='Store directory')
+    query.add_argument('--symbol', help='Gene symbol')
+    query.add_argument('--sample', help='Sample')
+    query.add_argument('--region', help='chrom:start-end (1-based, inclusive)')
+    query.add_argument('--impact', nargs='+', choices=IMPACTS,
+        help='VEP IMPACT values to keep')
+    query.add_argument('--max_gnomad_af', type=float,
+        help='Keep variants at most this frequent in gnomAD, or not in it')
+    return parser.parse_args(args)
+
+
+def main(args=None):
+    options = parse_args(args)
+    store = CohortStore(options.store)
+    if options.command == 'add':
+        added = store.add(options.vcfs)
+        print('Added {} samples to {}'.format(len(added), options.store))
+    elif options.command == 'compact':
+        store.compact()
+    else:
+        region = parse_region(options.region) if options.region else None
+        print_rows(store.query(symbol=options.symbol, sample=options.sample,
+                               region=region, impacts=options.impact,
+                               max_gnomad_af=options.max_gnomad_af))
+
+
+if __name__ == '__main__':
+    main()
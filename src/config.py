@@ -9,6 +9,10 @@ TODO: validation of config file input.
 
 import yaml
 
+# The C parser, when PyYAML was built with libyaml, is many times faster on
+# configurations listing thousands of FASTQ files
+YAML_LOADER = getattr(yaml, 'CLoader', yaml.Loader)
+
 
 class Config(object):
 
@@ -16,7 +20,7 @@ class Config(object):
         # Try to open and parse the YAML formatted config file
         with open(config_filename) as config_file:
             try:
-                config = yaml.load(config_file)
+                config = yaml.load(config_file, Loader=YAML_LOADER)
             except yaml.YAMLError, exc:
                 print("Error in configuration file:", exc)
                 raise exc
@@ -38,6 +42,12 @@ class Config(object):
             raise Exception("Unknown option: {}, not in configuration "
                             "file: {}".format(option, self.config_filename))
 
+    def get_optional_option(self, option, default=None):
+        '''Retrieve a global option from the configuration, falling back
+        to the supplied default when the option is not present.
+        '''
+        return self.config.get(option, default)
+
     def get_stage_options(self, stage, *options):
         num_options = len(options)
         if num_options == 1:
@@ -71,6 +81,17 @@ class Config(object):
             raise Exception("Unknown stage: {}, not in configuration "
                             "file: {}".format(stage, self.config_filename))
 
+    def get_optional_stage_option(self, stage, option, default=None):
+        '''Retrieve an option for a particular stage, falling back to the
+        defaults and then to the supplied default value. Unlike
+        get_stage_option this does not require the stage to be present in
+        the configuration file, which suits opt-in features.
+        '''
+        this_stage = self.config['stages'].get(stage) or {}
+        if option in this_stage:
+            return this_stage[option]
+        return self.config['defaults'].get(option, default)
+
     def validate(self):
         '''Check that the configuration is valid.'''
         config = self.config
@@ -81,6 +102,9 @@ class Config(object):
         # check_required_field(config, filename, 'vcf')
         check_required_field(config, filename, 'fastqs')
         check_required_field(config, filename, 'pipeline_id')
+        # The annotation cache is keyed by the VEP version
+        if 'anno_cache' in config:
+            check_required_field(config, filename, 'vep_version')
 
 
 def check_required_field(config, filename, field):
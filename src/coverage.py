@@ -0,0 +1,276 @@
+'''
+Per-amplicon and per-base coverage of the clipped BAM files, and a cohort
+coverage matrix to summarise and plot.
+
+Each BAM file is streamed once. The aligned blocks of its reads (soft-clipped
+primers excluded) are mapped into the concatenated bases of the gatk_bed
+targets and accumulated with NumPy into a per-base depth array, from which
+the mean depth of each amplicon follows by prefix sums. Both are saved as
+.npy files:
+
+    <prefix>.depth.npy        per-base depth over the merged targets (uint32)
+    <prefix>.amplicons.npy    mean depth of each target, in BED order (float32)
+
+The cohort step stacks the amplicon depths of all samples into a single
+amplicons x samples matrix, also a .npy file so that it can be opened with
+numpy.load(path, mmap_mode='r') without reading it all, and produces the
+cohort summaries and plots from that matrix alone:
+
+    <prefix>.amplicon_depth.npy   amplicons x samples mean depth (float32)
+    <prefix>.samples.txt          the sample of each column
+    <prefix>.amplicons.bed        the target of each row
+    <prefix>.sample_summary.tsv   depth and uniformity per sample
+    <prefix>.amplicon_summary.tsv depth and dropout per amplicon
+    <prefix>.png                  depth heatmap and per-sample boxplots,
+                                  when matplotlib is installed
+
+Run as a script, from the jobs of the coverage stages:
+
+    python coverage.py sample --bed targets.bed in.bam out_prefix
+    python coverage.py cohort --bed targets.bed out_prefix in.amplicons.npy...
+'''
+
+from __future__ import print_function
+import argparse
+import os
+import numpy
+import pysam
+from intervals import read_bed
+
+# Aligned blocks to collect before adding them to the depth array
+BLOCK_BUFFER = 1000000
+# Amplicons with less than this mean depth count as dropouts
+DEFAULT_MIN_DEPTH = 50
+# Amplicons within this fraction of the sample's mean depth count as uniform
+UNIFORMITY_FRACTION = 0.2
+AMPLICONS_SUFFIX = '.amplicons.npy'
+
+
+class TargetSpace(object):
+    '''The bases of a set of targets, merged where they overlap and
+    concatenated chromosome by chromosome into one coordinate space.
+    '''
+    def __init__(self, regions):
+        by_chrom = {}
+        for _line, chrom, start, end in regions:
+            by_chrom.setdefault(chrom, []).append((start, end))
+        self.chroms = {}
+        offset = 0
+        for chrom in sorted(by_chrom):
+            merged = []
+            for start, end in sorted(by_chrom[chrom]):
+                if merged and start <= merged[-1][1]:
+                    merged[-1][1] = max(merged[-1][1], end)
+                else:
+                    merged.append([start, end])
+            starts = numpy.array([start for start, _end in merged], dtype=numpy.int64)
+            ends = numpy.array([end for _start, end in merged], dtype=numpy.int64)
+            offsets = offset + numpy.concatenate(([0], numpy.cumsum(ends - starts)[:-1]))
+            self.chroms[chrom] = (starts, ends, offsets)
+            offset += int((ends - starts).sum())
+        self.size = offset
+
+    def index(self, chrom, positions):
+        '''Map genomic positions on chrom to the target space. Positions
+        between targets map to the end of the preceding target, so a range
+        of positions maps to the range of target bases it contains.
+        '''
+        starts, ends, offsets = self.chroms[chrom]
+        positions = numpy.asarray(positions, dtype=numpy.int64)
+        interval = numpy.searchsorted(starts, positions, side='right') - 1
+        before_first = interval < 0
+        interval = numpy.maximum(interval, 0)
+        within = numpy.clip(positions - starts[interval], 0,
+                            ends[interval] - starts[interval])
+        return numpy.where(before_first, offsets[0], offsets[interval] + within)
+
+
+def sample_depth(bam_path, regions, threads=1):
+    '''Per-base depth over the target space of regions, from a single pass
+    over the reads of a BAM file'''
+    space = TargetSpace(regions)
+    # Depth changes at the start and end of each aligned block
+    changes = numpy.zeros(space.size + 1, dtype=numpy.int64)
+
+    def add_blocks(chrom, starts, ends):
+        numpy.add.at(changes, space.index(chrom, starts), 1)
+        numpy.add.at(changes, space.index(chrom, ends), -1)
+
+    with pysam.AlignmentFile(bam_path, 'rb', threads=threads) as bam:
+        chrom, starts, ends = None, [], []
+        for read in bam.fetch(until_eof=True):
+            if read.is_unmapped or read.is_secondary or read.is_supplementary \
+                    or read.is_duplicate or read.is_qcfail:
+                continue
+            if read.reference_name != chrom or len(starts) >= BLOCK_BUFFER:
+                if starts:
+                    add_blocks(chrom, starts, ends)
+                chrom, starts, ends = read.reference_name, [], []
+            if chrom not in space.chroms:
+                continue
+            for start, end in read.get_blocks():
+                starts.append(start)
+                ends.append(end)
+        if starts:
+            add_blocks(chrom, starts, ends)
+    return space, numpy.cumsum(changes[:-1]).astype(numpy.uint32)
+
+
+def amplicon_depth(space, depth, regions):
+    '''Mean depth of each region, in order, from the per-base depth'''
+    totals = numpy.concatenate(([0], numpy.cumsum(depth, dtype=numpy.int64)))
+    means = numpy.zeros(len(regions), dtype=numpy.float32)
+    by_chrom = {}
+    for number, (_line, chrom, start, end) in enumerate(regions):
+        by_chrom.setdefault(chrom, []).append((number, start, end))
+    for chrom, targets in by_chrom.items():
+        numbers = numpy.array([number for number, _start, _end in targets])
+        starts = numpy.array([start for _number, start, _end in targets])
+        ends = numpy.array([end for _number, _start, end in targets])
+        first, last = space.index(chrom, starts), space.index(chrom, ends)
+        means[numbers] = (totals[last] - totals[first]) / \
+            numpy.maximum(ends - starts, 1).astype(numpy.float64)
+    return means
+
+
+def write_sample(bed_path, bam_path, prefix, threads=1):
+    '''Write the per-base and per-amplicon depth of a BAM file'''
+    regions = read_bed(bed_path)
+    space, depth = sample_depth(bam_path, regions, threads)
+    numpy.save(prefix + '.depth.npy', depth)
+    numpy.save(prefix + AMPLICONS_SUFFIX, amplicon_depth(space, depth, regions))
+
+
+def sample_name(amplicons_path):
+    name = os.path.basename(amplicons_path)
+    if name.endswith(AMPLICONS_SUFFIX):
+        name = name[:-len(AMPLICONS_SUFFIX)]
+    return name
+
+
+def write_matrix(amplicon_paths, num_amplicons, matrix_path):
+    '''Stack the amplicon depths of the samples into an amplicons x samples
+    matrix, written straight to a memory-mappable .npy file'''
+    matrix = numpy.lib.format.open_memmap(
+        matrix_path, mode='w+', dtype=numpy.float32,
+        shape=(num_amplicons, len(amplicon_paths)))
+    for column, path in enumerate(amplicon_paths):
+        depths = numpy.load(path)
+        if len(depths) != num_amplicons:
+            raise Exception("{} has {} amplicons, expected {}".format(
+                            path, len(depths), num_amplicons))
+        matrix[:, column] = depths
+    matrix.flush()
+    del matrix
+
+
+def sample_summary(matrix, min_depth=DEFAULT_MIN_DEPTH):
+    '''Mean and median amplicon depth of each sample, and the fractions of
+    its amplicons above min_depth and above UNIFORMITY_FRACTION of its mean'''
+    mean = matrix.mean(axis=0)
+    median = numpy.median(matrix, axis=0)
+    above_min = (matrix >= min_depth).mean(axis=0)
+    uniform = (matrix >= UNIFORMITY_FRACTION * mean).mean(axis=0)
+    return mean, median, above_min, uniform
+
+
+def amplicon_summary(matrix, min_depth=DEFAULT_MIN_DEPTH):
+    '''Median depth of each amplicon over the samples, its depth relative to
+    the other amplicons, and the fraction of samples it drops out in'''
+    median = numpy.median(matrix, axis=1)
+    # Depth of each amplicon relative to the sample's mean, averaged
+    sample_means = numpy.maximum(matrix.mean(axis=0), 1e-9)
+    relative = (matrix / sample_means).mean(axis=1)
+    dropout = (matrix < min_depth).mean(axis=1)
+    return median, relative, dropout
+
+
+def write_plots(matrix, samples, plot_path):
+    '''Plot a heatmap of log depth and the depth distribution per sample,
+    if matplotlib is available'''
+    try:
+        import matplotlib
+        matplotlib.use('Agg')
+        import matplotlib.pyplot as pyplot
+    except ImportError:
+        print('matplotlib is not installed, not plotting coverage')
+        return
+    figure, (heatmap, boxplot) = pyplot.subplots(
+        2, 1, figsize=(max(8, 0.25 * len(samples)), 12))
+    image = heatmap.imshow(numpy.log10(matrix + 1), aspect='auto',
+                           interpolation='nearest', cmap='viridis')
+    heatmap.set_title('Amplicon depth (log10)')
+    heatmap.set_xlabel('sample')
+    heatmap.set_ylabel('amplicon')
+    figure.colorbar(image, ax=heatmap)
+    boxplot.boxplot([matrix[:, column] for column in range(len(samples))])
+    boxplot.set_yscale('symlog')
+    boxplot.set_xticklabels(samples, rotation=90, fontsize=6)
+    boxplot.set_ylabel('amplicon depth')
+    figure.tight_layout()
+    figure.savefig(plot_path)
+    pyplot.close(figure)
+
+
+def write_cohort(bed_path, prefix, amplicon_paths, min_depth=DEFAULT_MIN_DEPTH):
+    '''Build the cohort coverage matrix and its summaries and plots'''
+    regions = read_bed(bed_path)
+    amplicon_paths = sorted(amplicon_paths, key=sample_name)
+    samples = [sample_name(path) for path in amplicon_paths]
+    matrix_path = prefix + '.amplicon_depth.npy'
+    write_matrix(amplicon_paths, len(regions), matrix_path)
+    with open(prefix + '.samples.txt', 'w') as samples_file:
+        samples_file.writelines(sample + '\n' for sample in samples)
+    with open(prefix + '.amplicons.bed', 'w') as amplicons_file:
+        amplicons_file.writelines(line + '\n' for line, _chrom, _start, _end in regions)
+    matrix = numpy.load(matrix_path, mmap_mode='r')
+    with open(prefix + '.sample_summary.tsv', 'w') as summary:
+        summary.write('sample\tmean_depth\tmedian_depth\tfraction_above_{}\t'
+                      'uniformity\n'.format(min_depth))
+        for row in zip(samples, *sample_summary(matrix, min_depth)):
+            summary.write('{}\t{:.1f}\t{:.1f}\t{:.4f}\t{:.4f}\n'.format(*row))
+    with open(prefix + '.amplicon_summary.tsv', 'w') as summary:
+        summary.write('chrom\tstart\tend\tmedian_depth\trelative_depth\t'
+                      'dropout_fraction\n')
+        median, relative, dropout = amplicon_summary(matrix, min_depth)
+        for (_line, chrom, start, end), row in \
+                zip(regions, zip(median, relative, dropout)):
+            summary.write('{}\t{}\t{}\t{:.1f}\t{:.3f}\t{:.4f}\n'.format(
+                chrom, start, end, *row))
+    write_plots(matrix, samples, prefix + '.png')
+
+
+def parse_args(args=None):
+    parser = argparse.ArgumentParser(
+        description='Amplicon coverage of BAM files and of the cohort')
+    commands = parser.add_subparsers(dest='command')
+    sample = commands.add_parser('sample',
+        help='Per-base and per-amplicon depth of one BAM file')
+    sample.add_argument('--bed', required=True, help='Target regions')
+    sample.add_argument('--threads', type=int, default=1,
+        help='Threads for BGZF decompression, defaults to 1')
+    sample.add_argument('bam', help='BAM file')
+    sample.add_argument('prefix', help='Prefix of the output files')
+    cohort = commands.add_parser('cohort',
+        help='Cohort coverage matrix, summaries and plots')
+    cohort.add_argument('--bed', required=True, help='Target regions')
+    cohort.add_argument('--min_depth', type=int, default=DEFAULT_MIN_DEPTH,
+        help='Depth below which an amplicon drops out, defaults to '
+             '{}'.format(DEFAULT_MIN_DEPTH))
+    cohort.add_argument('prefix', help='Prefix of the output files')
+    cohort.add_argument('amplicons', nargs='+',
+        help='Amplicon depths of the samples (' + AMPLICONS_SUFFIX + ' files)')
+    return parser.parse_args(args)
+
+
+def main(args=None):
+    options = parse_args(args)
+    if options.command == 'sample':
+        write_sample(options.bed, options.bam, options.prefix, options.threads)
+    else:
+        write_cohort(options.bed, options.prefix, options.amplicons,
+                     options.min_depth)
+
+
+if __name__ == '__main__':
+    main()
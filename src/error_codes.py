@@ -1,3 +1,4 @@
 '''Exit status values'''
 
 DRMAA_ERROR = 2
+PLAN_ERROR = 3
@@ -0,0 +1,76 @@
+'''
+Classification of failed jobs, so that run_stage can resubmit the jobs that
+failed because of the cluster rather than because of the tool.
+
+A job that ran out of memory or walltime, or whose node failed, would most
+likely succeed if it were simply submitted again, with more memory or time
+in the first two cases. A job whose tool reported an error would fail the
+same way again. The cause is worked out from the DRMAA job info of cluster
+jobs (see job_monitor.JobFailed), from what the scheduler wrote to the
+stderr of the job, or of the array task or bundle job it ran in (slurmstepd
+reports time limits, out of memory kills and node failures there) and from
+the end of the stderr log of the job, where Java reports an exhausted heap.
+
+SLURM ends jobs over their memory and over their walltime alike with
+SIGKILL, so a job killed without any such message is KILLED: either
+resource may have run out.
+'''
+
+import re
+import signal
+
+from job_logs import tail
+
+OUT_OF_MEMORY = 'OOM'
+TIMEOUT = 'TIMEOUT'
+NODE_FAILURE = 'NODE_FAILURE'
+# Killed by the scheduler or the kernel for no reason given
+KILLED = 'KILLED'
+TOOL_ERROR = 'TOOL_ERROR'
+
+# Failures of the cluster rather than of the tool, worth resubmitting
+INFRASTRUCTURE_FAILURES = (OUT_OF_MEMORY, TIMEOUT, NODE_FAILURE, KILLED)
+
+# Messages of the scheduler and of tools that identify the failure, checked
+# in this order
+FAILURE_PATTERNS = [
+    (TIMEOUT, re.compile(r'DUE TO TIME LIMIT|exceeded (job )?walltime|'
+                         r'job killed: walltime', re.IGNORECASE)),
+    (OUT_OF_MEMORY, re.compile(r'oom-kill|out-of-memory|Exceeded job memory limit|'
+                               r'java\.lang\.OutOfMemoryError|std::bad_alloc|'
+                               r'Cannot allocate memory|job killed: mem',
+                               re.IGNORECASE)),
+    (NODE_FAILURE, re.compile(r'DUE TO NODE FAILURE|DUE TO PREEMPTION|'
+                              r'node fail', re.IGNORECASE)),
+]
+
+# Exit status of a shell whose command was killed with SIGKILL, which is
+# how the out of memory killers, and SLURM at the end of the walltime, end
+# a process
+KILLED_STATUS = 128 + signal.SIGKILL
+
+
+def classify(error, log_lines=()):
+    '''The kind of failure of a job that raised error, given the last lines
+    of its stderr log'''
+    job_info = getattr(error, 'job_info', None)
+    lines = list(getattr(error, 'stderr', None) or []) + list(log_lines)
+    scheduler_stderr = getattr(error, 'scheduler_stderr', None)
+    if scheduler_stderr:
+        lines.extend(tail(scheduler_stderr))
+    for kind, pattern in FAILURE_PATTERNS:
+        if any(pattern.search(line) for line in lines):
+            return kind
+    if job_info is None:
+        return TOOL_ERROR
+    if job_info.wasAborted:
+        # Never ran, for instance because its node went down
+        return NODE_FAILURE
+    if job_info.hasSignal:
+        if job_info.terminatedSignal in ('SIGXCPU', signal.SIGXCPU):
+            return TIMEOUT
+        if job_info.terminatedSignal in ('SIGKILL', signal.SIGKILL):
+            return KILLED
+    if job_info.hasExited and job_info.exitStatus == KILLED_STATUS:
+        return KILLED
+    return TOOL_ERROR
@@ -0,0 +1,254 @@
+'''
+Persistent index of the state of pipeline files, for fast up-to-date checks.
+
+Before running anything ruffus checks whether each job of each task is up to
+date, which takes an existence check, a modification time and a resolved
+path of every input and output file. With thousands of files on a shared
+file system such as Lustre each of those is a round trip to the metadata
+server, and the checks take minutes.
+
+Instead, run_stage records the size and modification time of the outputs of
+each job in a SQLite database once the job has finished, and the up-to-date
+checks of ruffus consult it first. Entries are trusted while the listing of
+their directory is unchanged: the first time a directory is looked at in a
+run its modification time is compared with the one recorded when it was
+last checked. Only when they differ, because files were created, removed
+or renamed in it since, are its indexed files looked at again. Files the
+index does not know are looked up on the file system as before, and added
+to it. So a run over an unchanged tree costs one stat per directory rather
+than several per file. A directory is only checked once per run, so stages
+that write or remove files in the pipeline process itself, rather than in a
+job of run_stage, record those files too (see runner.record_outputs).
+
+A file changed in place, in a directory where nothing else changed, is not
+noticed; delete the index after changing pipeline files by hand.
+
+The index also keeps the checksums computed for the result cache, so that
+unchanged inputs are not read again by later runs.
+'''
+
+import os
+import sqlite3
+import stat
+import threading
+import time
+from collections import defaultdict, namedtuple
+from ruffus import file_name_parameters
+from result_cache import file_checksum
+
+# Seconds to wait for other pipeline runs holding the database lock
+LOCK_TIMEOUT = 600
+# Directory modification times are only trusted once they are older than
+# this many seconds, as some file systems keep them to the second and a
+# change in the same second would go unnoticed
+MTIME_GRANULARITY = 2
+
+# What the index knows of a file. link tells whether the path is a symbolic
+# link, in which case it is resolved on the file system.
+FileState = namedtuple('FileState', ['size', 'mtime', 'link', 'checksum'])
+
+
+def file_state(path):
+    '''The FileState of path on the file system, or None if it does not
+    exist (following links, like os.path.exists)'''
+    try:
+        link = stat.S_ISLNK(os.lstat(path).st_mode)
+        status = os.stat(path) if link else os.lstat(path)
+    except OSError:
+        return None
+    return FileState(status.st_size, status.st_mtime, link, None)
+
+
+class FileIndex(object):
+    '''Size, modification time and checksum of files, by absolute path'''
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        # Jobs of different tasks finish in different ruffus threads
+        self.connection = sqlite3.connect(path, timeout=LOCK_TIMEOUT,
+                                          check_same_thread=False)
+        self.connection.text_factory = str
+        with self.connection:
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS files ('
+                'path TEXT PRIMARY KEY, size INTEGER, mtime REAL, '
+                'link INTEGER, checksum TEXT)')
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS directories ('
+                'path TEXT PRIMARY KEY, mtime REAL)')
+        # Everything is read up front, as ruffus looks up every file of
+        # every job
+        self.files = dict(
+            (row[0], FileState(row[1], row[2], bool(row[3]), row[4]))
+            for row in self.connection.execute(
+                'SELECT path, size, mtime, link, checksum FROM files'))
+        self.directory_mtimes = dict(self.connection.execute(
+            'SELECT path, mtime FROM directories'))
+        # Names of the indexed files of each directory
+        self.names = defaultdict(set)
+        for path in self.files:
+            directory, name = os.path.split(path)
+            self.names[directory].add(name)
+        # Directories whose entries have been checked in this run, and
+        # their resolved paths
+        self.checked = set()
+        self.real_directories = {}
+
+    def close(self):
+        self.connection.close()
+
+    def _store(self, states):
+        '''Add (path, FileState) pairs to the index, with the lock held'''
+        with self.connection:
+            self.connection.executemany(
+                'INSERT OR REPLACE INTO files (path, size, mtime, link, checksum) '
+                'VALUES (?, ?, ?, ?, ?)',
+                [(path, state.size, state.mtime, int(state.link), state.checksum)
+                 for path, state in states])
+        self.files.update(states)
+        for path, _state in states:
+            directory, name = os.path.split(path)
+            self.names[directory].add(name)
+
+    def _check_directory(self, directory):
+        '''Look again at the indexed files of directory if it has changed
+        since it was last checked, with the lock held'''
+        if directory in self.checked:
+            return
+        self.checked.add(directory)
+        try:
+            mtime = os.stat(directory).st_mtime
+        except OSError:
+            mtime = None
+        if mtime is not None and mtime == self.directory_mtimes.get(directory):
+            return
+        changed, gone = [], []
+        for name in self.names[directory]:
+            path = os.path.join(directory, name)
+            known, current = self.files[path], file_state(path)
+            if current is None:
+                gone.append(path)
+            elif (current.size, current.mtime, current.link) != \
+                    (known.size, known.mtime, known.link):
+                changed.append((path, current))
+        self._store(changed)
+        self._forget(gone)
+        if mtime is not None and time.time() - mtime > MTIME_GRANULARITY:
+            with self.connection:
+                self.connection.execute(
+                    'INSERT OR REPLACE INTO directories (path, mtime) '
+                    'VALUES (?, ?)', (directory, mtime))
+            self.directory_mtimes[directory] = mtime
+
+    def state(self, path):
+        '''The FileState of path, or None if it does not exist'''
+        path = os.path.abspath(path)
+        with self.lock:
+            self._check_directory(os.path.dirname(path))
+            state = self.files.get(path)
+        if state is not None:
+            return state
+        # Not in the index, so ask the file system. A file missing from the
+        # index may still have been written by something other than
+        # run_stage during this run.
+        state = file_state(path)
+        if state is not None:
+            with self.lock:
+                self._store([(path, state)])
+        return state
+
+    def record(self, paths):
+        '''Record the current state of paths, after a job has written or
+        removed them'''
+        states, gone = [], []
+        for path in paths:
+            path = os.path.abspath(path)
+            state = file_state(path)
+            if state is not None:
+                states.append((path, state))
+            else:
+                gone.append(path)
+        with self.lock:
+            self._store(states)
+            self._forget(gone)
+
+    def _forget(self, paths):
+        '''Drop paths that no longer exist from the index, with the lock
+        held'''
+        with self.connection:
+            self.connection.executemany('DELETE FROM files WHERE path = ?',
+                                        [(path,) for path in paths])
+        for path in paths:
+            self.files.pop(path, None)
+            directory, name = os.path.split(path)
+            self.names[directory].discard(name)
+
+    def checksum(self, path):
+        '''Checksum of the contents of a file, read only when the file has
+        changed since its checksum was last recorded'''
+        path = os.path.abspath(path)
+        current = file_state(path)
+        if current is None:
+            # Let file_checksum raise the error
+            return file_checksum(path)
+        with self.lock:
+            known = self.files.get(path)
+        if known is not None and known.checksum is not None and \
+                (known.size, known.mtime) == (current.size, current.mtime):
+            return known.checksum
+        current = current._replace(checksum=file_checksum(path))
+        with self.lock:
+            self._store([(path, current)])
+        return current.checksum
+
+    def exists(self, path):
+        return self.state(path) is not None
+
+    def getmtime(self, path):
+        state = self.state(path)
+        if state is None:
+            # Raise the usual error
+            return os.path.getmtime(path)
+        return state.mtime
+
+    def realpath(self, path):
+        '''os.path.realpath, resolving only the directory of files that
+        are not links, once per directory'''
+        state = self.state(path)
+        if state is None or state.link:
+            return os.path.realpath(path)
+        directory, name = os.path.split(os.path.abspath(path))
+        with self.lock:
+            real_directory = self.real_directories.get(directory)
+        if real_directory is None:
+            real_directory = os.path.realpath(directory)
+            with self.lock:
+                self.real_directories[directory] = real_directory
+        return os.path.join(real_directory, name)
+
+
+class IndexedPath(object):
+    '''os.path, with the file lookups of up-to-date checks answered from a
+    FileIndex'''
+    def __init__(self, index):
+        self.exists = index.exists
+        self.getmtime = index.getmtime
+        self.realpath = index.realpath
+
+    def __getattr__(self, name):
+        return getattr(os.path, name)
+
+
+class IndexedOs(object):
+    '''The os module, with an IndexedPath for os.path'''
+    def __init__(self, index):
+        self.path = IndexedPath(index)
+
+    def __getattr__(self, name):
+        return getattr(os, name)
+
+
+def install_in_ruffus(index):
+    '''Make the up-to-date checks of ruffus, which live in its
+    file_name_parameters module, look files up in index'''
+    file_name_parameters.os = IndexedOs(index)
@@ -0,0 +1,116 @@
+'''
+Split the panel BED file into balanced interval shards, so that variant
+calling can be scattered over several jobs and gathered afterwards.
+
+Shards are balanced by the number of amplicons they contain, or by the
+historical runtime of each amplicon when a weights file is supplied, rather
+than by the number of bases they cover. Amplicons are small and roughly the
+same size, but the calling time is dominated by read depth, which follows
+the amplicon, not its length.
+
+Overlapping or adjacent amplicons are kept in the same shard. MuTect2 calls
+a variant in every shard whose intervals cover it, and merging the shard
+VCFs keeps the duplicates, so such amplicons are balanced as one cluster.
+'''
+
+import os
+
+
+def read_bed(bed_path):
+    '''Read the regions of a BED file as a list of (line, chrom, start, end).
+    Header, track and comment lines are skipped.
+    '''
+    regions = []
+    with open(bed_path) as bed_file:
+        for line in bed_file:
+            if not line.strip() or line.startswith(('#', 'track', 'browser')):
+                continue
+            line = line.rstrip('\n')
+            fields = line.split('\t')
+            regions.append((line, fields[0], int(fields[1]), int(fields[2])))
+    return regions
+
+
+def read_weights(weights_path):
+    '''Read historical per-region weights (such as runtime in seconds) from
+    a tab separated file of chrom, start, end and weight.
+    '''
+    weights = {}
+    with open(weights_path) as weights_file:
+        for line in weights_file:
+            if not line.strip() or line.startswith('#'):
+                continue
+            chrom, start, end, weight = line.rstrip('\n').split('\t')[:4]
+            weights[(chrom, int(start), int(end))] = float(weight)
+    return weights
+
+
+def region_clusters(regions):
+    '''Group the indices of regions into clusters of overlapping or adjacent
+    regions, in coordinate order'''
+    clusters = []
+    cluster_chrom, cluster_end = None, None
+    by_coordinate = sorted(range(len(regions)),
+                           key=lambda index: regions[index][1:])
+    for index in by_coordinate:
+        _line, chrom, start, end = regions[index]
+        # BED intervals are half open, so adjacent regions have start equal
+        # to the end of the previous one
+        if chrom == cluster_chrom and start <= cluster_end:
+            clusters[-1].append(index)
+            cluster_end = max(cluster_end, end)
+        else:
+            clusters.append([index])
+            cluster_chrom, cluster_end = chrom, end
+    return clusters
+
+
+def balance_shards(regions, num_shards, weights=None):
+    '''Partition regions into num_shards groups of similar total weight.
+
+    Overlapping or adjacent regions are first grouped into clusters, which
+    are never split between shards. Uses the longest processing time first
+    heuristic: clusters are taken heaviest first and each is put in the
+    currently lightest shard. Regions without a recorded weight count as
+    the mean recorded weight, or 1 when there are no weights at all. Each
+    shard keeps the regions in their original order.
+    '''
+    clusters = region_clusters(regions)
+    if len(clusters) < num_shards:
+        raise Exception("Cannot split {} clusters of regions into {} shards"
+                        .format(len(clusters), num_shards))
+    weights = weights or {}
+    default_weight = (sum(weights.values()) / len(weights)) if weights else 1.0
+
+    def region_weight(index):
+        _line, chrom, start, end = regions[index]
+        return weights.get((chrom, start, end), default_weight)
+
+    def cluster_weight(cluster):
+        return sum(region_weight(index) for index in cluster)
+
+    shard_totals = [0.0] * num_shards
+    shard_members = [[] for _ in range(num_shards)]
+    heaviest_first = sorted(clusters, key=cluster_weight, reverse=True)
+    for cluster in heaviest_first:
+        lightest = min(range(num_shards), key=lambda shard: shard_totals[shard])
+        shard_totals[lightest] += cluster_weight(cluster)
+        shard_members[lightest].extend(cluster)
+    return [[regions[index] for index in sorted(members)]
+            for members in shard_members]
+
+
+def shard_bed_paths(directory, num_shards):
+    '''File names of the shard BED files, in shard order'''
+    return [os.path.join(directory, 'shard_{:03d}.bed'.format(shard))
+            for shard in range(num_shards)]
+
+
+def write_shards(bed_path, shard_paths, weights_path=None):
+    '''Split bed_path into one balanced BED file per path in shard_paths'''
+    weights = read_weights(weights_path) if weights_path else None
+    shards = balance_shards(read_bed(bed_path), len(shard_paths), weights)
+    for shard_path, shard in zip(shard_paths, shards):
+        with open(shard_path, 'w') as shard_file:
+            for line, _chrom, _start, _end in shard:
+                shard_file.write(line + '\n')
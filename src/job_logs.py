@@ -0,0 +1,84 @@
+'''
+Per-stage, per-sample log files of the stdout and stderr of jobs.
+
+ruffus' run_job collects the whole stdout and stderr of a job in memory, and
+tools such as bwa and VEP write hundreds of MB to stderr. Instead, run_stage
+starts each job script by redirecting its own stdout and stderr, appending to
+
+    {log directory}/{stage}/{first output}.stdout
+    {log directory}/{stage}/{first output}.stderr
+
+so that the output goes straight from the job to disk, wherever the job
+runs, and all that ruffus or the cluster scheduler sees is what the job
+writes before the redirection (normally nothing). Every attempt of a job
+starts with a header line in both files, so retries are kept after the
+output of the attempts that failed. When a job finally fails, only the last
+lines of its stderr are read back for the error report.
+'''
+
+import os
+from collections import deque
+
+try:
+    from shlex import quote
+except ImportError:
+    from pipes import quote
+
+# Default directory of the job log files
+DEFAULT_JOB_LOG_DIR = 'job_logs'
+# Lines at the end of a log file, and bytes they are looked for in,
+# reported when a job fails
+TAIL_LINES = 50
+TAIL_BYTES = 64 * 1024
+# Start of the header line of each attempt of a job
+HEADER_PREFIX = '==== '
+
+
+def log_paths(log_dir, stage, outputs=None, inputs=None):
+    '''Absolute paths of the stdout and stderr log files of a job of stage,
+    named after its first output (or input), creating their directory'''
+    names = [os.path.basename(path) for path in (outputs or inputs or [])]
+    name = names[0] if names else stage
+    directory = os.path.abspath(os.path.join(log_dir, stage))
+    try:
+        os.makedirs(directory)
+    except OSError:
+        # Already exists, possibly created by another job
+        pass
+    base = os.path.join(directory, name)
+    return base + '.stdout', base + '.stderr'
+
+
+def logged_command(command, stdout_log, stderr_log, header):
+    '''Prefix a job script with the redirection of its stdout and stderr to
+    the end of the log files, and a header line in each'''
+    return 'exec >> {stdout} 2>> {stderr}\n' \
+           'echo {header} "on $(hostname) at $(date)"\n' \
+           'echo {header} "on $(hostname) at $(date)" >&2\n' \
+           '{command}'.format(stdout=quote(stdout_log), stderr=quote(stderr_log),
+                              header=quote(HEADER_PREFIX + header), command=command)
+
+
+def tail(path, lines=TAIL_LINES):
+    '''The last lines of the file at path, reading no more than the last
+    TAIL_BYTES of it. Missing files have no lines.'''
+    try:
+        with open(path) as log_file:
+            log_file.seek(0, os.SEEK_END)
+            size = log_file.tell()
+            log_file.seek(max(0, size - TAIL_BYTES))
+            if size > TAIL_BYTES:
+                # Skip the partial line
+                log_file.readline()
+            return list(deque(log_file, lines))
+    except IOError:
+        return []
+
+
+def last_attempt(lines):
+    '''The lines written by the last attempt of a job, out of the last
+    lines of its log'''
+    for index in range(len(lines) - 1, -1, -1):
+        if lines[index].startswith(HEADER_PREFIX):
+            return lines[index:]
+    return lines
@@ -0,0 +1,470 @@
+'''
+Asynchronous submission and monitoring of cluster jobs through DRMAA.
+
+ruffus' run_job submits a job and then waits on it with its own call to
+drmaa_session.wait, so every cluster job in flight ties up a worker thread
+that keeps polling the scheduler. Instead, JobMonitor.submit returns a
+JobFuture as soon as the job is queued, and a single background thread
+collects finished jobs for the whole session with drmaa_session.wait on
+JOB_IDS_SESSION_ANY, resolving the future of each. Worker threads that do
+need the outcome block on the future, which costs no scheduler polling, so
+--jobs can be raised to the number of jobs wanted in flight without adding
+load on the scheduler.
+
+Stages that fan out into many small jobs can instead be submitted as job
+arrays (DRMAA bulk jobs). Jobs of such a stage that become ready within
+array_window seconds of each other, with the same job options, are batched
+and submitted as one array of at most array_size tasks. Each job keeps its
+own job script, listed in an index file; the array task looks up its script
+by its task id and runs it with stdout and stderr redirected to the files
+run_job would have used. Every task is waited on as a job of its own, so the
+success or failure of each still goes back to the ruffus job it came from.
+ruffus only runs --jobs jobs at a time, so no array is larger than that.
+
+Commands that take seconds are better bundled: the jobs of a stage marked
+"bundle: True" are batched the same way (over bundle_window seconds, at most
+bundle_size of them) but submitted as a single cluster job with the stage's
+job options, which runs the bundled job scripts up to the stage's cores at a
+time. Each script still writes its own stdout and stderr, and its exit
+status to a file next to them, which decides the outcome of its ruffus job.
+The walltime of the stage has to cover the whole bundle. A bundle may also
+have setup and teardown commands, run once per bundle job before and after
+its scripts, for instance to load a shared index into memory on the node.
+
+Callers that want to know when a job leaves the scheduler's queue, such as
+the live metrics, pass a job_started callback. Every poll_interval the
+poller asks the scheduler for the status of the jobs such callers wait on
+(drmaa jobStatus), and calls back once a job is RUNNING rather than
+QUEUED_ACTIVE. A job that finishes in between is never seen running.
+'''
+
+import os
+import tempfile
+import threading
+import time
+
+from ruffus.drmaa_wrapper import error_drmaa_job, setup_drmaa_job, \
+    write_job_script_to_temp_file, read_stdout_stderr_from_files
+from batching import Batcher
+
+try:
+    from shlex import quote
+except ImportError:
+    from pipes import quote
+
+# Seconds the poller waits for a job to finish before checking for shutdown
+DEFAULT_POLL_INTERVAL = 10
+# Seconds to collect the jobs of an array stage before submitting them
+DEFAULT_ARRAY_WINDOW = 30
+# Most tasks in one job array, within SLURM's default MaxArraySize
+DEFAULT_ARRAY_SIZE = 1000
+# Seconds to collect the jobs of a bundled stage before submitting them
+DEFAULT_BUNDLE_WINDOW = 30
+# Most commands run by one bundle job
+DEFAULT_BUNDLE_SIZE = 100
+
+# Runs one task of a job array: the task id (counting from 1) selects the
+# line of the index file, given as the first argument, naming the job script
+ARRAY_TASK_SCRIPT = '''#!/bin/sh
+task=${SLURM_ARRAY_TASK_ID:-${SGE_TASK_ID:-$PBS_ARRAYID}}
+script=$(sed -n "${task}p" "$1")
+exec sh "$script" > "$script.stdout" 2> "$script.stderr"
+'''
+
+# Runs all the job scripts listed in the index file, the first argument, at
+# most the second argument at a time, recording the exit status of each
+BUNDLE_SCRIPT = '''#!/bin/sh
+xargs -P "$2" -I {} sh -c \\
+    'sh "$1" > "$1.stdout" 2> "$1.stderr"; echo $? > "$1.exit"' sh {} < "$1"
+'''
+
+
+class JobFailed(error_drmaa_job):
+    '''A cluster job that did not exit successfully. The DRMAA JobInfo of
+    the job (or None if the scheduler did not provide it) is kept in
+    job_info, together with the job's stdout and stderr, and the path of
+    the file the scheduler wrote its own messages about the job to (the
+    stderr of the array task or bundle job, if it ran in one).
+    '''
+    def __init__(self, message, job_info=None, stdout=None, stderr=None,
+                 scheduler_stderr=None):
+        error_drmaa_job.__init__(self, message)
+        self.job_info = job_info
+        self.stdout = stdout
+        self.stderr = stderr
+        self.scheduler_stderr = scheduler_stderr
+
+
+class JobFuture(object):
+    '''The eventual DRMAA JobInfo of a submitted job'''
+    def __init__(self, job_id):
+        self.job_id = job_id
+        self.job_info = None
+        self.error = None
+        self.finished = threading.Event()
+        self.started = False
+        self.start_callbacks = []
+        self.start_lock = threading.Lock()
+
+    def when_started(self, callback):
+        '''Call callback once the scheduler has started the job, or now
+        if it already has'''
+        with self.start_lock:
+            if not self.started:
+                self.start_callbacks.append(callback)
+                return
+        callback()
+
+    def set_started(self):
+        with self.start_lock:
+            self.started = True
+            callbacks, self.start_callbacks = self.start_callbacks, []
+        for callback in callbacks:
+            callback()
+
+    def set_result(self, job_info):
+        self.job_info = job_info
+        self.finished.set()
+
+    def set_error(self, error):
+        self.error = error
+        self.finished.set()
+
+    def done(self):
+        return self.finished.is_set()
+
+    def result(self):
+        '''Block until the job has finished and return its JobInfo'''
+        # Wait in short steps so that the thread stays interruptible
+        while not self.finished.wait(1):
+            pass
+        if self.error is not None:
+            raise self.error
+        return self.job_info
+
+
+class JobMonitor(object):
+    '''Submits jobs to a DRMAA session and tracks all of them from one thread'''
+    def __init__(self, drmaa_session, poll_interval=DEFAULT_POLL_INTERVAL):
+        self.session = drmaa_session
+        self.poll_interval = poll_interval
+        self.jobs = {}
+        self.lock = threading.Lock()
+        self.jobs_pending = threading.Condition(self.lock)
+        self.stopping = False
+        self.status_checked = 0
+        self.arrays = Batcher(self._submit_array)
+        self.bundles = Batcher(self._submit_bundle)
+        self.poller = threading.Thread(target=self._poll, name='drmaa-poller')
+        self.poller.daemon = True
+        self.poller.start()
+
+    def submit_template(self, job_template):
+        '''Submit a job from a DRMAA job template, returning its future'''
+        with self.lock:
+            # Register the job before the poller can see it finish
+            job_id = self.session.runJob(job_template)
+            future = JobFuture(job_id)
+            self.jobs[job_id] = future
+            self.jobs_pending.notify()
+        return future
+
+    def submit(self, cmd_str, job_name, job_other_options, job_script_directory):
+        '''Write a job script for cmd_str and submit it, as ruffus' run_job
+        does. Returns the future of the job and the paths of its script,
+        stdout and stderr.
+        '''
+        job_template = setup_drmaa_job(self.session, job_name, None, None,
+                                       job_other_options)
+        job_script_path, stdout_path, stderr_path = write_job_script_to_temp_file(
+            cmd_str, job_script_directory, job_name, job_other_options, None, None)
+        job_template.remoteCommand = job_script_path
+        # drmaa paths are specified as [hostname]:file_path
+        job_template.outputPath = ':' + stdout_path
+        job_template.errorPath = ':' + stderr_path
+        try:
+            future = self.submit_template(job_template)
+        finally:
+            self.session.deleteJobTemplate(job_template)
+        return future, job_script_path, stdout_path, stderr_path
+
+    def submit_array(self, cmd_strs, job_name, job_other_options,
+                     job_script_directory):
+        '''Write a job script for each of cmd_strs and submit them as the
+        tasks of one job array. Returns the future and the paths of the
+        script, stdout and stderr of each, and of the stderr of its array
+        task, in the order of cmd_strs.
+        '''
+        import drmaa
+        scripts, index_path, task_script_path = write_batch_scripts(
+            cmd_strs, job_name + '_array_', job_other_options,
+            job_script_directory, ARRAY_TASK_SCRIPT)
+        job_template = setup_drmaa_job(self.session, job_name, None, None,
+                                       job_other_options)
+        job_template.remoteCommand = '/bin/sh'
+        job_template.args = [task_script_path, index_path]
+        # Output of the task script itself, not of the jobs it runs
+        task_log = index_path[:-len('.index')] + '.' + \
+            drmaa.JobTemplate.PARAMETRIC_INDEX
+        job_template.outputPath = ':' + task_log + '.stdout'
+        job_template.errorPath = ':' + task_log + '.stderr'
+        try:
+            with self.lock:
+                job_ids = self.session.runBulkJobs(job_template, 1, len(cmd_strs), 1)
+                futures = [JobFuture(job_id) for job_id in job_ids]
+                for future in futures:
+                    self.jobs[future.job_id] = future
+                self.jobs_pending.notify()
+        finally:
+            self.session.deleteJobTemplate(job_template)
+        task_stderrs = [task_log.replace(drmaa.JobTemplate.PARAMETRIC_INDEX,
+                                         str(task)) + '.stderr'
+                        for task in range(1, len(cmd_strs) + 1)]
+        return [(future,) + script + (task_stderr,) for future, script, task_stderr
+                in zip(futures, scripts, task_stderrs)]
+
+    def submit_bundle(self, cmd_strs, job_name, job_other_options,
+                      job_script_directory, cores, setup=None, teardown=None):
+        '''Write a job script for each of cmd_strs and submit one job that
+        runs them, cores at a time, between the setup and teardown commands.
+        Returns the future of that job and the paths of the script, stdout
+        and stderr of each, and of the stderr of the bundle job, in the
+        order of cmd_strs.
+        '''
+        scripts, index_path, bundle_script_path = write_batch_scripts(
+            cmd_strs, job_name + '_bundle_', job_other_options,
+            job_script_directory, bundle_script(setup, teardown))
+        job_template = setup_drmaa_job(self.session, job_name, None, None,
+                                       job_other_options)
+        job_template.remoteCommand = '/bin/sh'
+        job_template.args = [bundle_script_path, index_path, str(cores)]
+        job_template.outputPath = ':' + bundle_script_path + '.stdout'
+        job_template.errorPath = ':' + bundle_script_path + '.stderr'
+        try:
+            future = self.submit_template(job_template)
+        finally:
+            self.session.deleteJobTemplate(job_template)
+        return [(future,) + script + (bundle_script_path + '.stderr',)
+                for script in scripts]
+
+    def _submit_array(self, key, jobs):
+        job_name, job_other_options, job_script_directory = key
+        cmd_strs, nice = batch_jobs(jobs)
+        return self.submit_array(cmd_strs, job_name,
+                                 with_nice(job_other_options, nice),
+                                 job_script_directory)
+
+    def _submit_bundle(self, key, jobs):
+        job_name, job_other_options, job_script_directory, cores, \
+            setup, teardown = key
+        cmd_strs, nice = batch_jobs(jobs)
+        return self.submit_bundle(cmd_strs, job_name,
+                                  with_nice(job_other_options, nice),
+                                  job_script_directory, cores, setup, teardown)
+
+    def run(self, cmd_str, job_name, job_other_options, job_script_directory,
+            logger=None, array=False, array_window=DEFAULT_ARRAY_WINDOW,
+            array_size=DEFAULT_ARRAY_SIZE, bundle=False,
+            bundle_window=DEFAULT_BUNDLE_WINDOW,
+            bundle_size=DEFAULT_BUNDLE_SIZE, cores=1, bundle_setup=None,
+            bundle_teardown=None, nice=0, job_started=None,
+            job_finished=None):
+        '''Submit cmd_str and wait for it to finish. Returns the stdout and
+        stderr of the job like ruffus' run_job, and raises JobFailed if it
+        was aborted, killed by a signal or exited with non-zero status.
+        With array set, the job is submitted as a task of a job array
+        together with the other jobs of the same name and options that
+        arrive within array_window seconds. With bundle set, it is run by
+        a single job together with such jobs, cores of them at a time,
+        after bundle_setup and before bundle_teardown. The job is
+        submitted with the SLURM nice value nice, or, in an array or
+        bundle, the lowest nice value of the jobs in it. job_started, if
+        given, is called once the scheduler starts the job (or its bundle
+        job), and job_finished with its JobInfo once it has finished,
+        whether or not it succeeded.
+        '''
+        if bundle:
+            future, job_script_path, stdout_path, stderr_path, \
+                scheduler_stderr = self.bundles.add(
+                    (job_name, job_other_options, job_script_directory, cores,
+                     bundle_setup, bundle_teardown),
+                    (cmd_str, nice), bundle_window, bundle_size)
+        elif array:
+            future, job_script_path, stdout_path, stderr_path, \
+                scheduler_stderr = self.arrays.add(
+                    (job_name, job_other_options, job_script_directory),
+                    (cmd_str, nice), array_window, array_size)
+        else:
+            future, job_script_path, stdout_path, stderr_path = self.submit(
+                cmd_str, job_name, with_nice(job_other_options, nice),
+                job_script_directory)
+            scheduler_stderr = stderr_path
+        if logger:
+            logger.debug('job has been submitted with jobid {}'.format(future.job_id))
+        if job_started is not None:
+            future.when_started(job_started)
+        job_info = future.result()
+        if job_finished is not None:
+            job_finished(job_info)
+        stdout, stderr = read_stdout_stderr_from_files(
+            stdout_path, stderr_path, logger, cmd_str)
+        # Keep the job script, with the job id as its extension
+        os.rename(job_script_path, '{}.{}'.format(job_script_path, future.job_id))
+        failure = job_failure(job_info)
+        if bundle:
+            exit_path = job_script_path + '.exit'
+            if os.path.exists(exit_path):
+                # The command finished, so whatever the scheduler said
+                # about the bundle job is not about this command
+                scheduler_stderr = None
+            failure = bundled_failure(exit_path, failure)
+        if failure:
+            raise JobFailed('{}\nThe original command was: >> {} <<\n'
+                            'The jobid was: {}\nThe stderr was:\n{}'.format(
+                                failure, cmd_str, future.job_id, ''.join(stderr)),
+                            job_info, stdout, stderr, scheduler_stderr)
+        return stdout, stderr
+
+    def shutdown(self):
+        '''Stop the poller once all submitted jobs have finished'''
+        with self.lock:
+            self.stopping = True
+            self.jobs_pending.notify()
+        self.poller.join()
+
+    def _poll(self):
+        import drmaa
+        while True:
+            with self.lock:
+                while not self.jobs and not self.stopping:
+                    self.jobs_pending.wait()
+                if not self.jobs and self.stopping:
+                    return
+            self._check_started(drmaa)
+            try:
+                job_info = self.session.wait(drmaa.Session.JOB_IDS_SESSION_ANY,
+                                             self.poll_interval)
+            except drmaa.errors.ExitTimeoutException:
+                continue
+            except drmaa.errors.InvalidJobException:
+                # No jobs left in the session, although some were registered:
+                # they were reaped elsewhere, so their outcome is unknown
+                # (see job_failure)
+                with self.lock:
+                    for future in self.jobs.values():
+                        future.set_result(None)
+                    self.jobs.clear()
+                continue
+            except Exception as err:
+                # Any other error would end this thread and leave every
+                # worker waiting on its future, so fail the pending jobs
+                # and carry on with those submitted later
+                with self.lock:
+                    for future in self.jobs.values():
+                        future.set_error(error_drmaa_job(
+                            'Lost track of job {}: {}'.format(future.job_id, err)))
+                    self.jobs.clear()
+                continue
+            with self.lock:
+                future = self.jobs.pop(job_info.jobId, None)
+            if future is not None:
+                future.set_result(job_info)
+
+    def _check_started(self, drmaa):
+        '''Tell the callers waiting for jobs to start about those the
+        scheduler has started, at most once every poll_interval'''
+        now = time.time()
+        if now - self.status_checked < self.poll_interval:
+            return
+        self.status_checked = now
+        with self.lock:
+            queued = [future for future in self.jobs.values()
+                      if future.start_callbacks and not future.started]
+        for future in queued:
+            try:
+                status = self.session.jobStatus(future.job_id)
+            except Exception:
+                # Finished in the meantime; the wait collects it
+                continue
+            if status == drmaa.JobState.RUNNING:
+                future.set_started()
+
+
+def with_nice(job_other_options, nice):
+    '''Job options with the SLURM nice value of the job, if it has one'''
+    if nice:
+        return '{} --nice={}'.format(job_other_options, nice)
+    return job_other_options
+
+
+def batch_jobs(jobs):
+    '''The commands of a batch of (command, nice value) jobs, and the nice
+    value of the batch: that of its most urgent job'''
+    cmd_strs = [cmd_str for cmd_str, _nice in jobs]
+    return cmd_strs, min(nice for _cmd_str, nice in jobs)
+
+
+def bundle_script(setup=None, teardown=None):
+    '''The driver script of a bundle. The bundled scripts run even if setup
+    fails, and teardown runs however the bundle job ends.
+    '''
+    shebang, body = BUNDLE_SCRIPT.split('\n', 1)
+    lines = [shebang]
+    if teardown:
+        lines.append('trap {} EXIT'.format(quote(teardown)))
+    if setup:
+        lines.append('(\n{}\n) || echo "Bundle setup failed" >&2'.format(setup))
+    return '\n'.join(lines + [body])
+
+
+def write_batch_scripts(cmd_strs, prefix, job_other_options,
+                        job_script_directory, driver):
+    '''Write the job script of each of a batch of commands, an index file
+    listing them and the driver script that runs them. Returns the paths of
+    the script, stdout and stderr of each command, of the index file and of
+    the driver script.
+    '''
+    scripts = [write_job_script_to_temp_file(
+                   cmd_str, job_script_directory, prefix.rstrip('_'),
+                   job_other_options, None, None)
+               for cmd_str in cmd_strs]
+    handle, index_path = tempfile.mkstemp(prefix=prefix, suffix='.index',
+                                          dir=job_script_directory)
+    with os.fdopen(handle, 'w') as index_file:
+        index_file.writelines(script + '\n' for script, _, _ in scripts)
+    driver_path = index_path[:-len('.index')] + '.sh'
+    with open(driver_path, 'w') as driver_file:
+        driver_file.write(driver)
+    return scripts, index_path, driver_path
+
+
+def bundled_failure(exit_path, bundle_failure):
+    '''Describe why a bundled command failed, from the exit status it left
+    in exit_path, or return None if it succeeded. bundle_failure describes
+    the failure of the bundle job, if it failed.
+    '''
+    try:
+        with open(exit_path) as exit_file:
+            status = int(exit_file.read().strip())
+    except (IOError, ValueError):
+        # The bundle job ended before the command did
+        return 'The bundled command did not finish.\n{}'.format(
+            bundle_failure or 'The bundle job ended early')
+    os.remove(exit_path)
+    if status:
+        return 'The bundled command exited with status {}'.format(status)
+    return None
+
+
+def job_failure(job_info):
+    '''Describe why a job failed, or return None if it succeeded. A job
+    whose outcome is unknown (no job_info) is taken to have failed.'''
+    if job_info is None:
+        return 'The outcome of the drmaa command is unknown'
+    if job_info.wasAborted:
+        return 'The drmaa command was never ran but used {}'.format(job_info.exitStatus)
+    if job_info.hasSignal:
+        return 'The drmaa command was terminated by signal {}'.format(job_info.terminatedSignal)
+    if job_info.hasExited and job_info.exitStatus:
+        return 'The drmaa command exited with status {}'.format(job_info.exitStatus)
+    return None
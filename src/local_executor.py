@@ -0,0 +1,85 @@
+'''
+Core and memory aware execution of stages that run on the local machine.
+
+With "local: True" ruffus starts up to --jobs commands at once regardless of
+how many cores or how much memory each of them uses, so a few multithreaded
+stages side by side can oversubscribe the machine. Instead, every local job
+reserves its stage's cores and mem from a ResourcePool for as long as it
+runs, and only starts when that reservation fits in what is left. Jobs start
+in the order they asked (within their priority, see priority.py), so a
+large job is never starved by a stream of small ones. A job asking for more
+than the whole machine is given the whole machine.
+
+The pool is shared between ruffus worker threads, so the pipeline must be
+run multithreaded (--use_threads), as it must be for DRMAA anyway.
+'''
+
+from contextlib import contextmanager
+import multiprocessing
+import os
+import threading
+
+
+def physical_memory_gb():
+    '''Total physical memory of the machine in GB'''
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') / float(1024 ** 3)
+    except (ValueError, OSError, AttributeError):
+        return None
+
+
+class ResourcePool(object):
+    '''Cores and memory (in GB) shared by concurrently running local jobs'''
+    def __init__(self, cores, mem):
+        self.cores = cores
+        self.mem = mem
+        self.free_cores = cores
+        self.free_mem = mem
+        self.waiting = []
+        self.condition = threading.Condition()
+
+    @classmethod
+    def from_config(cls, config):
+        '''Size the pool from the local_cores and local_mem options,
+        defaulting to all the cores and memory of the machine.
+        '''
+        cores = config.get_optional_option('local_cores') or multiprocessing.cpu_count()
+        mem = config.get_optional_option('local_mem') or physical_memory_gb() \
+            or float('inf')
+        return cls(cores, mem)
+
+    @contextmanager
+    def reserve(self, cores, mem, priority=0):
+        '''Block until cores and mem are free, and hold them while the
+        body of the with statement runs. Jobs with a lower priority value
+        go ahead of those waiting with a higher one.
+        '''
+        cores = min(cores, self.cores)
+        mem = min(mem, self.mem)
+        ticket = object()
+        with self.condition:
+            position = len(self.waiting)
+            while position > 0 and self.waiting[position - 1][0] > priority:
+                position -= 1
+            self.waiting.insert(position, (priority, ticket))
+            while self.waiting[0][1] is not ticket or \
+                    cores > self.free_cores or mem > self.free_mem:
+                self.condition.wait()
+            self.waiting.pop(0)
+            self.free_cores -= cores
+            self.free_mem -= mem
+            # The next job in line may fit in what is left
+            self.condition.notify_all()
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.free_cores += cores
+                self.free_mem += mem
+                self.condition.notify_all()
+
+
+@contextmanager
+def unreserved():
+    '''Stands in for ResourcePool.reserve for jobs that do not run locally'''
+    yield
@@ -1,9 +1,26 @@
 '''
 Initialisation and use of concurrency-friendly logging facility.
+
+The log file is written through a ruffus logging proxy, and every call on
+the proxy is a round trip to the process that owns the file. Rather than
+have each worker thread wait on that, under a lock shared by all of them,
+records are put on a queue and a single background thread writes them to
+the proxy, taking whatever has queued up since its last write as one batch.
 '''
 
+import logging
+import threading
+import time
+from Queue import Queue, Empty
+
 import ruffus.cmdline as cmdline
 
+# Most records written to the proxy in one batch
+MAX_BATCH = 1000
+# Records queued longer than this many seconds before being written have
+# the time they were logged added to them
+LATE_RECORD_SECONDS = 1
+
 
 class Logger(object):
     '''Concurrency friendly logging facility'''
@@ -11,9 +28,56 @@ class Logger(object):
         proxy, mutex = cmdline.setup_logging(__name__, log_file, verbosity)
         self.proxy = proxy
         self.mutex = mutex
+        # (time, level, message) records waiting to be written, and None
+        # once the logger is closed
+        self.records = Queue()
+        self.writer = threading.Thread(target=self._write)
+        self.writer.daemon = True
+        self.writer.start()
 
+    def log(self, level, message):
+        '''Queue a message of the given logging level for the log file'''
+        self.records.put((time.time(), level, message))
+
+    def debug(self, message):
+        self.log(logging.DEBUG, message)
 
     def info(self, message):
         '''Display an informational message to the log file'''
-        with self.mutex:
-            self.proxy.info(message)
+        self.log(logging.INFO, message)
+
+    def warning(self, message):
+        self.log(logging.WARNING, message)
+
+    # ruffus' run_job warns with warn
+    warn = warning
+
+    def error(self, message):
+        self.log(logging.ERROR, message)
+
+    def close(self):
+        '''Write the records still queued and stop the writer thread'''
+        self.records.put(None)
+        self.writer.join()
+
+    def _write(self):
+        while True:
+            batch = [self.records.get()]
+            while batch[-1] is not None and len(batch) < MAX_BATCH:
+                try:
+                    batch.append(self.records.get_nowait())
+                except Empty:
+                    break
+            closed = batch[-1] is None
+            if closed:
+                batch.pop()
+            now = time.time()
+            with self.mutex:
+                for logged, level, message in batch:
+                    if now - logged > LATE_RECORD_SECONDS:
+                        message = '[logged {}] {}'.format(
+                            time.strftime('%Y-%m-%d %H:%M:%S',
+                                          time.localtime(logged)), message)
+                    self.proxy.log(level, message)
+            if closed:
+                return
@@ -13,13 +13,21 @@ Repository: https://github.com/khalidm/hiplexpipe_somatic
 from __future__ import print_function
 from ruffus import *
 import ruffus.cmdline as cmdline
-from version import version
 from name import program_name
+import argparse
 import sys
 from config import Config
 from state import State
 from logger import Logger
 from pipeline import make_pipeline
+from telemetry import DEFAULT_TELEMETRY_DB, report_main
+from local_executor import ResourcePool
+from job_monitor import JobMonitor, DEFAULT_POLL_INTERVAL
+from planner import make_plan, print_plan, PlanError
+from file_index import FileIndex, install_in_ruffus
+from priority import Prioritizer
+from metrics import Metrics
+from job_logs import DEFAULT_JOB_LOG_DIR
 import error_codes
 
 # default place to save cluster job scripts
@@ -29,6 +37,19 @@ DEFAULT_JOBSCRIPT_DIR = 'jobscripts'
 DEFAULT_CONFIG_FILE = 'pipeline.config'
 
 
+class VersionAction(argparse.Action):
+    '''Print the version of the pipeline and exit. The version is only
+    looked up when asked for, as loading pkg_resources takes longer than
+    planning a run.'''
+    def __init__(self, option_strings, dest=argparse.SUPPRESS,
+                 default=argparse.SUPPRESS, help=None):
+        super(VersionAction, self).__init__(option_strings=option_strings,
+            dest=dest, default=default, nargs=0, help=help)
+
+    def __call__(self, parser, namespace, values, option_string=None):
+        from version import version
+        parser.exit(message='{} {}\n'.format(parser.prog, version))
+
 def parse_command_line():
     '''Parse the command line arguments of the pipeline'''
     parser = cmdline.get_argparse(description='A variant discovery pipeline',
@@ -40,40 +61,122 @@ def parse_command_line():
         default=DEFAULT_JOBSCRIPT_DIR,
         help='Directory to store cluster job scripts created by the ' \
              'pipeline, defaults to {}'.format(DEFAULT_JOBSCRIPT_DIR))
-    parser.add_argument('--version', action='version',
-        version='%(prog)s ' + version)
+    parser.add_argument('--job_logs', type=str,
+        default=DEFAULT_JOB_LOG_DIR,
+        help='Directory to append the stdout and stderr of each job to, '
+             'one file of each per stage and sample, defaults to '
+             '{}'.format(DEFAULT_JOB_LOG_DIR))
+    parser.add_argument('--telemetry', type=str, default=None,
+        help='SQLite database to record the resource usage of each job in, '
+             'such as {}, which adaptive stages and critical path priorities '
+             'learn from. Off by default'.format(DEFAULT_TELEMETRY_DB))
+    parser.add_argument('--plan', action='store_true',
+        help='Print the jobs each stage would run and the resources they '
+             'request, without running anything or connecting to DRMAA')
+    parser.add_argument('--version', action=VersionAction,
+        help="show program's version number and exit")
     return parser.parse_args()
 
 def main():
     '''Initialise the pipeline, then run it'''
+    # Subcommands that report on earlier runs rather than run the pipeline
+    if len(sys.argv) > 1 and sys.argv[1] == 'telemetry':
+        report_main(sys.argv[2:])
+        return
     # Parse command line arguments
     options = parse_command_line()
     # Initialise the logger
     logger = Logger(__name__, options.log_file, options.verbose)
     # Log the command line used to run the pipeline
     logger.info(' '.join(sys.argv))
+    # Planning, printing or drawing the pipeline runs no jobs, so it does
+    # not need DRMAA, which may not be available on a login node
+    planning = options.plan or options.just_print or options.flowchart
     drmaa_session = None
-    try:
-        # Set up the DRMAA session for running cluster jobs
-        import drmaa
-        drmaa_session = drmaa.Session()
-        drmaa_session.initialize()
-    except Exception as e:
-        print("{progname} error using DRMAA library".format(progname=program_name), file=sys.stdout)
-        print("Error message: {msg}".format(msg=e.message, file=sys.stdout))
-        exit(error_codes.DRMAA_ERROR)
+    if not planning:
+        try:
+            # Set up the DRMAA session for running cluster jobs
+            import drmaa
+            drmaa_session = drmaa.Session()
+            drmaa_session.initialize()
+        except Exception as e:
+            print("{progname} error using DRMAA library".format(progname=program_name), file=sys.stdout)
+            print("Error message: {msg}".format(msg=e.message, file=sys.stdout))
+            exit(error_codes.DRMAA_ERROR)
     # Parse the configuration file, and initialise global state
     config = Config(options.config)
     config.validate()
-    state = State(options=options, config=config, logger=logger,
-                  drmaa_session=drmaa_session)
-    # Build the pipeline workflow
-    pipeline = make_pipeline(state)
-    # Run (or print) the pipeline
-    cmdline.run(options)
+    if options.plan:
+        state = State(options=options, config=config, logger=logger,
+                      drmaa_session=None)
+        try:
+            print_plan(make_plan(make_pipeline(state), config))
+        except PlanError as err:
+            logger.error(str(err))
+            print("{progname} cannot plan the run: {msg}; --just_print lists "
+                  "its jobs instead".format(progname=program_name, msg=err),
+                  file=sys.stderr)
+            exit(error_codes.PLAN_ERROR)
+        finally:
+            logger.close()
+        return
+    # Cores and memory shared by the stages that run on this machine
+    local_pool = ResourcePool.from_config(config)
+    # Track all cluster jobs from a single thread
+    job_monitor = None
     if drmaa_session is not None:
-        # Shut down the DRMAA session
-        drmaa_session.exit()
+        job_monitor = JobMonitor(drmaa_session,
+            config.get_optional_option('drmaa_poll_interval', DEFAULT_POLL_INTERVAL))
+    # Answer the up-to-date checks of ruffus from the file index
+    file_index = None
+    file_index_path = config.get_optional_option('file_index')
+    if file_index_path:
+        file_index = FileIndex(file_index_path)
+        install_in_ruffus(file_index)
+    # Give jobs on the longest remaining path of the pipeline priority
+    prioritizer = None
+    if config.get_optional_option('critical_path_priority', False):
+        prioritizer = Prioritizer(config, options.telemetry)
+    # Live counts of the jobs of each stage, for monitoring long runs
+    metrics = None
+    metrics_file = config.get_optional_option('metrics_file')
+    metrics_port = config.get_optional_option('metrics_port')
+    if metrics_file or metrics_port:
+        metrics = Metrics(config.get_option('pipeline_id'))
+    state = State(options=options, config=config, logger=logger,
+                  drmaa_session=drmaa_session, local_pool=local_pool,
+                  job_monitor=job_monitor, file_index=file_index,
+                  prioritizer=prioritizer, metrics=metrics)
+    try:
+        # Build the pipeline workflow
+        pipeline = make_pipeline(state)
+        # Without a plan, every job gets the same priority and no stage
+        # expects any jobs, but the run itself is unaffected
+        try:
+            if prioritizer is not None:
+                prioritizer.plan(pipeline)
+            if metrics is not None:
+                metrics.plan(pipeline, config)
+        except PlanError as err:
+            logger.warning('Not planning the run: {}'.format(err))
+        if metrics is not None:
+            metrics.start(metrics_file, metrics_port)
+        # Run (or print) the pipeline
+        cmdline.run(options)
+    finally:
+        # Tear down whether or not the pipeline failed, which is when the
+        # final metrics and the log matter most
+        if metrics is not None:
+            metrics.stop()
+        if job_monitor is not None:
+            job_monitor.shutdown()
+        if file_index is not None:
+            file_index.close()
+        if drmaa_session is not None:
+            # Shut down the DRMAA session
+            drmaa_session.exit()
+        # Write the log records still queued
+        logger.close()
 
 
 if __name__ == '__main__':
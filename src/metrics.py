@@ -0,0 +1,296 @@
+'''
+Live progress and throughput metrics of a pipeline run.
+
+With metrics_file or metrics_port set, run_stage keeps counts of the jobs of
+each stage that are queued (waiting for the cores and memory of the local
+machine, or in the scheduler's queue), running (started locally, or reported
+RUNNING by the scheduler, see job_monitor.py), done and failed, and the mean
+runtime of the jobs done. Runtimes of cluster jobs are from when the job
+monitor saw them running, so to within drmaa_poll_interval; jobs that
+finished before it saw them running, and jobs whose outputs were restored
+from the result cache, count as done without a runtime.
+
+The counts are published in the Prometheus text format, every
+METRICS_INTERVAL seconds to metrics_file (which the node exporter's textfile
+collector can pick up), and on request at http://localhost:{metrics_port}/.
+Along with them go the number of jobs each stage is expected to run in
+total, from the plan of the run (see planner.py) leaving out the tasks that
+work in the pipeline process rather than through run_stage, an ETA of each
+stage from its jobs still to run, its mean runtime and how many of its jobs
+run at once, and the number of samples per hour that finished the last
+per-sample stage of the longest branch of the pipeline.
+'''
+
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from collections import defaultdict
+from contextlib import contextmanager
+import os
+import threading
+import time
+
+from planner import make_plan, task_action, topological_order
+from telemetry import sample_name
+
+# Seconds between writes of the metrics file
+METRICS_INTERVAL = 15
+CONTENT_TYPE = 'text/plain; version=0.0.4'
+
+
+class StageCounts(object):
+    '''Jobs of a stage in each state, and their total runtime'''
+    def __init__(self):
+        self.expected = 0
+        self.queued = 0
+        self.running = 0
+        self.done = 0
+        self.restored = 0
+        self.failed = 0
+        # Jobs done with a known runtime, and their total runtime
+        self.timed = 0
+        self.runtime = 0.0
+
+    def mean_runtime(self):
+        return self.runtime / self.timed if self.timed else None
+
+    def eta(self):
+        '''Seconds until the expected jobs of the stage are done, or None
+        before any of them is'''
+        mean = self.mean_runtime()
+        if mean is None:
+            return None
+        left = max(0, self.expected - self.done)
+        return left * mean / max(1, self.running)
+
+
+def in_process(task):
+    '''Whether a task works in the pipeline process rather than through
+    run_stage (see stages.in_process)'''
+    return getattr(task.user_defined_work_func, 'in_process', False)
+
+
+def ends_sample(task):
+    '''Whether the outputs of a task only go on to merges over the cohort,
+    directly or through tasks that work in process'''
+    for child in task._outward:
+        if task_action(child) == 'task_merge':
+            continue
+        if in_process(child) and ends_sample(child):
+            continue
+        return False
+    return True
+
+
+def label(value):
+    '''A value quoted as a Prometheus label'''
+    return '"{}"'.format(str(value).replace('\\', '\\\\').replace('"', '\\"')
+                         .replace('\n', '\\n'))
+
+
+class Metrics(object):
+    '''Counts of the jobs of each stage of a pipeline run'''
+    def __init__(self, pipeline_id):
+        self.pipeline_id = pipeline_id
+        self.started = time.time()
+        self.stages = defaultdict(StageCounts)
+        self.final_stages = set()
+        self.finished_samples = set()
+        self.lock = threading.Lock()
+        self.stopping = threading.Event()
+        self.metrics_file = None
+        self.writer = None
+        self.server = None
+
+    def plan(self, pipeline, config):
+        '''Expect the jobs planned for pipeline, and take the stages of the
+        last per-sample tasks of its longest branch that run through
+        run_stage as the final stages'''
+        plans = make_plan(pipeline, config)
+        tasks = dict((task._name, task) for task in pipeline.tasks)
+        stages = config.get_optional_option('stages') or {}
+        # Tasks on the way to each task, counting itself
+        depths = {}
+        for task in topological_order(pipeline):
+            depths[task] = 1 + max([depths[parent] for parent in task._inward]
+                                   or [0])
+        ends = {}
+        with self.lock:
+            for plan in plans:
+                task = tasks.get(plan.task)
+                # Tasks that work in process, such as the merge of the VEP
+                # chunks, never reach run_stage
+                if plan.stage not in stages or task is None or \
+                        in_process(task):
+                    continue
+                self.stages[plan.stage].expected += max(0, plan.jobs - plan.done)
+                # Per-sample tasks at the end of a branch of the pipeline;
+                # merges such as summarize_coverage cover the whole cohort
+                if task_action(task) != 'task_merge' and ends_sample(task):
+                    ends[plan.stage] = max(ends.get(plan.stage, 0),
+                                           depths[task])
+            # The variant calling branch, rather than the coverage one
+            deepest = max(ends.values() or [0])
+            self.final_stages.update(stage for stage, depth in ends.items()
+                                     if depth == deepest)
+
+    @contextmanager
+    def job(self, stage, paths):
+        '''Count a job of the stage working on paths as queued for the body
+        of the with statement, which calls the function it is given when
+        the job starts. The job is done if the body completes, and failed
+        if it raises.'''
+        started = []
+        with self.lock:
+            counts = self.stages[stage]
+            counts.queued += 1
+
+        def start():
+            with self.lock:
+                counts.queued -= 1
+                counts.running += 1
+                started.append(time.time())
+        try:
+            yield start
+        except Exception:
+            with self.lock:
+                if started:
+                    counts.running -= 1
+                else:
+                    counts.queued -= 1
+                counts.failed += 1
+            raise
+        with self.lock:
+            if started:
+                counts.running -= 1
+                counts.timed += 1
+                counts.runtime += time.time() - started[0]
+            else:
+                counts.queued -= 1
+            self._done(stage, paths)
+
+    def restored(self, stage, paths):
+        '''Count a job of the stage working on paths, whose outputs were
+        restored from the result cache, as done'''
+        with self.lock:
+            self.stages[stage].restored += 1
+            self._done(stage, paths)
+
+    def _done(self, stage, paths):
+        '''Count a job of the stage as done, with the lock held'''
+        self.stages[stage].done += 1
+        if stage in self.final_stages:
+            sample = sample_name(paths)
+            if sample is not None:
+                self.finished_samples.add(sample)
+
+    def render(self):
+        '''The metrics in the Prometheus text format'''
+        lines = []
+
+        def metric(name, kind, help_text, rows):
+            lines.append('# HELP {} {}'.format(name, help_text))
+            lines.append('# TYPE {} {}'.format(name, kind))
+            for labels, value in rows:
+                if value is not None:
+                    lines.append('{}{{{}}} {}'.format(
+                        name, ','.join('{}={}'.format(key, label(item))
+                                       for key, item in labels), value))
+        with self.lock:
+            stages = sorted((stage, counts) for stage, counts in self.stages.items())
+            per_stage = lambda value: [
+                ([('pipeline', self.pipeline_id), ('stage', stage)], value(counts))
+                for stage, counts in stages]
+            metric('pipeline_jobs_expected', 'gauge',
+                   'Jobs of the stage planned for this run',
+                   per_stage(lambda counts: counts.expected))
+            metric('pipeline_jobs_queued', 'gauge',
+                   'Jobs of the stage waiting for local cores and memory',
+                   per_stage(lambda counts: counts.queued))
+            metric('pipeline_jobs_running', 'gauge',
+                   'Jobs of the stage running, or submitted to the cluster',
+                   per_stage(lambda counts: counts.running))
+            metric('pipeline_jobs_done_total', 'counter',
+                   'Jobs of the stage done', per_stage(lambda counts: counts.done))
+            metric('pipeline_jobs_restored_total', 'counter',
+                   'Jobs of the stage done by restoring their outputs from '
+                   'the result cache', per_stage(lambda counts: counts.restored))
+            metric('pipeline_jobs_failed_total', 'counter',
+                   'Job attempts of the stage failed',
+                   per_stage(lambda counts: counts.failed))
+            metric('pipeline_job_runtime_seconds_mean', 'gauge',
+                   'Mean runtime of the jobs of the stage done',
+                   per_stage(lambda counts: counts.mean_runtime()))
+            metric('pipeline_stage_eta_seconds', 'gauge',
+                   'Estimated seconds until the jobs of the stage are done',
+                   per_stage(lambda counts: counts.eta()))
+            etas = [counts.eta() for _stage, counts in stages
+                    if counts.done < counts.expected]
+            elapsed = time.time() - self.started
+            samples = len(self.finished_samples)
+            metric('pipeline_eta_seconds', 'gauge',
+                   'Estimated seconds until the slowest stage is done',
+                   [([('pipeline', self.pipeline_id)],
+                     None if None in etas else max(etas or [0]))])
+            metric('pipeline_samples_finished_total', 'counter',
+                   'Samples through the final stages of the pipeline',
+                   [([('pipeline', self.pipeline_id)], samples)])
+            metric('pipeline_samples_per_hour', 'gauge',
+                   'Samples through the final stages per hour of the run',
+                   [([('pipeline', self.pipeline_id)],
+                     samples * 3600.0 / elapsed if elapsed > 0 else None)])
+            metric('pipeline_uptime_seconds', 'gauge',
+                   'Seconds since the pipeline started',
+                   [([('pipeline', self.pipeline_id)], elapsed)])
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path):
+        '''Write the metrics to path, replacing it in one step so that
+        readers never see a partial file'''
+        temporary = '{}.{}.tmp'.format(path, os.getpid())
+        with open(temporary, 'w') as metrics_file:
+            metrics_file.write(self.render())
+        os.rename(temporary, path)
+
+    def start(self, metrics_file=None, port=None):
+        '''Publish the metrics to metrics_file, every METRICS_INTERVAL
+        seconds, and over HTTP on port of localhost'''
+        if metrics_file:
+            self.metrics_file = metrics_file
+
+            def write_periodically():
+                while not self.stopping.wait(METRICS_INTERVAL):
+                    self.write(metrics_file)
+            self.writer = threading.Thread(target=write_periodically)
+            self.writer.daemon = True
+            self.writer.start()
+        if port:
+            self.server = HTTPServer(('localhost', port), metrics_handler(self))
+            serve = threading.Thread(target=self.server.serve_forever)
+            serve.daemon = True
+            serve.start()
+
+    def stop(self):
+        '''Stop publishing, leaving the final metrics in metrics_file'''
+        self.stopping.set()
+        if self.writer is not None:
+            self.writer.join()
+            self.write(self.metrics_file)
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+
+
+def metrics_handler(metrics):
+    '''An HTTP request handler class serving metrics'''
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = metrics.render()
+            self.send_response(200)
+            self.send_header('Content-Type', CONTENT_TYPE)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            # Requests are not worth a line in the pipeline's output
+            pass
+    return MetricsHandler
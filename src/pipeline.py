@@ -4,6 +4,52 @@ Build the pipeline workflow by plumbing the stages together.
 
 from ruffus import Pipeline, suffix, formatter, add_inputs, output_from
 from stages import Stages
+from intervals import shard_bed_paths
+from collections import defaultdict
+import os
+import re
+
+# Match the R1 (read 1) FASTQ file and grab the path and sample name.
+# Hi-Plex example: OHI031002-P02F04_S318_L001_R1_001.fastq
+# new sample name = OHI031002-P02F04
+FASTQ_R1_PATTERN = '.+/(?P<sample>[a-zA-Z0-9-]+)-(?P<tumor>[TN]+)_(?P<readid>[a-zA-Z0-9-]+)_(?P<lane>[a-zA-Z0-9]+)_R1_(?P<lib>[a-zA-Z0-9-:]+).fastq'
+# The corresponding R2 (read 2) FASTQ file
+# Hi-Plex example: OHI031002-P02F04_S318_L001_R2_001.fastq
+FASTQ_R2_PATTERN = '{path[0]}/{sample[0]}-{tumor[0]}_{readid[0]}_{lane[0]}_R2_{lib[0]}.fastq'
+# Sample, tumour/normal, read id, lane and library passed to the alignment stages
+FASTQ_EXTRAS = ['{sample[0]}', '{tumor[0]}', '{readid[0]}', '{lane[0]}', '{lib[0]}']
+# Chunks of a pair of FASTQ files, keeping the fields of the FASTQ name
+# Example: alignments/OHI031002/chunks/OHI031002-T_S318_L001_001.chunk_0000.R1.fastq
+FASTQ_CHUNK_PREFIX = 'alignments/{sample[0]}/chunks/{sample[0]}-{tumor[0]}_{readid[0]}_{lane[0]}_{lib[0]}'
+FASTQ_CHUNK_R1_PATTERN = '.+/(?P<sample>[a-zA-Z0-9-]+)-(?P<tumor>[TN]+)_(?P<readid>[a-zA-Z0-9-]+)_(?P<lane>[a-zA-Z0-9]+)_(?P<lib>[a-zA-Z0-9-:]+).(?P<chunk>chunk_[0-9]+).R1.fastq'
+FASTQ_CHUNK_R2_PATTERN = '{path[0]}/{sample[0]}-{tumor[0]}_{readid[0]}_{lane[0]}_{lib[0]}.{chunk[0]}.R2.fastq'
+# Alignment of a sample, merged from all its lanes
+# Example: alignments/OHI031002/OHI031002_T.bam
+SAMPLE_BAM_PREFIX = 'alignments/{sample[0]}/{sample[0]}_{tumor[0]}'
+# Alignment of one lane of a sample, keeping the fields of the FASTQ name
+# Example: alignments/OHI031002/lanes/OHI031002-T_S318_L001_001.bam
+LANE_BAM_PREFIX = 'alignments/{sample[0]}/lanes/{sample[0]}-{tumor[0]}_{readid[0]}_{lane[0]}_{lib[0]}'
+# Match the alignment of a lane, or of a chunk of one, and grab the sample
+LANE_BAM_PATTERN = '.+/(?P<sample>[a-zA-Z0-9-]+)-(?P<tumor>[TN]+)_[^/]+.bam'
+LANE_PRIMARY_BAM_PATTERN = '.+/(?P<sample>[a-zA-Z0-9-]+)-(?P<tumor>[TN]+)_[^/]+.primary.bam'
+# Match a clipped tumour BAM and find the clipped normal BAM of the same sample
+TUMOR_BAM_PATTERN = '.+/(?P<sample>[a-zA-Z0-9-]+)_T.primary.primerclipped.bam'
+NORMAL_BAM_PATTERN = '{path[0]}/{sample[0]}_N.primary.primerclipped.bam'
+
+
+def fastqs_by_lanes(fastq_files):
+    '''The R1 FASTQ files of the samples sequenced on a single lane, and
+    those of the samples sequenced on several lanes'''
+    lanes = defaultdict(list)
+    for fastq in fastq_files:
+        match = re.match(FASTQ_R1_PATTERN, fastq)
+        if match:
+            lanes[match.group('sample', 'tumor')].append(fastq)
+    single_lane = sorted(fastqs[0] for fastqs in lanes.values()
+                         if len(fastqs) == 1)
+    multi_lane = sorted(fastq for fastqs in lanes.values() if len(fastqs) > 1
+                        for fastq in fastqs)
+    return single_lane, multi_lane
 
 
 def make_pipeline(state):
@@ -23,110 +69,327 @@ def make_pipeline(state):
         name='original_fastqs',
         output=fastq_files)
 
-    # Align paired end reads in FASTQ to the reference producing a BAM file
-    pipeline.transform(
-        task_func=stages.align_bwa,
-        name='align_bwa',
-        input=output_from('original_fastqs'),
-        # Match the R1 (read 1) FASTQ file and grab the path and sample name.
-        # This will be the first input to the stage.
-        # Hi-Plex example: OHI031002-P02F04_S318_L001_R1_001.fastq
-        # new sample name = OHI031002-P02F04
-        filter=formatter(
-            '.+/(?P<sample>[a-zA-Z0-9-]+)-(?P<tumor>[TN]+)_(?P<readid>[a-zA-Z0-9-]+)_(?P<lane>[a-zA-Z0-9]+)_R1_(?P<lib>[a-zA-Z0-9-:]+).fastq'),
-
-        # Add one more inputs to the stage:
-        #    1. The corresponding R2 FASTQ file
-        # Hi-Plex example: OHI031002-P02F04_S318_L001_R2_001.fastq
-        add_inputs=add_inputs(
-            '{path[0]}/{sample[0]}-{tumor[0]}_{readid[0]}_{lane[0]}_R2_{lib[0]}.fastq'),
-
-        # Add an "extra" argument to the state (beyond the inputs and outputs)
-        # which is the sample name. This is needed within the stage for finding out
-        # sample specific configuration options
-        extras=['{sample[0]}', '{tumor[0]}', '{readid[0]}', '{lane[0]}', '{lib[0]}'],
-        # The output file name is the sample name with a .bam extension.
-        output='alignments/{sample[0]}/{sample[0]}_{tumor[0]}.bam')
-
-    # Sort the BAM file using Picard
-    pipeline.transform(
-        task_func=stages.sort_bam_picard,
-        name='sort_bam_picard',
-        input=output_from('align_bwa'),
-        filter=suffix('.bam'),
-        output='.sort.bam')
-
-    # High quality and primary alignments
-    pipeline.transform(
-        task_func=stages.primary_bam,
-        name='primary_bam',
-        input=output_from('sort_bam_picard'),
-        filter=suffix('.sort.bam'),
-        output='.primary.bam')
-
-    # index bam file
-    pipeline.transform(
-        task_func=stages.index_sort_bam_picard,
-        name='index_bam',
-        input=output_from('primary_bam'),
-        filter=suffix('.primary.bam'),
-        output='.primary.bam.bai')
+    # Each pair of FASTQ files, one lane of a sample, is aligned into a
+    # sorted BAM file. The BAM files of all the lanes of a sample are
+    # merged into its alignment; a sample with a single lane is aligned
+    # straight into it, without a merge.
+    single_lane_fastqs, multi_lane_fastqs = fastqs_by_lanes(fastq_files)
+    if state.config.get_optional_option('fused_alignment', False):
+        # Align, sort, filter for primary alignments and index in one job,
+        # streaming between the tools instead of writing intermediate BAMs.
+        # The output has the same name as the primary_bam stage output, so
+        # up-to-date checks on existing results still hold.
+        primary_bam_tasks = []
+        if single_lane_fastqs:
+            (pipeline.transform(
+                task_func=stages.align_bwa_fused,
+                name='align_bwa_fused',
+                input=single_lane_fastqs,
+                filter=formatter(FASTQ_R1_PATTERN),
+                add_inputs=add_inputs(FASTQ_R2_PATTERN),
+                extras=FASTQ_EXTRAS,
+                output=SAMPLE_BAM_PREFIX + '.primary.bam')
+                .follows('original_fastqs'))
+            primary_bam_tasks.append('align_bwa_fused')
+        if multi_lane_fastqs:
+            (pipeline.transform(
+                task_func=stages.align_bwa_fused,
+                name='align_bwa_fused_lane',
+                input=multi_lane_fastqs,
+                filter=formatter(FASTQ_R1_PATTERN),
+                add_inputs=add_inputs(FASTQ_R2_PATTERN),
+                extras=FASTQ_EXTRAS,
+                output=LANE_BAM_PREFIX + '.primary.bam')
+                .follows('original_fastqs'))
+
+            pipeline.collate(
+                task_func=stages.merge_bwa_chunks,
+                name='merge_bwa_lanes',
+                input=output_from('align_bwa_fused_lane'),
+                filter=formatter(LANE_PRIMARY_BAM_PATTERN),
+                output=SAMPLE_BAM_PREFIX + '.primary.bam',
+                # Index the merged BAM, as index_bam would
+                extras=['align_bwa_fused', True])
+            primary_bam_tasks.append('merge_bwa_lanes')
+        index_bam_tasks = primary_bam_tasks
+    else:
+        aligned_tasks = []
+        if state.config.get_optional_stage_option('align_bwa', 'chunk_reads'):
+            # Split each pair of FASTQ files into chunks, and align the
+            # chunks as separate jobs
+            pipeline.subdivide(
+                task_func=stages.split_fastq_chunks,
+                name='split_fastq_chunks',
+                input=output_from('original_fastqs'),
+                filter=formatter(FASTQ_R1_PATTERN),
+                add_inputs=add_inputs(FASTQ_R2_PATTERN),
+                output=FASTQ_CHUNK_PREFIX + '.chunk_*.R[12].fastq',
+                extras=[FASTQ_CHUNK_PREFIX])
+
+            pipeline.transform(
+                task_func=stages.align_bwa,
+                name='align_bwa_chunk',
+                input=output_from('split_fastq_chunks'),
+                filter=formatter(FASTQ_CHUNK_R1_PATTERN),
+                add_inputs=add_inputs(FASTQ_CHUNK_R2_PATTERN),
+                extras=FASTQ_EXTRAS,
+                output='{path[0]}/{sample[0]}-{tumor[0]}_{readid[0]}_{lane[0]}_{lib[0]}.{chunk[0]}.bam')
+            lane_task = 'align_bwa_chunk'
+        else:
+            if single_lane_fastqs:
+                # Align paired end reads in FASTQ to the reference producing a BAM file
+                (pipeline.transform(
+                    task_func=stages.align_bwa,
+                    name='align_bwa',
+                    input=single_lane_fastqs,
+                    # Match the R1 (read 1) FASTQ file and grab the path and sample name.
+                    # This will be the first input to the stage.
+                    filter=formatter(FASTQ_R1_PATTERN),
+                    # Add one more inputs to the stage:
+                    #    1. The corresponding R2 FASTQ file
+                    add_inputs=add_inputs(FASTQ_R2_PATTERN),
+                    # Add an "extra" argument to the state (beyond the inputs and outputs)
+                    # which is the sample name. This is needed within the stage for finding out
+                    # sample specific configuration options
+                    extras=FASTQ_EXTRAS,
+                    # The output file name is the sample name with a .bam extension.
+                    output=SAMPLE_BAM_PREFIX + '.bam')
+                    .follows('original_fastqs'))
+                aligned_tasks.append('align_bwa')
+            lane_task = None
+            if multi_lane_fastqs:
+                # The output file is named after the lane, with a .bam extension.
+                (pipeline.transform(
+                    task_func=stages.align_bwa,
+                    name='align_bwa_lane',
+                    input=multi_lane_fastqs,
+                    filter=formatter(FASTQ_R1_PATTERN),
+                    add_inputs=add_inputs(FASTQ_R2_PATTERN),
+                    extras=FASTQ_EXTRAS,
+                    output=LANE_BAM_PREFIX + '.bam')
+                    .follows('original_fastqs'))
+                lane_task = 'align_bwa_lane'
+
+        if lane_task is not None:
+            # Merge the lanes (or chunks) of a sample into its alignment
+            pipeline.collate(
+                task_func=stages.merge_bwa_chunks,
+                name='merge_bwa_lanes',
+                input=output_from(lane_task),
+                filter=formatter(LANE_BAM_PATTERN),
+                output=SAMPLE_BAM_PREFIX + '.bam',
+                extras=['align_bwa'])
+            aligned_tasks.append('merge_bwa_lanes')
+
+        # High quality and primary alignments. align_bwa sorts its output,
+        # and merging keeps the order, so there is no sort here.
+        pipeline.transform(
+            task_func=stages.primary_bam,
+            name='primary_bam',
+            input=output_from(*aligned_tasks),
+            filter=suffix('.bam'),
+            output='.primary.bam')
+
+        # index bam file
+        pipeline.transform(
+            task_func=stages.index_sort_bam_picard,
+            name='index_bam',
+            input=output_from('primary_bam'),
+            filter=suffix('.primary.bam'),
+            output='.primary.bam.bai')
+        primary_bam_tasks = ['primary_bam']
+        index_bam_tasks = ['index_bam']
 
     # Clip the primer_seq from BAM File
     (pipeline.transform(
         task_func=stages.clip_bam,
         name='clip_bam',
-        input=output_from('primary_bam'),
+        input=output_from(*primary_bam_tasks),
         filter=suffix('.primary.bam'),
         output='.primary.primerclipped.bam')
-        .follows('index_bam'))
+        .follows(*index_bam_tasks))
+
+    ###### COVERAGE ######
+
+    if state.config.get_optional_option('coverage', False):
+        # Per-base and per-amplicon depth of each clipped BAM
+        pipeline.transform(
+            task_func=stages.coverage_bam,
+            name='coverage_bam',
+            input=output_from('clip_bam'),
+            filter=formatter('.+/(?P<bam>[^/]+).primary.primerclipped.bam'),
+            output='coverage/{bam[0]}.amplicons.npy')
+
+        # Cohort coverage matrix, summaries and plots
+        pipeline.merge(
+            task_func=stages.summarize_coverage,
+            name='summarize_coverage',
+            input=output_from('coverage_bam'),
+            output='coverage/cohort.amplicon_depth.npy')
 
     ###### GATK VARIANT CALLING - MuTect2 ######
 
-    # Call somatics variants using MuTect2
-    pipeline.transform(
-        task_func=stages.call_mutect2_gatk,
-        name='call_mutect2_gatk',
-        input=output_from('clip_bam'),
-        # filter=suffix('.merged.dedup.realn.bam'),
-        filter=formatter('.+/(?P<sample>[a-zA-Z0-9-]+)_T.primary.primerclipped.bam'),
-        add_inputs=add_inputs(
-            '{path[0]}/{sample[0]}_N.primary.primerclipped.bam'),
-        # extras=['{sample[0]}'],
-        output='variants/mutect2/{sample[0]}.mutect2.vcf')
-        # .follows('clip_bam')
+    mutect2_shards = state.config.get_optional_stage_option(
+        'call_mutect2_gatk', 'shards', 1)
+    if mutect2_shards > 1:
+        # Split the panel BED into balanced shards, call each tumour/normal
+        # pair on every shard as its own job, then merge the shards of each
+        # pair. The merge task takes the name of the unsharded stage so that
+        # downstream stages are connected in the same way in both modes.
+        shard_beds = shard_bed_paths('variants/mutect2/intervals', mutect2_shards)
+        pipeline.split(
+            task_func=stages.split_gatk_bed,
+            name='split_gatk_bed',
+            input=stages.gatk_bed,
+            output=shard_beds)
+
+        shard_tasks = []
+        for shard_bed in shard_beds:
+            shard = os.path.splitext(os.path.basename(shard_bed))[0]
+            shard_task = 'call_mutect2_gatk_' + shard
+            (pipeline.transform(
+                task_func=stages.call_mutect2_gatk_shard,
+                name=shard_task,
+                input=output_from('clip_bam'),
+                filter=formatter(TUMOR_BAM_PATTERN),
+                add_inputs=add_inputs(NORMAL_BAM_PATTERN, shard_bed),
+                output='variants/mutect2/shards/{sample[0]}.' + shard + '.mutect2.vcf')
+                .follows('split_gatk_bed'))
+            shard_tasks.append(shard_task)
+
+        pipeline.collate(
+            task_func=stages.merge_mutect2_gatk,
+            name='call_mutect2_gatk',
+            input=output_from(*shard_tasks),
+            filter=formatter('.+/(?P<sample>[a-zA-Z0-9-]+).shard_[0-9]+.mutect2.vcf'),
+            output='variants/mutect2/{sample[0]}.mutect2.vcf')
+    else:
+        # Call somatics variants using MuTect2
+        pipeline.transform(
+            task_func=stages.call_mutect2_gatk,
+            name='call_mutect2_gatk',
+            input=output_from('clip_bam'),
+            # filter=suffix('.merged.dedup.realn.bam'),
+            filter=formatter(TUMOR_BAM_PATTERN),
+            add_inputs=add_inputs(NORMAL_BAM_PATTERN),
+            # extras=['{sample[0]}'],
+            output='variants/mutect2/{sample[0]}.mutect2.vcf')
+            # .follows('clip_bam')
 
     ###### GATK VARIANT CALLING - MuTect2 ######
 
-    # -------- VEP ----------
-    # Apply NORM
-    (pipeline.transform(
-        task_func=stages.apply_vt,
-        name='apply_vt',
-        input=output_from('call_mutect2_gatk'),
-        filter=suffix('.mutect2.vcf'),
-        # add_inputs=add_inputs(['variants/ALL.indel_recal', 'variants/ALL.indel_tranches']),
-        output='.mutect2.vt.vcf')
-        .follows('call_mutect2_gatk'))
-    #
-    # Apply VEP
-    (pipeline.transform(
-        task_func=stages.apply_vep,
-        name='apply_vep',
-        input=output_from('apply_vt'),
-        filter=suffix('.mutect2.vt.vcf'),
-        # add_inputs=add_inputs(['variants/ALL.indel_recal', 'variants/ALL.indel_tranches']),
-        output='.mutect2.vt.vep.vcf')
-        .follows('apply_vt'))
-    #
-    # Apply vcfanno
-    (pipeline.transform(
-        task_func=stages.apply_vcfanno,
-        name='apply_vcfanno',
-        input=output_from('apply_vep'),
-        filter=suffix('.mutect2.vt.vep.vcf'),
-        # add_inputs=add_inputs(['variants/ALL.indel_recal', 'variants/ALL.indel_tranches']),
-        output='.mutect2.annotated.vcf')
-        .follows('apply_vep'))
+    if state.config.get_optional_option('fused_annotation', False):
+        # Normalise, annotate with VEP and vcfanno, compress and index in a
+        # single job per sample, streaming between the tools instead of
+        # writing the VCF of each stage. The annotation cache and VEP chunks
+        # only apply to the separate stages.
+        pipeline.transform(
+            task_func=stages.annotate_vcf_fused,
+            name='annotate_vcf_fused',
+            input=output_from('call_mutect2_gatk'),
+            filter=suffix('.mutect2.vcf'),
+            output='.mutect2.annotated.vcf.gz')
+        annotated_task = 'annotate_vcf_fused'
+    else:
+        # -------- VEP ----------
+        # Apply NORM
+        (pipeline.transform(
+            task_func=stages.apply_vt,
+            name='apply_vt',
+            input=output_from('call_mutect2_gatk'),
+            filter=suffix('.mutect2.vcf'),
+            # add_inputs=add_inputs(['variants/ALL.indel_recal', 'variants/ALL.indel_tranches']),
+            output='.mutect2.vt.vcf')
+            .follows('call_mutect2_gatk'))
+        #
+        # Look up previously seen alleles in the annotation cache
+        if state.config.get_optional_option('anno_cache'):
+            # Records with cached annotations are written next to the output
+            # (.mutect2.vt.cached.vcf); only the others go on to VEP and vcfanno,
+            # which are skipped when there are none.
+            pipeline.transform(
+                task_func=stages.lookup_anno_cache,
+                name='lookup_anno_cache',
+                input=output_from('apply_vt'),
+                filter=suffix('.mutect2.vt.vcf'),
+                output='.mutect2.vt.uncached.vcf')
+            vep_input_task = 'lookup_anno_cache'
+            vep_input_suffix = '.mutect2.vt.uncached.vcf'
+            vcfanno_output_suffix = '.mutect2.vt.uncached.annotated.vcf'
+        else:
+            vep_input_task = 'apply_vt'
+            vep_input_suffix = '.mutect2.vt.vcf'
+            vcfanno_output_suffix = '.mutect2.annotated.vcf'
+        annotated_task = 'apply_vcfanno'
+        vep_output_suffix = vep_input_suffix[:-len('.vcf')] + '.vep.vcf'
+        #
+        # Apply VEP
+        if state.config.get_optional_stage_option('apply_vep', 'chunk_size'):
+            # Split each normalised VCF into chunks, annotate the chunks as
+            # separate jobs and merge them back in coordinate order. The merge
+            # task takes the name of the unchunked stage so that downstream
+            # stages are connected in the same way in both modes.
+            pipeline.subdivide(
+                task_func=stages.split_vep_chunks,
+                name='split_vep_chunks',
+                input=output_from(vep_input_task),
+                filter=formatter('.+/(?P<sample>[a-zA-Z0-9-]+)' + re.escape(vep_input_suffix)),
+                output='variants/mutect2/vep_chunks/{sample[0]}.chunk_*.vt.vcf',
+                extras=['variants/mutect2/vep_chunks/{sample[0]}'])
+
+            pipeline.transform(
+                task_func=stages.apply_vep,
+                name='apply_vep_chunk',
+                input=output_from('split_vep_chunks'),
+                filter=suffix('.vt.vcf'),
+                output='.vt.vep.vcf')
+
+            pipeline.collate(
+                task_func=stages.merge_vep_chunks,
+                name='apply_vep',
+                input=output_from('apply_vep_chunk'),
+                filter=formatter('.+/(?P<sample>[a-zA-Z0-9-]+).chunk_[0-9]+.vt.vep.vcf'),
+                output='variants/mutect2/{sample[0]}' + vep_output_suffix)
+        else:
+            (pipeline.transform(
+                task_func=stages.apply_vep,
+                name='apply_vep',
+                input=output_from(vep_input_task),
+                filter=suffix(vep_input_suffix),
+                # add_inputs=add_inputs(['variants/ALL.indel_recal', 'variants/ALL.indel_tranches']),
+                output=vep_output_suffix)
+                .follows(vep_input_task))
+        #
+        # Apply vcfanno
+        (pipeline.transform(
+            task_func=stages.apply_vcfanno,
+            name='apply_vcfanno',
+            input=output_from('apply_vep'),
+            filter=suffix(vep_output_suffix),
+            # add_inputs=add_inputs(['variants/ALL.indel_recal', 'variants/ALL.indel_tranches']),
+            output=vcfanno_output_suffix)
+            .follows('apply_vep'))
+
+        if state.config.get_optional_option('anno_cache'):
+            # Merge the freshly annotated records with the cached ones into the
+            # usual annotated VCF, and add the new annotations to the cache
+            pipeline.transform(
+                task_func=stages.merge_anno_cache,
+                name='merge_anno_cache',
+                input=output_from('apply_vcfanno'),
+                filter=formatter('.+/(?P<sample>[a-zA-Z0-9-]+).mutect2.vt.uncached.annotated.vcf'),
+                add_inputs=add_inputs('{path[0]}/{sample[0]}.mutect2.vt.uncached.vcf',
+                                      '{path[0]}/{sample[0]}.mutect2.vt.cached.vcf'),
+                output='{path[0]}/{sample[0]}.mutect2.annotated.vcf')
+            annotated_task = 'merge_anno_cache'
+
+    if state.config.get_optional_option('cohort_store', False):
+        # Add the annotated variants of new samples to the columnar cohort
+        # store
+        pipeline.merge(
+            task_func=stages.build_cohort_store,
+            name='build_cohort_store',
+            input=output_from(annotated_task),
+            output='variants/cohort_store/manifest.json')
 
     return pipeline
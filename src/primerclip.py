@@ -0,0 +1,215 @@
+'''
+Soft-clip amplicon primers from read pairs, in process with pysam.
+
+This is a drop-in replacement for bamclipper in the clip_bam stage, selected
+with "clip_engine: pysam". bamclipper streams every read through a
+name-sorted samtools and perl pipeline on a single core; here the primer
+pairs of primer_bedpe_file are indexed per chromosome, sorted by the start
+of the left primer, so the primer pair of a read pair is found by binary
+search.
+
+Read pairs are matched to a primer pair like bamclipper does: the 5' end of
+the forward read must lie within upstream/downstream bases of the start of
+the left primer, and the 5' end of the reverse read within the same distance
+of the end of the right primer. The forward read is then soft-clipped up to
+the end of the left primer and the reverse read from the start of the right
+primer. Pairs that match no primer pair, and reads that would be clipped
+away entirely, are written unchanged. As with bamclipper, the output is
+coordinate sorted and indexed.
+
+Run as a script, from the job of the clip_bam stage:
+
+    python primerclip.py [--threads N] [--upstream N] [--downstream N] \\
+        primers.bedpe in.bam out.bam
+'''
+
+from __future__ import print_function
+import argparse
+import bisect
+import os
+import pysam
+
+# Default tolerance, in bases, of read ends around primer ends, as bamclipper
+DEFAULT_UPSTREAM = 5
+DEFAULT_DOWNSTREAM = 5
+
+# CIGAR operations
+MATCH, INS, DEL, SKIP, SOFT_CLIP, HARD_CLIP, PAD, EQUAL, DIFF = range(9)
+CONSUMES_REFERENCE = (MATCH, DEL, SKIP, EQUAL, DIFF)
+CONSUMES_QUERY = (MATCH, INS, SOFT_CLIP, EQUAL, DIFF)
+
+
+class PrimerIndex(object):
+    '''Primer pairs of a BEDPE file, searchable by the start of the left
+    primer. Coordinates are zero based and half open, as in BEDPE.
+    '''
+    def __init__(self, bedpe_path, upstream=DEFAULT_UPSTREAM,
+                 downstream=DEFAULT_DOWNSTREAM):
+        self.upstream = upstream
+        self.downstream = downstream
+        pairs = {}
+        with open(bedpe_path) as bedpe:
+            for line in bedpe:
+                fields = line.split()
+                if not fields or fields[0].startswith(('#', 'track', 'browser')):
+                    continue
+                chrom = fields[0]
+                start1, end1, start2, end2 = [int(field) for field in
+                                              (fields[1], fields[2], fields[4], fields[5])]
+                pairs.setdefault(chrom, []).append((start1, end1, start2, end2))
+        self.pairs = {}
+        self.starts = {}
+        for chrom, chrom_pairs in pairs.items():
+            chrom_pairs.sort()
+            self.pairs[chrom] = chrom_pairs
+            self.starts[chrom] = [pair[0] for pair in chrom_pairs]
+
+    def find(self, chrom, forward_start, reverse_end):
+        '''The primer pair (start1, end1, start2, end2) amplifying a read
+        pair whose forward read starts at forward_start and whose reverse
+        read ends at reverse_end, or None.
+        '''
+        starts = self.starts.get(chrom)
+        if not starts:
+            return None
+        pairs = self.pairs[chrom]
+        first = bisect.bisect_left(starts, forward_start - self.downstream)
+        last = bisect.bisect_right(starts, forward_start + self.upstream)
+        for start1, end1, start2, end2 in pairs[first:last]:
+            if reverse_end - self.upstream <= end2 <= reverse_end + self.downstream:
+                return start1, end1, start2, end2
+        return None
+
+
+def clip_start(cigar, start, clip_to):
+    '''Soft-clip the query bases aligned before reference position clip_to.
+    Returns the new CIGAR and alignment start, or None if nothing aligned
+    would be left.
+    '''
+    ops = list(cigar)
+    leading_hard = []
+    clipped = 0
+    index = 0
+    while index < len(ops) and ops[index][0] in (SOFT_CLIP, HARD_CLIP):
+        if ops[index][0] == HARD_CLIP:
+            leading_hard.append(ops[index])
+        else:
+            clipped += ops[index][1]
+        index += 1
+    position = start
+    while index < len(ops) and position < clip_to:
+        op, length = ops[index]
+        if op in CONSUMES_REFERENCE:
+            taken = min(length, clip_to - position)
+            position += taken
+            if op in CONSUMES_QUERY:
+                clipped += taken
+            if taken < length:
+                ops[index] = (op, length - taken)
+                break
+        elif op in CONSUMES_QUERY:
+            clipped += length
+        index += 1
+    rest = ops[index:]
+    # An alignment may not start with an indel
+    while rest and rest[0][0] in (INS, DEL, SKIP, PAD):
+        op, length = rest.pop(0)
+        if op == INS:
+            clipped += length
+        elif op != PAD:
+            position += length
+    if not any(op in CONSUMES_REFERENCE for op, _length in rest):
+        return None
+    if clipped == 0:
+        return cigar, start
+    return leading_hard + [(SOFT_CLIP, clipped)] + rest, position
+
+
+def clip_end(cigar, end, clip_from):
+    '''Soft-clip the query bases aligned from reference position clip_from
+    onwards, where end is the (exclusive) end of the alignment. Returns the
+    new CIGAR, or None if nothing aligned would be left.
+    '''
+    # Clipping the end is clipping the start of the mirrored alignment
+    clipped = clip_start(list(reversed(cigar)), -end, -clip_from)
+    if clipped is None:
+        return None
+    return list(reversed(clipped[0]))
+
+
+def clip_pair(primers, read1, read2):
+    '''Soft-clip the primers from a read pair in place'''
+    if read1.is_unmapped or read2.is_unmapped or \
+            read1.reference_id != read2.reference_id or \
+            read1.is_reverse == read2.is_reverse:
+        return
+    forward, reverse = (read2, read1) if read1.is_reverse else (read1, read2)
+    primer_pair = primers.find(forward.reference_name, forward.reference_start,
+                               reverse.reference_end)
+    if primer_pair is None:
+        return
+    _start1, end1, start2, _end2 = primer_pair
+    forward_clip = clip_start(forward.cigartuples, forward.reference_start, end1)
+    reverse_cigar = clip_end(reverse.cigartuples, reverse.reference_end, start2)
+    if forward_clip is None or reverse_cigar is None:
+        return
+    forward.cigartuples, forward.reference_start = forward_clip
+    reverse.cigartuples = reverse_cigar
+
+
+def clip_bam(bedpe_path, bam_in, bam_out, threads=1,
+             upstream=DEFAULT_UPSTREAM, downstream=DEFAULT_DOWNSTREAM):
+    '''Soft-clip primers from all the read pairs of bam_in, writing a
+    coordinate sorted and indexed bam_out'''
+    primers = PrimerIndex(bedpe_path, upstream, downstream)
+    unsorted_out = bam_out + '.unsorted.bam'
+    # Mates of a coordinate sorted BAM are near each other, so few reads
+    # wait for their mate at any time
+    waiting = {}
+    with pysam.AlignmentFile(bam_in, 'rb', threads=threads) as reads, \
+            pysam.AlignmentFile(unsorted_out, 'wb', template=reads,
+                                threads=threads) as clipped:
+        for read in reads:
+            if not read.is_paired or read.is_secondary or read.is_supplementary:
+                clipped.write(read)
+                continue
+            mate = waiting.pop(read.query_name, None)
+            if mate is None:
+                waiting[read.query_name] = read
+                continue
+            clip_pair(primers, mate, read)
+            clipped.write(mate)
+            clipped.write(read)
+        # Reads whose mate is not in the file
+        for read in waiting.values():
+            clipped.write(read)
+    pysam.sort('-@', str(threads), '-o', bam_out, unsorted_out)
+    os.remove(unsorted_out)
+    pysam.index(bam_out)
+
+
+def parse_args(args=None):
+    parser = argparse.ArgumentParser(
+        description='Soft-clip amplicon primers from paired reads')
+    parser.add_argument('--threads', type=int, default=1,
+        help='Threads for BGZF compression and sorting, defaults to 1')
+    parser.add_argument('--upstream', type=int, default=DEFAULT_UPSTREAM,
+        help='Bases a read may start upstream of its primer, defaults to '
+             '{}'.format(DEFAULT_UPSTREAM))
+    parser.add_argument('--downstream', type=int, default=DEFAULT_DOWNSTREAM,
+        help='Bases a read may start downstream of its primer, defaults to '
+             '{}'.format(DEFAULT_DOWNSTREAM))
+    parser.add_argument('bedpe', help='Primer pairs in BEDPE format')
+    parser.add_argument('bam_in', help='Coordinate sorted input BAM')
+    parser.add_argument('bam_out', help='Clipped output BAM')
+    return parser.parse_args(args)
+
+
+def main(args=None):
+    options = parse_args(args)
+    clip_bam(options.bedpe, options.bam_in, options.bam_out, options.threads,
+             options.upstream, options.downstream)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,133 @@
+'''
+Critical path aware priorities of pipeline jobs.
+
+ruffus starts the jobs that are ready in the order of the pipeline graph,
+so with a few hundred samples the alignment of a normal sample can sit in
+the cluster queue behind all the tumour alignments, and the MuTect2 call of
+its pair, and everything after it, waits for it. With
+"critical_path_priority: True" every job is instead given a priority from
+the estimated time from the start of its stage to the end of the pipeline,
+the remaining critical path of the stage. Jobs on long paths go first.
+
+The runtime of each stage is estimated as the mean wall time of its jobs in
+the telemetry database, the stage's runtime_estimate option ("hours:minutes")
+or, failing both, its walltime. The remaining critical path of a stage is
+its runtime plus the longest remaining critical path of the stages that use
+its outputs, over the task graph built by make_pipeline.
+
+Priorities are passed to SLURM as --nice values, since users may only lower
+the priority of their jobs: 0 for the stages with the longest remaining
+path, up to priority_nice_range (default 1000) for those with the shortest.
+Jobs batched into one job array or bundle are submitted with the lowest
+nice value among them. Local jobs wait for their cores and memory in the
+same order.
+
+The two halves of a tumour/normal pair have to meet at MuTect2, so a job
+whose partner has already finished the same stage is given nice 0: the
+partner is waiting for it. Samples are paired by their names, which end in
+_T or _N (-T or -N in the FASTQ files).
+'''
+
+import os
+import re
+import sqlite3
+import threading
+
+from planner import topological_order, resource_stage, check_ruffus
+from resources import parse_walltime
+from telemetry import sample_name
+
+DEFAULT_NICE_RANGE = 1000
+# Tumour or normal sample name, and the name of the pair
+PAIR_PATTERN = re.compile(r'^(?P<pair>[a-zA-Z0-9-]+?)[-_](?P<tumor>[TN])(?:_|$)')
+
+
+def pair_name(paths):
+    '''The tumour/normal pair and the half of it that a job works on, from
+    its first output (or input), or None'''
+    name = sample_name(paths)
+    match = PAIR_PATTERN.match(name) if name else None
+    if match is None:
+        return None
+    return match.group('pair'), match.group('tumor')
+
+
+def mean_stage_minutes(telemetry_db):
+    '''Mean wall time in minutes of the successful jobs of each stage in the
+    telemetry database'''
+    if not telemetry_db or not os.path.exists(telemetry_db):
+        return {}
+    connection = sqlite3.connect(telemetry_db)
+    try:
+        rows = connection.execute(
+            'SELECT stage, AVG(wall_time) FROM jobs WHERE exit_status = 0 '
+            'AND wall_time IS NOT NULL GROUP BY stage').fetchall()
+    except sqlite3.OperationalError:
+        # No jobs table yet
+        rows = []
+    finally:
+        connection.close()
+    return dict((stage, wall / 60.0) for stage, wall in rows)
+
+
+class Prioritizer(object):
+    '''Priorities of the jobs of each stage, from the remaining critical
+    path of the stage and the progress of tumour/normal pairs'''
+    def __init__(self, config, telemetry_db):
+        self.config = config
+        self.telemetry_db = telemetry_db
+        self.nice_range = config.get_optional_option('priority_nice_range',
+                                                     DEFAULT_NICE_RANGE)
+        # Remaining critical path in minutes of each stage
+        self.remaining = {}
+        # Stages finished by each half of each pair
+        self.finished_stages = {}
+        self.lock = threading.Lock()
+
+    def estimate(self, stage, history):
+        '''Estimated runtime in minutes of a job of the stage'''
+        if stage in history:
+            return history[stage]
+        if stage not in (self.config.get_optional_option('stages') or {}):
+            # Tasks that run nothing, such as original_fastqs
+            return 0
+        estimate = self.config.get_optional_stage_option(stage, 'runtime_estimate')
+        if estimate is None:
+            estimate = self.config.get_optional_stage_option(stage, 'walltime', '0:00')
+        return parse_walltime(estimate)
+
+    def plan(self, pipeline):
+        '''Work out the remaining critical path of every stage of pipeline'''
+        check_ruffus(pipeline)
+        history = mean_stage_minutes(self.telemetry_db)
+        task_remaining = {}
+        for task in reversed(topological_order(pipeline)):
+            stage = resource_stage(self.config, task)
+            downstream = [task_remaining[child] for child in task._outward
+                          if child in task_remaining]
+            task_remaining[task] = self.estimate(stage, history) + \
+                max(downstream or [0])
+            self.remaining[stage] = max(self.remaining.get(stage, 0),
+                                        task_remaining[task])
+
+    def nice(self, stage, paths):
+        '''The nice value of a job of the stage working on paths'''
+        longest = max(self.remaining.values() or [0])
+        if longest <= 0:
+            return 0
+        pair = pair_name(paths)
+        if pair is not None:
+            name, half = pair
+            partner = (name, 'N' if half == 'T' else 'T')
+            with self.lock:
+                if stage in self.finished_stages.get(partner, ()):
+                    return 0
+        remaining = self.remaining.get(stage, longest)
+        return int(round(self.nice_range * (1 - float(remaining) / longest)))
+
+    def finished(self, stage, paths):
+        '''Record that the job of the stage working on paths has finished'''
+        pair = pair_name(paths)
+        if pair is not None:
+            with self.lock:
+                self.finished_stages.setdefault(pair, set()).add(stage)
@@ -0,0 +1,204 @@
+'''
+Adaptive per-stage resource sizing.
+
+The mem and walltime values in the configuration are static guesses, and
+generous ones: small amplicon BAMs get the same 30 GB as whole lanes, which
+makes jobs wait longer in the queue. For stages with "adaptive: True" the
+memory and walltime requested for a job are instead predicted from the total
+size of its input files, by a least squares fit over the successful jobs of
+the same stage in the telemetry database. The prediction allows for the
+scatter of the history around the fit, and is clamped to the stage's
+mem_min/mem_max and walltime_min/walltime_max options. The ceilings default
+to the static mem and walltime of the stage, so the model can only ever ask
+for less than the configuration.
+
+Stages without enough history keep their static values. Stages that size a
+Java heap from their memory are never predicted less than JAVA_MEM_MIN, so
+that the JVM has room beyond the heap.
+
+Jobs that run out of memory or walltime are resubmitted by run_stage with
+the exhausted resource multiplied by the stage's mem_factor or
+walltime_factor (default 2), up to mem_ceiling or walltime_ceiling (default
+four times the first request), see escalate. Jobs killed without a reason
+given, which may have run out of either, have both raised.
+'''
+
+import math
+import os
+import sqlite3
+
+from failures import OUT_OF_MEMORY, TIMEOUT, KILLED
+
+# Fewest successful jobs of a stage needed before predicting its resources
+MIN_HISTORY = 5
+# Only fit the most recent jobs of a stage
+MAX_HISTORY = 500
+# Number of residual standard deviations added to the fitted value
+SAFETY_SD = 2.0
+# Fraction added on top of the prediction
+HEADROOM = 0.2
+# Default factor a resource is multiplied by when a job runs out of it
+ESCALATION_FACTOR = 2
+# Default ceiling of an escalated resource, as a multiple of the first request
+ESCALATION_CEILING = 4
+KB_IN_GIGABYTE = 1024.0 * 1024.0
+# Least memory in GB predicted for a job that sizes a Java heap from its
+# memory: java_heap (see stages.py) leaves 2 GB beyond the heap for the JVM,
+# and the heap is at least 1 GB
+JAVA_MEM_MIN = 3
+
+
+def parse_walltime(walltime):
+    '''Convert a walltime of the form "hours:minutes" to minutes'''
+    hours, minutes = str(walltime).split(':')
+    return int(hours) * 60 + int(minutes)
+
+
+def format_walltime(minutes):
+    '''Convert minutes to a walltime of the form "hours:minutes"'''
+    minutes = int(math.ceil(minutes))
+    return '{}:{:02d}'.format(minutes // 60, minutes % 60)
+
+
+def fit_line(xs, ys):
+    '''Least squares fit of ys = slope * xs + intercept. Returns the slope,
+    intercept and the standard deviation of the residuals.
+    '''
+    n = float(len(xs))
+    mean_x, mean_y = sum(xs) / n, sum(ys) / n
+    var_x = sum((x - mean_x) ** 2 for x in xs)
+    if var_x == 0:
+        slope = 0.0
+    else:
+        slope = sum((x - mean_x) * (y - mean_y) for x, y in zip(xs, ys)) / var_x
+    intercept = mean_y - slope * mean_x
+    residuals = [y - (slope * x + intercept) for x, y in zip(xs, ys)]
+    sd = math.sqrt(sum(r ** 2 for r in residuals) / n)
+    return slope, intercept, sd
+
+
+def predict(xs, ys, x):
+    '''Upper estimate of y at x from the history (xs, ys)'''
+    slope, intercept, sd = fit_line(xs, ys)
+    return (slope * x + intercept + SAFETY_SD * sd) * (1 + HEADROOM)
+
+
+def clamp(value, floor, ceiling):
+    return max(floor, min(ceiling, value))
+
+
+class ResourceModel(object):
+    '''Predicts the memory and walltime of jobs from the telemetry history'''
+    def __init__(self, telemetry_db):
+        self.telemetry_db = telemetry_db
+
+    def history(self, stage):
+        '''Input bytes, max RSS in GB and wall minutes of recent successful
+        jobs of the stage'''
+        if not self.telemetry_db or not os.path.exists(self.telemetry_db):
+            return []
+        connection = sqlite3.connect(self.telemetry_db)
+        try:
+            rows = connection.execute(
+                'SELECT input_bytes, max_rss_kb, wall_time FROM jobs '
+                'WHERE stage = ? AND exit_status = 0 AND max_rss_kb IS NOT NULL '
+                'AND wall_time IS NOT NULL ORDER BY finished DESC LIMIT ?',
+                (stage, MAX_HISTORY)).fetchall()
+        except sqlite3.OperationalError:
+            # No jobs table yet
+            rows = []
+        finally:
+            connection.close()
+        return [(float(input_bytes), max_rss / KB_IN_GIGABYTE, wall / 60.0)
+                for input_bytes, max_rss, wall in rows]
+
+    def predict(self, stage, input_bytes):
+        '''Predicted (mem in GB, walltime in minutes) of a job of the stage
+        with the given input size, or None without enough history.
+        '''
+        history = self.history(stage)
+        if len(history) < MIN_HISTORY:
+            return None
+        sizes = [size for size, _mem, _wall in history]
+        mem = predict(sizes, [mem for _size, mem, _wall in history], input_bytes)
+        wall = predict(sizes, [wall for _size, _mem, wall in history], input_bytes)
+        return mem, wall
+
+
+def stage_resources(state, stage, inputs, java=False):
+    '''The memory (in GB) and walltime to request for a job of the stage,
+    with java set for a job that sizes a Java heap from its memory'''
+    config = state.config
+    mem = config.get_stage_option(stage, 'mem')
+    walltime = config.get_stage_option(stage, 'walltime')
+    if not config.get_optional_stage_option(stage, 'adaptive', False) or not inputs:
+        return mem, walltime
+    input_bytes = sum(os.path.getsize(path) for path in inputs
+                      if os.path.exists(path))
+    prediction = ResourceModel(state.options.telemetry).predict(stage, input_bytes)
+    if prediction is None:
+        return mem, walltime
+    predicted_mem, predicted_minutes = prediction
+    mem_min = config.get_optional_stage_option(stage, 'mem_min', 1)
+    if java:
+        mem_min = max(mem_min, JAVA_MEM_MIN)
+    mem_max = config.get_optional_stage_option(stage, 'mem_max', mem)
+    minutes_min = parse_walltime(
+        config.get_optional_stage_option(stage, 'walltime_min', '0:10'))
+    minutes_max = parse_walltime(
+        config.get_optional_stage_option(stage, 'walltime_max', walltime))
+    # The ceiling wins over the floor, so that the model never asks for
+    # more than the configuration
+    mem = int(math.ceil(clamp(predicted_mem, min(mem_min, mem_max), mem_max)))
+    walltime = format_walltime(clamp(predicted_minutes, minutes_min, minutes_max))
+    return mem, walltime
+
+
+def escalate_mem(config, stage, mem, first_mem):
+    '''More memory (in GB) for a job of the stage that ran out of mem, or
+    None if mem is already at its ceiling'''
+    factor = config.get_optional_stage_option(stage, 'mem_factor',
+                                              ESCALATION_FACTOR)
+    ceiling = config.get_optional_stage_option(
+        stage, 'mem_ceiling', first_mem * ESCALATION_CEILING)
+    if mem >= ceiling:
+        return None
+    return int(math.ceil(min(mem * factor, ceiling)))
+
+
+def escalate_walltime(config, stage, walltime, first_walltime):
+    '''A longer walltime for a job of the stage that ran out of walltime,
+    or None if walltime is already at its ceiling'''
+    factor = config.get_optional_stage_option(stage, 'walltime_factor',
+                                              ESCALATION_FACTOR)
+    ceiling = parse_walltime(config.get_optional_stage_option(
+        stage, 'walltime_ceiling',
+        format_walltime(parse_walltime(first_walltime) * ESCALATION_CEILING)))
+    minutes = parse_walltime(walltime)
+    if minutes >= ceiling:
+        return None
+    return format_walltime(min(minutes * factor, ceiling))
+
+
+def escalate(state, stage, mem, walltime, first_mem, first_walltime, failure):
+    '''The memory (in GB) and walltime to resubmit a job of the stage with,
+    after it failed with the given kind of failure (see failures.classify)
+    asking for mem and walltime. Returns None if the exhausted resource is
+    already at its ceiling.
+    '''
+    config = state.config
+    if failure == OUT_OF_MEMORY:
+        more_mem = escalate_mem(config, stage, mem, first_mem)
+        return None if more_mem is None else (more_mem, walltime)
+    if failure == TIMEOUT:
+        more_walltime = escalate_walltime(config, stage, walltime, first_walltime)
+        return None if more_walltime is None else (mem, more_walltime)
+    if failure == KILLED:
+        # Either may have run out, so raise both, as far as they go
+        more_mem = escalate_mem(config, stage, mem, first_mem)
+        more_walltime = escalate_walltime(config, stage, walltime, first_walltime)
+        if more_mem is None and more_walltime is None:
+            return None
+        return more_mem or mem, more_walltime or walltime
+    # Other failures are resubmitted as they were
+    return mem, walltime
@@ -0,0 +1,133 @@
+'''
+Content-addressed cache of stage results, shared between runs and projects.
+
+Ruffus only compares time stamps of files in the current working directory,
+so a re-run after a configuration tweak, or a sample that appears in two
+projects, recomputes every stage. Instead, each job is given a key computed
+from its fully rendered command, the checksums of its input files and the
+tool modules it loads. When the cache directory already holds outputs for
+that key they are restored, by hard link where possible and otherwise by
+copy, and the job is not submitted. The outputs of successful jobs are
+recorded under their key for later runs.
+
+Because outputs and cache entries may share a hard link, run_stage removes
+the old outputs of a job before running it, so that a tool truncating its
+output file in place never rewrites a cache entry.
+
+Layout of the cache directory:
+
+    <directory>/<key[:2]>/<key>/manifest    names of the cached outputs
+    <directory>/<key[:2]>/<key>/<n>         contents of the n-th output
+'''
+
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+
+# Read files in blocks of this many bytes when computing checksums
+CHECKSUM_BLOCK_SIZE = 1024 * 1024
+
+# Checksums of input files, keyed by (path, size, mtime), so that a file
+# used by several jobs is only read once
+_checksums = {}
+_checksums_lock = threading.Lock()
+
+
+def file_checksum(path):
+    '''SHA-1 hex digest of the contents of a file'''
+    status = os.stat(path)
+    signature = (os.path.abspath(path), status.st_size, status.st_mtime)
+    with _checksums_lock:
+        if signature in _checksums:
+            return _checksums[signature]
+    digest = hashlib.sha1()
+    with open(path, 'rb') as handle:
+        for block in iter(lambda: handle.read(CHECKSUM_BLOCK_SIZE), b''):
+            digest.update(block)
+    with _checksums_lock:
+        _checksums[signature] = digest.hexdigest()
+    return digest.hexdigest()
+
+
+def link_or_copy(source, destination):
+    '''Hard link source to destination, copying if linking is not possible,
+    for instance when they are on different file systems.
+    '''
+    if os.path.lexists(destination):
+        os.remove(destination)
+    try:
+        os.link(source, destination)
+    except OSError:
+        shutil.copy2(source, destination)
+
+
+class ResultCache(object):
+    '''Outputs of stage jobs, keyed by command, inputs and tool versions'''
+    def __init__(self, directory):
+        self.directory = directory
+
+    def key(self, command, inputs, modules, checksum=file_checksum):
+        '''Compute the cache key of a job, with checksum giving the checksum
+        of an input file'''
+        digest = hashlib.sha1()
+        digest.update(command.encode('utf-8'))
+        for module in modules or []:
+            digest.update(b'\0module\0' + module.encode('utf-8'))
+        for path in inputs:
+            digest.update(b'\0input\0' + checksum(path).encode('utf-8'))
+        return digest.hexdigest()
+
+    def entry(self, key):
+        return os.path.join(self.directory, key[:2], key)
+
+    def restore(self, key, outputs):
+        '''Put the cached outputs of key in place. Returns False, leaving
+        the outputs untouched, if the cache does not hold the main (first)
+        output.
+        '''
+        entry = self.entry(key)
+        manifest = os.path.join(entry, 'manifest')
+        if not os.path.exists(manifest):
+            return False
+        with open(manifest) as manifest_file:
+            cached = [line.rstrip('\n') for line in manifest_file]
+        if not set(outputs[:1]).issubset(cached):
+            return False
+        for index, output in enumerate(cached):
+            output_dir = os.path.dirname(output)
+            if output_dir and not os.path.exists(output_dir):
+                os.makedirs(output_dir)
+            link_or_copy(os.path.join(entry, str(index)), output)
+            # Restored outputs must look newer than the inputs to ruffus
+            os.utime(output, None)
+        return True
+
+    def store(self, key, outputs):
+        '''Record the outputs of a successful job under key. Outputs that
+        the job did not create, such as optional index files, are skipped.
+        '''
+        entry = self.entry(key)
+        if os.path.exists(entry):
+            return
+        parent = os.path.dirname(entry)
+        if not os.path.exists(parent):
+            try:
+                os.makedirs(parent)
+            except OSError:
+                # Another job created it in the meantime
+                pass
+        # Build the entry under a temporary name and rename it into place,
+        # so that a partly written entry is never restored
+        staging = tempfile.mkdtemp(prefix='.' + key, dir=parent)
+        created = [output for output in outputs if os.path.exists(output)]
+        for index, output in enumerate(created):
+            link_or_copy(output, os.path.join(staging, str(index)))
+        with open(os.path.join(staging, 'manifest'), 'w') as manifest_file:
+            manifest_file.writelines(output + '\n' for output in created)
+        try:
+            os.rename(staging, entry)
+        except OSError:
+            # Another job stored the same key first
+            shutil.rmtree(staging, ignore_errors=True)
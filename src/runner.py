@@ -5,6 +5,18 @@ and command line options of the pipeline.
 '''
 
 from ruffus.drmaa_wrapper import run_job, error_drmaa_job
+from result_cache import ResultCache
+from resources import stage_resources, escalate
+from failures import classify, INFRASTRUCTURE_FAILURES
+from local_executor import unreserved
+from job_monitor import DEFAULT_ARRAY_WINDOW, DEFAULT_ARRAY_SIZE, \
+    DEFAULT_BUNDLE_WINDOW, DEFAULT_BUNDLE_SIZE, with_nice
+from scratch import scratch_command
+from job_logs import log_paths, logged_command, tail, last_attempt
+import telemetry
+from contextlib import contextmanager
+import os
+import time
 
 
 # slurm memory is requested in MB, but the config file specifies in GB
@@ -33,52 +45,259 @@ SLURM options:
                         REQUEUE, and ALL (any state change)
 '''
 
-def run_stage(state, stage, command):
-    '''Run a pipeline stage, either locally or on the cluster'''
+def local_reservation(state, run_local, cores, mem_in_gb, priority=0):
+    '''Reserve the cores and memory of a local job in the local resource pool'''
+    if run_local and state.local_pool is not None:
+        return state.local_pool.reserve(cores, mem_in_gb, priority)
+    return unreserved()
+
+def slurm_job_options(cores, walltime, mem_in_gb, queue, account):
+    '''Job-specific options for SLURM'''
+    return '--nodes=1 --ntasks-per-node={cores} --ntasks={cores} --time={time} --mem={mem} --partition={queue} --account={account}' \
+                  .format(cores=cores, time=walltime,
+                          mem=mem_in_gb * MEGABYTES_IN_GIGABYTE, queue=queue,
+                          account=account)
+
+def record_outputs(state, outputs):
+    '''Record the state of the outputs of a finished job, or of the files a
+    stage wrote or removed in process, in the file index, so that the next
+    up-to-date check need not look at them'''
+    if state.file_index is not None and outputs:
+        state.file_index.record(outputs)
+
+@contextmanager
+def untracked():
+    '''A job that is not counted in any metrics'''
+    yield lambda: None
+
+def tracked_job(state, stage, inputs, outputs):
+    '''Count a job of the stage in the live metrics of the run, if any'''
+    if state.metrics is not None:
+        return state.metrics.job(stage, outputs or inputs or [])
+    return untracked()
+
+def record_finished(state, stage, inputs, outputs):
+    '''Let the prioritizer know that a job of the stage has finished'''
+    if state.prioritizer is not None:
+        state.prioritizer.finished(stage, outputs or inputs or [])
+
+def run_stage(state, stage, command, inputs=None, outputs=None,
+              bundle_setup=None, bundle_teardown=None):
+    '''Run a pipeline stage, either locally or on the cluster.
+
+    The command is either a string, or a function from the memory of the
+    job in GB to a string, for commands such as java that need to know it.
+
+    When the stage declares its input and output files and a result_cache
+    directory is configured, outputs of an identical earlier job are
+    restored from the cache instead of running the job again.
+
+    When the stage is bundled, bundle_setup and bundle_teardown are shell
+    commands run once by each bundle job before and after the commands it
+    bundles, with the modules of the stage loaded.
+    '''
 
     # Grab the configuration options for this stage
     config = state.config
     modules = config.get_stage_option(stage, 'modules')
-    mem = config.get_stage_option(stage, 'mem') * MEGABYTES_IN_GIGABYTE
+    # Memory (in GB) and walltime, possibly predicted from earlier jobs.
+    # Commands that depend on the memory size a Java heap from it.
+    mem_in_gb, walltime = stage_resources(state, stage, inputs,
+                                          java=callable(command))
     account = config.get_stage_option(stage, 'account')
     queue = config.get_stage_option(stage, 'queue')
-    walltime = config.get_stage_option(stage, 'walltime')
     run_local = config.get_stage_option(stage, 'local')
     cores = config.get_stage_option(stage, 'cores')
+    retries = config.get_optional_stage_option(stage, 'retries', 0)
+    # Resubmissions of jobs that ran out of memory or walltime, or whose
+    # node failed, on top of the retries, if configured
+    resubmits = config.get_optional_stage_option(stage, 'resubmits', 0)
+    # Stage the inputs and outputs of the job through node-local scratch
+    scratch = config.get_optional_stage_option(stage, 'scratch', False)
+    # Submit the jobs of the stage to the cluster in job arrays
+    array = config.get_optional_stage_option(stage, 'array', False)
+    array_window = config.get_optional_stage_option(stage, 'array_window',
+                                                    DEFAULT_ARRAY_WINDOW)
+    array_size = config.get_optional_stage_option(stage, 'array_size',
+                                                  DEFAULT_ARRAY_SIZE)
+    # Run short jobs of the stage together in a single cluster job
+    bundle = config.get_optional_stage_option(stage, 'bundle', False)
+    bundle_window = config.get_optional_stage_option(stage, 'bundle_window',
+                                                     DEFAULT_BUNDLE_WINDOW)
+    bundle_size = config.get_optional_stage_option(stage, 'bundle_size',
+                                                   DEFAULT_BUNDLE_SIZE)
+    # Commands a bundle job runs at a time
+    bundle_jobs = config.get_optional_stage_option(stage, 'bundle_jobs', cores)
     pipeline_id = config.get_option('pipeline_id')
     job_name = pipeline_id + '_' + stage
 
+    render_command = command if callable(command) else lambda _mem_in_gb: command
+    command = render_command(mem_in_gb)
+
     # Generate a "module load" command for each required module
     module_loads = '\n'.join(['module load ' + module for module in modules])
-    cluster_command = '\n'.join([module_loads, command])
+    stage_in_scratch = scratch and outputs
+    wrapped_command = command
+    if stage_in_scratch:
+        wrapped_command = scratch_command(command, inputs or [], outputs, job_name)
+    if bundle_setup:
+        bundle_setup = '\n'.join([module_loads, bundle_setup])
+    if bundle_teardown:
+        bundle_teardown = '\n'.join([module_loads, bundle_teardown])
 
-    # Specify job-specific options for SLURM
-    job_options = '--nodes=1 --ntasks-per-node={cores} --ntasks={cores} --time={time} --mem={mem} --partition={queue} --account={account}' \
-                      .format(cores=cores, time=walltime, mem=mem, queue=queue, account=account)
+    # Jobs on the longest remaining path of the pipeline go first. The
+    # nice value is kept out of the job options, which batch the jobs of
+    # array and bundle stages.
+    nice = 0
+    if state.prioritizer is not None:
+        nice = state.prioritizer.nice(stage, outputs or inputs or [])
+    job_options = slurm_job_options(cores, walltime, mem_in_gb, queue, account)
 
     # Log a message about the job we are about to run
     log_messages = ['Running stage: {}'.format(stage),
                     'Command: {}'.format(command)]
     if not run_local:
-        log_messages.append('Job options: {}'.format(job_options))
+        log_messages.append('Job options: {}'.format(with_nice(job_options, nice)))
+    if wrapped_command != command:
+        log_messages.append('Staged through node-local scratch')
     state.logger.info('\n'.join(log_messages))
 
-    # Run the job, capturing stdout and stderr
-    stdout_res, stderr_res = None, None
-    try:
-        stdout_res, stderr_res = \
-            run_job(cmd_str=cluster_command,
-                job_name = job_name,
-                logger = state.logger.proxy,
-                drmaa_session = state.drmaa_session,
-                # Determines whether to run the command on the local
-                # machine or run it on the cluster
-                run_locally = run_local,
-                # Keep a copy of the job script for diagnostic purposes
-                retain_job_scripts = True,
-                # retain_stdout = True,
-                # retain_stderr = True,
-                job_script_directory = state.options.jobscripts,
-                job_other_options = job_options)
-    except error_drmaa_job as err:
-        raise Exception("\n".join(map(str, ["Failed to run:", command, err, stdout_res, stderr_res])))
+    result_cache, cache_key = None, None
+    cache_directory = config.get_optional_option('result_cache')
+    if cache_directory and inputs is not None and outputs:
+        result_cache = ResultCache(cache_directory)
+        # Key on the command as configured, so that a job whose memory was
+        # sized differently still finds its earlier results
+        static_command = render_command(config.get_stage_option(stage, 'mem'))
+        # Checksums of unchanged inputs are kept in the file index
+        if state.file_index is not None:
+            cache_key = result_cache.key(static_command, inputs, modules,
+                                         checksum=state.file_index.checksum)
+        else:
+            cache_key = result_cache.key(static_command, inputs, modules)
+        if result_cache.restore(cache_key, outputs):
+            state.logger.info('Restored stage {} outputs from result cache: {}'
+                              .format(stage, cache_key))
+            record_outputs(state, outputs)
+            record_finished(state, stage, inputs, outputs)
+            if state.metrics is not None:
+                state.metrics.restored(stage, outputs or inputs or [])
+            return
+        # Outputs may be hard links into the cache, never write through them
+        for output in outputs:
+            if os.path.lexists(output):
+                os.remove(output)
+
+    # Run the job, with its stdout and stderr appended to the log files of
+    # the stage. A job that failed because of the cluster is resubmitted up
+    # to "resubmits" times, with more memory or walltime if it ran out of
+    # them, and any failed job is resubmitted up to "retries" times, before
+    # the stage is reported failed. Each attempt is recorded in the
+    # telemetry database, if there is one.
+    telemetry_db = state.options.telemetry
+    stdout_log, stderr_log = log_paths(state.options.job_logs, stage,
+                                       outputs, inputs)
+    first_mem_in_gb, first_walltime = mem_in_gb, walltime
+    attempt, retried, resubmitted = 0, 0, 0
+    while True:
+        attempt += 1
+        resources = dict(local=run_local, cores=cores, walltime=walltime,
+                         mem=mem_in_gb)
+        job_command = '\n'.join([module_loads, wrapped_command])
+        time_file = None
+        job_infos = []
+        # The scheduler accounts for the resources of jobs the job monitor
+        # submits on their own; time the others
+        if telemetry_db and (run_local or state.job_monitor is None or bundle):
+            time_file = telemetry.new_time_file(state.options.jobscripts, job_name)
+            job_command = '\n'.join([module_loads,
+                                     telemetry.timed_command(wrapped_command, time_file)])
+        job_command = logged_command(job_command, stdout_log, stderr_log,
+            '{} attempt {}'.format(job_name, attempt))
+        submitted = time.time()
+        try:
+            # Local jobs wait until their cores and memory are free
+            with tracked_job(state, stage, inputs, outputs) as job_started, \
+                    local_reservation(state, run_local, cores, mem_in_gb, nice):
+                if run_local or state.job_monitor is None:
+                    job_started()
+                    run_job(cmd_str=job_command,
+                            job_name = job_name,
+                            logger = state.logger,
+                            drmaa_session = state.drmaa_session,
+                            # Determines whether to run the command on the local
+                            # machine or run it on the cluster
+                            run_locally = run_local,
+                            # Keep a copy of the job script for diagnostic purposes
+                            retain_job_scripts = True,
+                            # retain_stdout = True,
+                            # retain_stderr = True,
+                            job_script_directory = state.options.jobscripts,
+                            job_other_options = with_nice(job_options, nice))
+                else:
+                    # Cluster jobs are tracked by the single job monitor
+                    # thread; this thread just waits for the outcome. They
+                    # only count as running once the scheduler starts them,
+                    # which the monitor only asks about for the metrics.
+                    if state.metrics is None:
+                        job_started = None
+                    state.job_monitor.run(cmd_str=job_command,
+                            job_name = job_name,
+                            job_other_options = job_options,
+                            job_script_directory = state.options.jobscripts,
+                            logger = state.logger,
+                            array = array,
+                            array_window = array_window,
+                            array_size = array_size,
+                            bundle = bundle,
+                            bundle_window = bundle_window,
+                            bundle_size = bundle_size,
+                            cores = bundle_jobs,
+                            bundle_setup = bundle_setup,
+                            bundle_teardown = bundle_teardown,
+                            nice = nice,
+                            job_started = job_started,
+                            job_finished = job_infos.append)
+            break
+        except error_drmaa_job as err:
+            log_tail = tail(stderr_log)
+            failure = classify(err, last_attempt(log_tail))
+            escalated = None
+            if failure in INFRASTRUCTURE_FAILURES and resubmitted < resubmits:
+                escalated = escalate(state, stage, mem_in_gb, walltime,
+                                     first_mem_in_gb, first_walltime, failure)
+            if escalated is not None:
+                resubmitted += 1
+                mem_in_gb, walltime = escalated
+                # Commands such as java size their heap from the memory
+                command = render_command(mem_in_gb)
+                wrapped_command = command
+                if stage_in_scratch:
+                    wrapped_command = scratch_command(command, inputs or [],
+                                                      outputs, job_name)
+                job_options = slurm_job_options(cores, walltime, mem_in_gb,
+                                                queue, account)
+                state.logger.info('Stage {} failed ({}), resubmitting with '
+                                  '{} GB and walltime {} ({} of {}):\n{}'
+                                  .format(stage, failure, mem_in_gb, walltime,
+                                          resubmitted, resubmits, err))
+            elif retried < retries:
+                retried += 1
+                state.logger.info('Stage {} failed ({}), retrying ({} of {}):\n{}'
+                                  .format(stage, failure, retried, retries, err))
+            else:
+                raise Exception("\n".join(map(str, [
+                    "Failed to run ({}):".format(failure), command, err,
+                    "The end of {} was:".format(stderr_log),
+                    ''.join(log_tail)])))
+        finally:
+            if telemetry_db:
+                telemetry.record_job(telemetry_db, pipeline_id, stage, job_name,
+                                     resources, submitted, time_file,
+                                     inputs, outputs,
+                                     job_infos[0] if job_infos else None)
+
+    if result_cache is not None:
+        result_cache.store(cache_key, outputs)
+    record_outputs(state, outputs)
+    record_finished(state, stage, inputs, outputs)
@@ -0,0 +1,107 @@
+'''
+Run the jobs of a stage on node-local scratch space.
+
+Stages with "scratch: true" have their command wrapped so that the job
+makes a private directory under $TMPDIR (or /tmp) on the node it runs on,
+copies its input files there, runs the command against the copies and then
+copies its output files back to the shared file system. The many small
+reads and writes of tools such as Picard and samtools sort then stay on the
+node, and the shared file system sees one sequential copy of each file.
+TMPDIR is pointed at the scratch directory while the command runs, so the
+temporary files of the tools land there too, and the directory is removed
+when the job ends, whether or not it succeeded.
+
+Only files given by relative paths, which are the files of the pipeline
+itself, are staged. They keep their relative paths under the scratch
+directory, and every path in the command that starts with one of them is
+redirected there, so that files derived from an output name, such as the
+temporary files of samtools sort -T {bam}.tmp, are also written on the node.
+Index files next to a staged input (.bai, .tbi and .csi) are copied with it.
+Absolute paths, such as the reference genome, are left in place.
+
+The outputs are copied back under a temporary name and renamed into place,
+so a job killed part way through never leaves a truncated output behind.
+'''
+
+import os
+import re
+
+try:
+    from shlex import quote
+except ImportError:
+    from pipes import quote
+
+# Shell variable holding the scratch directory of a job
+SCRATCH_VARIABLE = 'PIPELINE_SCRATCH'
+# Characters that may come before a path in a command
+PATH_BOUNDARY = r'''(?:^|(?<=[\s=,:'"<>(]))'''
+
+# Shell functions copying a file (with its index files) to the scratch
+# directory, and an output back from it
+STAGING_FUNCTIONS = '''\
+stage_in() {
+    for file in "$1" "$1.bai" "${1%.bam}.bai" "$1.tbi" "$1.csi"; do
+        if [ -e "$file" ]; then cp -p "$file" "$PIPELINE_SCRATCH/$file" || return 1; fi
+    done
+}
+stage_out() {
+    if [ -e "$PIPELINE_SCRATCH/$1" ]; then
+        mkdir -p "$(dirname "$1")" &&
+        cp "$PIPELINE_SCRATCH/$1" "$1.staging" && mv "$1.staging" "$1"
+    fi
+}'''
+
+
+def staged_paths(paths):
+    '''The normalised paths that are staged through scratch: relative paths
+    within the working directory'''
+    staged = []
+    for path in paths:
+        path = os.path.normpath(path)
+        if not os.path.isabs(path) and not path.startswith(os.pardir) \
+                and path not in staged:
+            staged.append(path)
+    return staged
+
+
+def redirect_paths(command, paths):
+    '''Point every path in command that starts with one of paths to the
+    scratch directory'''
+    if not paths:
+        return command
+    # Longest paths first, so that a path is never split by a shorter one
+    alternatives = '|'.join(re.escape(path) for path in
+                            sorted(paths, key=len, reverse=True))
+    pattern = re.compile(PATH_BOUNDARY + r'(?:\./)?(' + alternatives + ')')
+    return pattern.sub(lambda match: '${' + SCRATCH_VARIABLE + '}/' + match.group(1),
+                       command)
+
+
+def scratch_command(command, inputs, outputs, name='job'):
+    '''Wrap a shell command to run in a node-local scratch directory,
+    copying inputs there and outputs back. The exit status of the command
+    is preserved, and outputs are only copied back if it succeeded.
+    '''
+    inputs = staged_paths(inputs)
+    outputs = staged_paths(outputs)
+    directories = sorted(set(os.path.dirname(path) for path in inputs + outputs
+                             if os.path.dirname(path)))
+    lines = [
+        '{var}=$(mktemp -d "${{TMPDIR:-/tmp}}/{name}.XXXXXX") || exit 1'.format(
+            var=SCRATCH_VARIABLE, name=re.sub(r'[^\w.-]', '_', name)),
+        # Exported for commands that run their own shell, such as bash -c
+        'export {var}'.format(var=SCRATCH_VARIABLE),
+        "trap 'rm -rf \"${var}\"' EXIT".format(var=SCRATCH_VARIABLE),
+        STAGING_FUNCTIONS,
+        'mkdir -p "${var}/tmp"'.format(var=SCRATCH_VARIABLE)]
+    lines.extend('mkdir -p "${var}"/{directory}'.format(
+        var=SCRATCH_VARIABLE, directory=quote(directory)) for directory in directories)
+    lines.extend('stage_in {path} || exit 1'.format(path=quote(path)) for path in inputs)
+    # Run the command in a subshell, so that it cannot exit the wrapper
+    # before the outputs are copied back
+    lines.append('(\nexport TMPDIR="${var}/tmp"\n{command}\n)'.format(
+        var=SCRATCH_VARIABLE, command=redirect_paths(command, inputs + outputs)))
+    lines.append('status=$?')
+    lines.append('if [ $status -ne 0 ]; then exit $status; fi')
+    lines.extend('stage_out {path} || exit 1'.format(path=quote(path)) for path in outputs)
+    return '\n'.join(lines)
@@ -8,26 +8,66 @@ as config, options, DRMAA and the logger.
 '''
 
 from utils import safe_make_dir
-from runner import run_stage
+from runner import run_stage, record_outputs, tracked_job, record_finished
+from intervals import write_shards
+from vcf_io import split_vcf, merge_vcfs, read_vcf, write_vcf, \
+    add_header_lines, sort_records, has_records
+from annotation_cache import AnnotationCache, DEFAULT_MAX_ENTRIES, \
+    record_key, added_annotation, with_annotation, file_digest
 import os
-import pysam
+import sys
+
+try:
+    from shlex import quote
+except ImportError:
+    from pipes import quote
+
+# The in-process primer clipper, run as a script by the clip_bam stage
+PRIMERCLIP_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                 'primerclip.py')
+# Coverage of BAM files and the cohort, run as a script by the coverage stages
+COVERAGE_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                               'coverage.py')
+# Columnar store of the cohort's annotated variants, run as a script by the
+# build_cohort_store stage
+COHORT_STORE_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                   'cohort_store.py')
 
 PICARD_JAR = '/usr/local/easybuild/software/picard/2.3.0/picard.jar'
 SNPEFF_JAR = '/usr/local/easybuild/software/snpEff/4.1d-Java-1.7.0_80/snpEff.jar'
 
 GATK_JAR = '$GATK_HOME/GenomeAnalysisTK.jar'
 
-def java_command(jar_path, mem_in_gb, command_args):
-    '''Build a string for running a java command'''
+def java_heap(mem_in_gb):
+    '''Java's max heap memory in GB for a job given mem_in_gb'''
     # Bit of room between Java's max heap memory and what was requested.
     # Allows for other Java memory usage, such as stack.
-    java_mem = mem_in_gb - 2
-    return 'java -Xmx{mem}g -jar {jar_path} {command_args}'.format(
+    return max(1, mem_in_gb - 2)
+
+def java_command(jar_path, mem_in_gb, command_args):
+    '''Build a string for running a java command'''
+    java_mem = java_heap(mem_in_gb)
+    # Temporary files, such as those of Picard sorting, follow TMPDIR,
+    # which points to node-local scratch for stages run there
+    return 'java -Xmx{mem}g -Djava.io.tmpdir=${{TMPDIR:-/tmp}} ' \
+           '-jar {jar_path} {command_args}'.format(
         jar_path=jar_path, mem=java_mem, command_args=command_args)
 
-def run_java(state, stage, jar_path, mem, args):
-    command = java_command(jar_path, mem, args)
-    run_stage(state, stage, command)
+def run_java(state, stage, jar_path, args, inputs=None, outputs=None):
+    # The heap size follows the memory run_stage requests for the job
+    command = lambda mem_in_gb: java_command(jar_path, mem_in_gb, args)
+    run_stage(state, stage, command, inputs=inputs, outputs=outputs)
+
+def in_process(method):
+    '''Mark a stage method that does its work in the pipeline process
+    itself rather than in a job of run_stage'''
+    method.in_process = True
+    return method
+
+def bwa_read_group(sample_id, tumor_id, read_id, lane, lib):
+    '''Build the quoted read group string passed to bwa mem -R'''
+    return '"@RG\\tID:{readid}\\tSM:{sample}_{tumor_id}_{readid}\\tPU:lib1\\tLN:{lane}\\tPL:Illumina"' \
+        .format(readid=read_id, lib=lib, lane=lane, sample=sample_id, tumor_id=tumor_id)
 
 class Stages(object):
     def __init__(self, state):
@@ -56,17 +96,14 @@ class Stages(object):
         self.mutect2_gnomad = self.get_options('mutect2_gnomad')
         self.vcfanno = self.get_options('vcfanno')
 
-    def run_picard(self, stage, args):
-        mem = int(self.state.config.get_stage_options(stage, 'mem'))
-        return run_java(self.state, stage, PICARD_JAR, mem, args)
+    def run_picard(self, stage, args, inputs=None, outputs=None):
+        return run_java(self.state, stage, PICARD_JAR, args, inputs, outputs)
 
-    def run_snpeff(self, stage, args):
-        mem = int(self.state.config.get_stage_options(stage, 'mem'))
-        return run_java(self.state, stage, SNPEFF_JAR, mem, args)
+    def run_snpeff(self, stage, args, inputs=None, outputs=None):
+        return run_java(self.state, stage, SNPEFF_JAR, args, inputs, outputs)
 
-    def run_gatk(self, stage, args):
-        mem = int(self.state.config.get_stage_options(stage, 'mem'))
-        return run_java(self.state, stage, GATK_JAR, mem, args)
+    def run_gatk(self, stage, args, inputs=None, outputs=None):
+        return run_java(self.state, stage, GATK_JAR, args, inputs, outputs)
 
     def get_stage_options(self, stage, *options):
         return self.state.config.get_stage_options(stage, *options)
@@ -74,28 +111,136 @@ class Stages(object):
     def get_options(self, *options):
         return self.state.config.get_options(*options)
 
+    def bwa_threads(self, stage):
+        '''Threads for each bwa of a stage. A bundle job shares its cores
+        between the commands it runs at a time.'''
+        config = self.state.config
+        cores = config.get_stage_option(stage, 'cores')
+        if not config.get_optional_stage_option(stage, 'bundle', False):
+            return cores
+        jobs = config.get_optional_stage_option(stage, 'bundle_jobs', cores)
+        return max(1, cores // jobs)
+
+    def bwa_shm_commands(self, stage):
+        '''Setup and teardown commands for the bundle jobs of a stage with
+        bwa_shm set, which load the BWA index into shared memory once for
+        all the alignments of the bundle, and release it at the end. bwa
+        mem uses the shared index when it is there, and otherwise loads it
+        from disk as usual.'''
+        if not self.state.config.get_optional_stage_option(stage, 'bwa_shm', False):
+            return None, None
+        setup = 'bwa shm -l 2>/dev/null | cut -f 1 | grep -qxF {name} || ' \
+                'bwa shm {reference}'.format(
+                    name=os.path.basename(self.reference), reference=self.reference)
+        return setup, 'bwa shm -d'
+
+    @in_process
     def original_fastqs(self, output):
         '''Original fastq files'''
         # print output
         pass
 
     def align_bwa(self, inputs, bam_out, sample_id, tumor_id, read_id, lane, lib):
-        # def align_bwa(self, inputs, bam_out, sample_id):
-        '''Align the paired end fastq files to the reference genome using bwa'''
+        '''Align a pair of fastq files (one lane of a sample, or a chunk of
+        one) to the reference genome using bwa, producing a sorted BAM file
+        with the read group of the lane'''
+        fastq_read1_in, fastq_read2_in = inputs
+        cores = self.bwa_threads('align_bwa')
+        safe_make_dir(os.path.dirname(bam_out))
+        read_group = bwa_read_group(sample_id, tumor_id, read_id, lane, lib)
+        command = 'bwa mem -M -t {cores} -R {read_group} {reference} {fastq_read1} {fastq_read2} ' \
+                  '| samtools sort -@ {cores} -T {bam}.tmp -o {bam} -' \
+                  .format(cores=cores,
+                          read_group=read_group,
+                          fastq_read1=fastq_read1_in,
+                          fastq_read2=fastq_read2_in,
+                          reference=self.reference,
+                          bam=bam_out)
+        setup, teardown = self.bwa_shm_commands('align_bwa')
+        # A bwa that fails part way must fail the job, rather than leave a
+        # truncated but sorted BAM
+        run_stage(self.state, 'align_bwa', 'bash -o pipefail -c ' + quote(command),
+                  inputs=inputs, outputs=[bam_out],
+                  bundle_setup=setup, bundle_teardown=teardown)
+
+    def align_bwa_fused(self, inputs, bam_out, sample_id, tumor_id, read_id, lane, lib):
+        '''Align, sort, keep primary alignments and index one lane of a
+        sample in a single job.
+
+        Streams bwa output through the same filter as primary_bam and a
+        multithreaded samtools sort, so none of the intermediate BAMs of
+        align_bwa and primary_bam are written to disk.
+        The BAM index is written next to the output, as index_bam would.
+        '''
         fastq_read1_in, fastq_read2_in = inputs
-        cores = self.get_stage_options('align_bwa', 'cores')
-        safe_make_dir('alignments/{sample}'.format(sample=sample_id))
-        read_group = '"@RG\\tID:{readid}\\tSM:{sample}_{tumor_id}_{readid}\\tPU:lib1\\tLN:{lane}\\tPL:Illumina"' \
-            .format(readid=read_id, lib=lib, lane=lane, sample=sample_id, tumor_id=tumor_id)
+        cores = self.bwa_threads('align_bwa_fused')
+        safe_make_dir(os.path.dirname(bam_out))
+        read_group = bwa_read_group(sample_id, tumor_id, read_id, lane, lib)
         command = 'bwa mem -M -t {cores} -R {read_group} {reference} {fastq_read1} {fastq_read2} ' \
-                  '| samtools view -b -h -o {bam} -' \
+                  '| samtools view -u -h -q 1 -f 2 -F 4 -F 8 -F 256 - ' \
+                  '| samtools sort -@ {cores} -T {bam}.tmp -o {bam} - ' \
+                  '&& samtools index {bam} {bam}.bai' \
                   .format(cores=cores,
                           read_group=read_group,
                           fastq_read1=fastq_read1_in,
                           fastq_read2=fastq_read2_in,
                           reference=self.reference,
                           bam=bam_out)
-        run_stage(self.state, 'align_bwa', command)
+        setup, teardown = self.bwa_shm_commands('align_bwa_fused')
+        # A bwa that fails part way must fail the job, rather than leave a
+        # truncated but sorted and indexed BAM
+        run_stage(self.state, 'align_bwa_fused',
+                  'bash -o pipefail -c ' + quote(command),
+                  inputs=inputs, outputs=[bam_out, bam_out + '.bai'],
+                  bundle_setup=setup, bundle_teardown=teardown)
+
+    def split_fastq_chunks(self, inputs, chunks_out, chunk_prefix):
+        '''Split a pair of FASTQ files into chunks of chunk_reads read pairs
+        for parallel alignment'''
+        fastq_read1_in, fastq_read2_in = inputs
+        # Remove chunks (and their alignments) left over from earlier runs,
+        # which may have been split differently
+        removed = []
+        for chunk in chunks_out:
+            os.remove(chunk)
+            removed.append(chunk)
+            aligned_chunk = chunk[:-len('.R1.fastq')] + '.bam'
+            if chunk.endswith('.R1.fastq') and os.path.exists(aligned_chunk):
+                os.remove(aligned_chunk)
+                removed.append(aligned_chunk)
+        safe_make_dir(os.path.dirname(chunk_prefix))
+        chunk_reads = self.get_stage_options('align_bwa', 'chunk_reads')
+        # Four lines per read; both files hold the reads of a pair in the
+        # same order, so their chunks pair up
+        command = ' && '.join(
+            'split -d -a 4 -l {lines} --additional-suffix=.{read}.fastq '
+            '{fastq} {prefix}.chunk_'.format(
+                lines=4 * chunk_reads, read=read, fastq=fastq, prefix=chunk_prefix)
+            for read, fastq in (('R1', fastq_read1_in), ('R2', fastq_read2_in)))
+        run_stage(self.state, 'split_fastq_chunks', command, inputs=list(inputs))
+        # The new chunks are globbed by the next task, but the removed ones
+        # may have been recreated under the same names
+        record_outputs(self.state, removed)
+
+    def merge_bwa_chunks(self, bams_in, bam_out, align_stage, index=False):
+        '''Merge the sorted alignments of all the lanes (or chunks of lanes)
+        of a sample, and with index set index the result. Chunks of the
+        same lane share a read group, which is kept once. Configurations
+        without a merge_bwa_chunks stage merge with the settings of
+        align_stage.'''
+        stage = 'merge_bwa_chunks'
+        if stage not in self.state.config.get_option('stages'):
+            stage = align_stage
+        cores = self.state.config.get_optional_stage_option(stage, 'cores', 1)
+        # Chunk names are zero padded, so sorting restores the read order
+        command = 'samtools merge -f -c -p -@ {cores} {bam_out} {bams_in}'.format(
+            cores=cores, bam_out=bam_out, bams_in=' '.join(sorted(bams_in)))
+        outputs = [bam_out]
+        if index:
+            command += ' && samtools index {bam} {bam}.bai'.format(bam=bam_out)
+            outputs.append(bam_out + '.bai')
+        run_stage(self.state, stage, command,
+                  inputs=sorted(bams_in), outputs=outputs)
 
     # def apply_undr_rover(self, inputs, vcf_output, sample_id, readid):
     #     # def align_bwa(self, inputs, bam_out, sample_id):
@@ -128,10 +273,24 @@ class Stages(object):
     #     run_stage(self.state, 'apply_undr_rover', command)
 
     def clip_bam(self, bam_in, sorted_bam_out):
-        '''Clip the BAM file using Bamclipper'''
-        bamclipper_args = '{bamclipper} -b {bam_in} -p {primer_bedpe_file} -n 1'.format(
-                          bamclipper=self.bamclipper, bam_in=bam_in, primer_bedpe_file=self.primer_bedpe_file)
-        run_stage(self.state, 'clip_bam', bamclipper_args)
+        '''Clip the BAM file using Bamclipper, or with "clip_engine: pysam"
+        using the in-process clipper in primerclip.py'''
+        clip_engine = self.state.config.get_optional_stage_option(
+            'clip_bam', 'clip_engine', 'bamclipper')
+        if clip_engine == 'pysam':
+            cores = self.get_stage_options('clip_bam', 'cores')
+            command = '{python} {primerclip} --threads {cores} {primer_bedpe_file} ' \
+                      '{bam_in} {bam_out}'.format(
+                          python=sys.executable, primerclip=PRIMERCLIP_SCRIPT,
+                          cores=cores, primer_bedpe_file=self.primer_bedpe_file,
+                          bam_in=bam_in, bam_out=sorted_bam_out)
+        else:
+            command = '{bamclipper} -b {bam_in} -p {primer_bedpe_file} -n 1'.format(
+                      bamclipper=self.bamclipper, bam_in=bam_in, primer_bedpe_file=self.primer_bedpe_file)
+        # Both engines index the clipped BAM next to it
+        run_stage(self.state, 'clip_bam', command,
+                  inputs=[bam_in, self.primer_bedpe_file],
+                  outputs=[sorted_bam_out, sorted_bam_out + '.bai'])
 
     def sort_bam_picard(self, bam_in, sorted_bam_out):
         '''Sort the BAM file using Picard'''
@@ -139,35 +298,79 @@ class Stages(object):
                       'VALIDATION_STRINGENCY=LENIENT SORT_ORDER=coordinate ' \
                       'MAX_RECORDS_IN_RAM=5000000 CREATE_INDEX=True'.format(
                           bam_in=bam_in, sorted_bam_out=sorted_bam_out)
-        self.run_picard('sort_bam_picard', picard_args)
+        self.run_picard('sort_bam_picard', picard_args, inputs=[bam_in],
+                        outputs=[sorted_bam_out, sorted_bam_out[:-len('.bam')] + '.bai'])
 
     def primary_bam(self, bam_in, sbam_out):
         '''On keep primary alignments in the BAM file using samtools'''
         command = 'samtools view -h -q 1 -f 2 -F 4 -F 8 -F 256 -b ' \
                     '-o {sbam_out} {bam_in}'.format(
                         bam_in=bam_in, sbam_out=sbam_out)
-        run_stage(self.state, 'primary_bam', command)
+        run_stage(self.state, 'primary_bam', command,
+                  inputs=[bam_in], outputs=[sbam_out])
 
     # index sorted bam file
     def index_sort_bam_picard(self, bam_in, bam_index):
         '''Index sorted bam using samtools'''
         command = 'samtools index {bam_in} {bam_index}'.format(
                           bam_in=bam_in, bam_index=bam_index)
-        run_stage(self.state, 'index_sort_bam_picard', command)
+        run_stage(self.state, 'index_sort_bam_picard', command,
+                  inputs=[bam_in], outputs=[bam_index])
 
     # coverage bam
     def call_mutect2_gatk(self, inputs, vcf_out):
         '''Call somatic variants from using MuTect2'''
         tumor_in, normal_in = inputs
+        safe_make_dir('variants/mutect2/')
+        command = self.mutect2_command(tumor_in, normal_in, self.gatk_bed, vcf_out)
+        run_stage(self.state, 'call_mutect2_gatk', command,
+                  inputs=[tumor_in, normal_in, self.gatk_bed],
+                  outputs=[vcf_out, vcf_out + '.stats'])
+
+    @in_process
+    def split_gatk_bed(self, bed_in, shards_out):
+        '''Split the panel BED file into balanced shards for MuTect2'''
+        safe_make_dir(os.path.dirname(shards_out[0]))
+        weights = self.state.config.get_optional_option('mutect2_shard_weights')
+        write_shards(bed_in, shards_out, weights)
+        record_outputs(self.state, shards_out)
+
+    def call_mutect2_gatk_shard(self, inputs, vcf_out):
+        '''Call somatic variants using MuTect2 over one shard of the panel'''
+        tumor_in, normal_in, shard_bed = inputs
+        safe_make_dir(os.path.dirname(vcf_out))
+        command = self.mutect2_command(tumor_in, normal_in, shard_bed, vcf_out)
+        run_stage(self.state, 'call_mutect2_gatk', command,
+                  inputs=inputs, outputs=[vcf_out, vcf_out + '.stats'])
+
+    def merge_mutect2_gatk(self, vcfs_in, vcf_out):
+        '''Merge the MuTect2 shard VCFs and statistics of one sample'''
+        # Shard names are zero padded, so sorting restores the shard order
+        vcfs_in = sorted(vcfs_in)
+        command = 'gatk MergeVcfs {vcfs} -O {vcf_out} && ' \
+                  'gatk MergeMutectStats {stats} -O {vcf_out}.stats'.format(
+                      vcfs=' '.join('-I ' + vcf for vcf in vcfs_in),
+                      stats=' '.join('-stats {}.stats'.format(vcf) for vcf in vcfs_in),
+                      vcf_out=vcf_out)
+        run_stage(self.state, 'merge_mutect2_gatk', command,
+                  inputs=vcfs_in + [vcf + '.stats' for vcf in vcfs_in],
+                  outputs=[vcf_out, vcf_out + '.stats'])
+
+    def mutect2_command(self, tumor_in, normal_in, intervals, vcf_out):
+        '''Build the MuTect2 command for a tumour/normal pair over intervals,
+        as a function of the memory of the job in GB'''
+        # Imported here so that planning the pipeline does not load pysam
+        import pysam
         tumor_samfile = pysam.AlignmentFile(tumor_in, "rb")
         normal_samfile = pysam.AlignmentFile(normal_in, "rb")
         tumor_id = tumor_samfile.header['RG'][0]['SM']
         normal_id = normal_samfile.header['RG'][0]['SM']
         tumor_samfile.close()
         normal_samfile.close()
-        # safe_make_dir('variants/mutect2/{sample}'.format(sample=sample_id))
-        safe_make_dir('variants/mutect2/')
-        command = "gatk Mutect2 -R {reference} " \
+        # "--af-of-alleles-not-in-resource 0.00003125 " \
+        # The heap size follows the memory run_stage requests for the job,
+        # which grows if the job is resubmitted after running out of it
+        return lambda mem_in_gb: "gatk --java-options -Xmx{heap}g Mutect2 -R {reference} " \
             "-I {tumor_in} " \
             "-tumor {tumor_id} " \
             "-I {normal_in} " \
@@ -175,7 +378,7 @@ class Stages(object):
             "--germline-resource {mutect2_gnomad} " \
             "--af-of-alleles-not-in-resource 0.001 " \
             "-O {out} " \
-            "-L {gatk_bed} " \
+            "-L {intervals} " \
             "--max-reads-per-alignment-start 0 " \
             "--dont-use-soft-clipped-bases".format(reference=self.reference,
                         tumor_in=tumor_in,
@@ -183,33 +386,41 @@ class Stages(object):
                         tumor_id=tumor_id,
                         normal_id=normal_id,
                         mutect2_gnomad=self.mutect2_gnomad,
-                        gatk_bed=self.gatk_bed,
-                        out=vcf_out)
-        # "--af-of-alleles-not-in-resource 0.00003125 " \
-        run_stage(self.state, 'call_mutect2_gatk', command)
-
-    # multicov plots
-    def apply_multicov_plots(self, bam_in, multicov):
-        '''Generate multicov plots'''
-        walltime_hours = self.get_stage_options('apply_multicov_plots', 'walltime')
-        h, m = walltime_hours.split(':')
-        walltime = int(h) * 3600 + int(m) * 60
-        # safe_make_dir('variants')
-        # command = 'jupyter nbconvert --to html --execute coverage_analysis_main.ipynb ' \
-        #             '--ExecutePreprocessor.timeout={walltime}'.format(walltime=walltime)
-        command = 'jupyter nbconvert --to html coverage_analysis_main.ipynb ' \
-                    '--ExecutePreprocessor.timeout={walltime}'.format(walltime=walltime)
-        run_stage(self.state, 'apply_multicov_plots', command)
-
-    # summarize picard
-    def apply_summarize_picard(self, input, output):
-        '''Summarize picard coverage'''
-        input = input
-        # bams = ' '.join([bam for bam in bam_in])
-        # safe_make_dir('variants')
-        command = 'python coverage_summary.py > {output} '.format(
-                          output=output)
-        run_stage(self.state, 'apply_summarize_picard', command)
+                        intervals=intervals,
+                        out=vcf_out,
+                        heap=java_heap(mem_in_gb))
+
+    def coverage_bam(self, bam_in, amplicons_out):
+        '''Per-base and per-amplicon depth of a clipped BAM over the targets'''
+        cores = self.get_stage_options('coverage_bam', 'cores')
+        prefix = amplicons_out[:-len('.amplicons.npy')]
+        safe_make_dir(os.path.dirname(prefix))
+        command = '{python} {coverage} sample --bed {bed} --threads {cores} ' \
+                  '{bam_in} {prefix}'.format(
+                      python=sys.executable, coverage=COVERAGE_SCRIPT,
+                      bed=self.gatk_bed, cores=cores, bam_in=bam_in, prefix=prefix)
+        run_stage(self.state, 'coverage_bam', command,
+                  inputs=[bam_in, self.gatk_bed],
+                  outputs=[amplicons_out, prefix + '.depth.npy'])
+
+    def summarize_coverage(self, amplicons_in, matrix_out):
+        '''Cohort coverage matrix, summaries and plots from the per-sample
+        amplicon depths'''
+        prefix = matrix_out[:-len('.amplicon_depth.npy')]
+        # Amplicons below min_depth count as dropouts
+        min_depth = self.state.config.get_optional_stage_option(
+            'summarize_coverage', 'min_depth')
+        min_depth_arg = '--min_depth {} '.format(min_depth) if min_depth else ''
+        command = '{python} {coverage} cohort --bed {bed} {min_depth_arg}' \
+                  '{prefix} {amplicons}'.format(
+                      python=sys.executable, coverage=COVERAGE_SCRIPT,
+                      bed=self.gatk_bed, min_depth_arg=min_depth_arg,
+                      prefix=prefix, amplicons=' '.join(amplicons_in))
+        outputs = [matrix_out] + [prefix + suffix for suffix in (
+            '.samples.txt', '.amplicons.bed', '.sample_summary.tsv',
+            '.amplicon_summary.tsv', '.png')]
+        run_stage(self.state, 'summarize_coverage', command,
+                  inputs=list(amplicons_in) + [self.gatk_bed], outputs=outputs)
 
     def apply_vt(self, inputs, vcf_out):
         '''Apply NORM'''
@@ -219,13 +430,13 @@ class Stages(object):
                     "-o {vcf_out} - ".format(
                     vt_path=self.vt_path, vcf_in=vcf_in, vt_path2=self.vt_path, reference=self.reference,
                     vcf_out=vcf_out)
-        run_stage(self.state, 'apply_vt', vt_command)
+        run_stage(self.state, 'apply_vt', vt_command,
+                  inputs=[vcf_in], outputs=[vcf_out])
 
-    def apply_vep(self, inputs, vcf_out):
-        '''Apply VEP'''
-        vcf_in = inputs
-        cores = self.get_stage_options('apply_vep', 'cores')
-        vep_command = "{vep_path}/vep " \
+    def vep_command(self, vcf_in, vcf_out, cores):
+        '''Build the VEP command, reading vcf_in and writing vcf_out, either
+        of which may be STDIN or STDOUT'''
+        return "{vep_path}/vep " \
             "--cache " \
             "--refseq " \
             "--offline " \
@@ -248,9 +459,158 @@ class Stages(object):
             "--flag_pick " \
             "--plugin MaxEntScan,/vlsci/UOM0040/shared/km/programs/ensembl-vep/data/MaxEntScan/ " \
             "--plugin GeneSplicer,$GENE_SPLICER_PATH/bin/linux/genesplicer," \
-            "$GENE_SPLICER_PATH/human,context=100,tmpdir=/scratch/UOM0040/temp/".format(reference=self.reference,
+            "$GENE_SPLICER_PATH/human,context=100,tmpdir=${{TMPDIR:-/tmp}}/".format(reference=self.reference,
             vep_path=self.vep_path, vcf_in=vcf_in, vcf_out=vcf_out, vep_cache=self.vep_cache, threads=cores)
-        run_stage(self.state, 'apply_vep', vep_command)
+
+    def apply_vep(self, inputs, vcf_out):
+        '''Apply VEP'''
+        vcf_in = inputs
+        if self.all_cached(vcf_in):
+            self.skip_annotation('apply_vep', vcf_in, vcf_out)
+            return
+        cores = self.get_stage_options('apply_vep', 'cores')
+        vep_command = self.vep_command(vcf_in, vcf_out, cores)
+        run_stage(self.state, 'apply_vep', vep_command,
+                  inputs=[vcf_in], outputs=[vcf_out])
+
+    def annotate_vcf_fused(self, vcf_in, vcf_out):
+        '''Normalise a VCF with vt, annotate it with VEP and vcfanno, and
+        compress and index it, streaming through a single job instead of
+        apply_vt, apply_vep and apply_vcfanno'''
+        cores = self.get_stage_options('annotate_vcf_fused', 'cores')
+        # VEP names its summary after its output, which is STDOUT here
+        vep_stats = vcf_out[:-len('.vcf.gz')] + '.vep_summary.html'
+        command = '{vt_path} decompose -s {vcf_in} - ' \
+                  '| {vt_path} normalize -r {reference} - ' \
+                  '| {vep} --stats_file {vep_stats} ' \
+                  '| {vcfanno} -lua {annolua} {anno} /dev/stdin ' \
+                  '| bgzip -c > {vcf_out} && tabix -p vcf {vcf_out}'.format(
+                      vt_path=self.vt_path, vcf_in=vcf_in, reference=self.reference,
+                      vep=self.vep_command('STDIN', 'STDOUT', cores),
+                      vep_stats=vep_stats, vcfanno=self.vcfanno,
+                      annolua=self.annolua, anno=self.anno, vcf_out=vcf_out)
+        # A failure anywhere in the pipe must fail the job, not just one of
+        # bgzip or tabix
+        run_stage(self.state, 'annotate_vcf_fused',
+                  'bash -o pipefail -c ' + quote(command),
+                  inputs=[vcf_in, self.anno, self.annolua],
+                  outputs=[vcf_out, vcf_out + '.tbi'])
+
+    @in_process
+    def split_vep_chunks(self, vcf_in, chunks_out, chunk_prefix):
+        '''Split a normalised VCF into chunks for parallel VEP annotation'''
+        # Remove chunks (and their annotations) left over from earlier runs,
+        # which may have been split differently
+        removed = []
+        for chunk in chunks_out:
+            os.remove(chunk)
+            removed.append(chunk)
+            annotated_chunk = chunk[:-len('.vt.vcf')] + '.vt.vep.vcf'
+            if os.path.exists(annotated_chunk):
+                os.remove(annotated_chunk)
+                removed.append(annotated_chunk)
+        safe_make_dir(os.path.dirname(chunk_prefix))
+        chunk_size = self.get_stage_options('apply_vep', 'chunk_size')
+        written = split_vcf(vcf_in, chunk_prefix, chunk_size)
+        record_outputs(self.state, removed + written)
+
+    @in_process
+    def merge_vep_chunks(self, vcfs_in, vcf_out):
+        '''Merge the VEP annotated chunks of a sample in coordinate order'''
+        # Chunk names are zero padded, so sorting restores the chunk order
+        merge_vcfs(sorted(vcfs_in), vcf_out)
+        record_outputs(self.state, [vcf_out])
+
+    def annotation_cache(self):
+        '''Open the cross-run annotation cache for the configured VEP and
+        vcfanno versions'''
+        config = self.state.config
+        vep_version = str(config.get_option('vep_version'))
+        anno_hash = file_digest(self.anno, self.annolua)
+        max_entries = config.get_optional_option('anno_cache_max_entries',
+            DEFAULT_MAX_ENTRIES)
+        return AnnotationCache(config.get_option('anno_cache'), vep_version,
+            anno_hash, max_entries)
+
+    def all_cached(self, vcf_in):
+        '''Whether every record of a VCF was found in the annotation cache,
+        leaving none for VEP or vcfanno'''
+        return bool(self.state.config.get_optional_option('anno_cache')) and \
+            not has_records(vcf_in)
+
+    def skip_annotation(self, stage, vcf_in, vcf_out):
+        '''Pass a VCF without records through in place of a job of the
+        annotation stage; merge_anno_cache adds the cached header lines'''
+        # Counted as a job of the stage, so that the metrics and priorities
+        # of the run still see the sample through it
+        with tracked_job(self.state, stage, [vcf_in], [vcf_out]) as start:
+            start()
+            header, records = read_vcf(vcf_in)
+            write_vcf(vcf_out, header, records)
+        record_outputs(self.state, [vcf_out])
+        record_finished(self.state, stage, [vcf_in], [vcf_out])
+
+    @in_process
+    def lookup_anno_cache(self, vcf_in, vcf_out):
+        '''Separate the normalised records with cached annotations'''
+        # Records found in the cache are written with their annotation to
+        # the .cached.vcf file, the rest to the output for VEP and vcfanno
+        cached_out = vcf_out[:-len('.uncached.vcf')] + '.cached.vcf'
+        header, records = read_vcf(vcf_in)
+        cache = self.annotation_cache()
+        try:
+            found = cache.lookup([record_key(record) for record in records])
+            annotation_header = cache.header_lines()
+            totals = cache.counters()
+        finally:
+            cache.close()
+        cached = [with_annotation(record, found[record_key(record)])
+                  for record in records if record_key(record) in found]
+        uncached = [record for record in records if record_key(record) not in found]
+        write_vcf(cached_out, add_header_lines(header, annotation_header), cached)
+        write_vcf(vcf_out, header, uncached)
+        record_outputs(self.state, [vcf_out, cached_out])
+        self.state.logger.info('Annotation cache {}: {} hits, {} misses '
+            '(all runs: {} hits, {} misses, {} evictions)'.format(
+                vcf_in, len(cached), len(uncached), totals.get('hits', 0),
+                totals.get('misses', 0), totals.get('evictions', 0)))
+
+    @in_process
+    def merge_anno_cache(self, inputs, vcf_out):
+        '''Merge newly annotated and cached records, caching the new ones'''
+        annotated_in, uncached_in, cached_in = inputs
+        annotated_header, annotated = read_vcf(annotated_in)
+        uncached_header, uncached = read_vcf(uncached_in)
+        cached_header, cached = read_vcf(cached_in)
+        originals = dict((record_key(record), record) for record in uncached)
+        annotations = dict((record_key(record),
+                            added_annotation(originals[record_key(record)], record))
+                           for record in annotated if record_key(record) in originals)
+        # Only INFO definitions are cached; other added header lines, such
+        # as the VEP command line, are specific to one sample
+        added_info = [line for line in annotated_header
+                      if line.startswith('##INFO=') and line not in uncached_header]
+        header = add_header_lines(annotated_header, cached_header[:-1])
+        write_vcf(vcf_out, header, sort_records(header, annotated + cached))
+        record_outputs(self.state, [vcf_out])
+        cache = self.annotation_cache()
+        try:
+            cache.store(annotations)
+            cache.store_header(added_info)
+        finally:
+            cache.close()
+
+    def build_cohort_store(self, vcfs_in, manifest_out):
+        '''Add the samples whose annotated VCFs are new or changed to the
+        columnar cohort variant store'''
+        store = os.path.dirname(manifest_out)
+        command = '{python} {cohort_store} add {store} {vcfs}'.format(
+            python=sys.executable, cohort_store=COHORT_STORE_SCRIPT,
+            store=store, vcfs=' '.join(sorted(vcfs_in)))
+        # The store is updated in place rather than rewritten, so its
+        # manifest must never be restored from the result cache
+        run_stage(self.state, 'build_cohort_store', command,
+                  outputs=[manifest_out])
 
     def apply_bcf(self, inputs, vcf_out):
         '''Apply BCF'''
@@ -258,41 +618,48 @@ class Stages(object):
         cores = self.get_stage_options('apply_bcf', 'cores')
         command = "bcftools filter -e \"ALT='*'\" {vcf_in} > {vcf_out}".format(cores=cores,
                             vcf_in=vcf_in, vcf_out=vcf_out)
-        run_stage(self.state, 'apply_bcf', command)
+        run_stage(self.state, 'apply_bcf', command,
+                  inputs=[vcf_in], outputs=[vcf_out])
 
     def apply_snpeff(self, inputs, vcf_out):
         '''Apply SnpEFF'''
         vcf_in = inputs
         #cores = self.get_stage_options('apply_snpeff', 'cores')  apply_snpeff
-        # mem = int(self.state.config.get_stage_options(stage, 'mem'))
-        mem = int(self.get_stage_options('apply_snpeff', 'mem')) - 2
-        snpeff_command = "java -Xmx{mem}g -jar {snpeff_path} eff -c {snpeff_conf} " \
-                    "-canon GRCh37.75 {vcf_in} | bgzip -c > {vcf_out}".format(
-                    mem=mem, snpeff_path=self.snpeff_path, snpeff_conf=self.snpeff_conf,
-                    vcf_in=vcf_in, vcf_out=vcf_out)
-        run_stage(self.state, 'apply_snpeff', snpeff_command)
+        snpeff_args = "eff -c {snpeff_conf} -canon GRCh37.75 {vcf_in}".format(
+                    snpeff_conf=self.snpeff_conf, vcf_in=vcf_in)
+        snpeff_command = lambda mem_in_gb: "{java} | bgzip -c > {vcf_out}".format(
+                    java=java_command(self.snpeff_path, mem_in_gb, snpeff_args),
+                    vcf_out=vcf_out)
+        run_stage(self.state, 'apply_snpeff', snpeff_command,
+                  inputs=[vcf_in], outputs=[vcf_out])
         #run_snpeff(self.state, 'apply_snpeff', snpeff_command)
 
     def apply_vcfanno(self, inputs, vcf_out):
         '''Apply anno'''
         vcf_in = inputs
+        if self.all_cached(vcf_in):
+            self.skip_annotation('apply_vcfanno', vcf_in, vcf_out)
+            return
         #cores = self.get_stage_options('apply_snpeff', 'cores')
         anno_command = "{vcfanno} -lua {annolua} {anno} {vcf_in} > {vcf_out}".format(
                     vcfanno=self.vcfanno, annolua=self.annolua, anno=self.anno, vcf_in=vcf_in, vcf_out=vcf_out)
-        run_stage(self.state, 'apply_vcfanno', anno_command)
+        run_stage(self.state, 'apply_vcfanno', anno_command,
+                  inputs=[vcf_in, self.anno, self.annolua], outputs=[vcf_out])
 
     def apply_cat_vcf(self, inputs, vcf_out):
         '''Concatenate and sort undr_rover VCF files for downstream analysis'''
         vcfs = ' '.join([vcf for vcf in inputs])
         # safe_make_dir('variants')
         command = 'vcf-concat {vcfs} | vcf-sort -c | bgzip -c > {vcf_out} '.format(vcfs=vcfs,vcf_out=vcf_out)
-        run_stage(self.state, 'apply_cat_vcf', command)
+        run_stage(self.state, 'apply_cat_vcf', command,
+                  inputs=list(inputs), outputs=[vcf_out])
 
     def apply_tabix(self, input, vcf_out):
         '''bgzip the vcf file in prepartion for bcftools annotation'''
         vcf = input
         command = "tabix -p vcf {vcf}".format(vcf=vcf)
-        run_stage(self.state, 'apply_tabix', command)
+        run_stage(self.state, 'apply_tabix', command,
+                  inputs=[vcf], outputs=[vcf_out])
 
     def apply_homopolymer_ann(self, inputs, vcf_out):
         '''Apply HomopolymerRun annotation to undr_rover output'''
@@ -302,7 +669,8 @@ class Stages(object):
                     "bcftools annotate -a {hrfile} -c CHROM,FROM,TO,HRUN " \
                     "-h header.tmp " \
                     "{vcf_in} > {vcf_out}".format(hrfile=self.hrfile,vcf_in=vcf_in,vcf_out=vcf_out)
-        run_stage(self.state, 'apply_cat_vcf', command)
+        run_stage(self.state, 'apply_cat_vcf', command,
+                  inputs=[vcf_in, self.hrfile], outputs=[vcf_out])
 
     # def apply_cat_vcf(self, inputs, vcf_out):
     #     '''Concatenate and sort undr_rover VCF files for downstream analysis'''
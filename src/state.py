@@ -4,8 +4,17 @@ Global state of the pipeline:
     - config: the parsed contents of the pipeline configuration file
     - logger: the concurrency friendly logging facility
     - drmaa_session: the DRMAA session for running jobs on the cluster
+    - local_pool: the cores and memory available to stages run locally
+    - job_monitor: submits cluster jobs and tracks them from a single thread
+    - file_index: the persistent state of pipeline files, if configured
+    - prioritizer: the critical path priorities of jobs, if configured
+    - metrics: live counts of the jobs of each stage, if configured
 '''
 
 from collections import namedtuple
 
-State = namedtuple("State", ["options", "config", "logger", "drmaa_session"])
+State = namedtuple("State", ["options", "config", "logger", "drmaa_session",
+                             "local_pool", "job_monitor", "file_index",
+                             "prioritizer", "metrics"])
+# Fields after drmaa_session are optional
+State.__new__.__defaults__ = (None, None, None, None, None)
@@ -0,0 +1,295 @@
+'''
+Per-job resource telemetry, kept in a local SQLite database.
+
+Telemetry is off unless the pipeline is given --telemetry. The scheduler
+already accounts for the resources of cluster jobs, so for jobs submitted
+through the job monitor the start time, wall time, CPU time and maximum
+resident set size come from the resource usage in their DRMAA JobInfo. Jobs
+run locally, or bundled with others into one cluster job, are instead
+wrapped in /usr/bin/time, which appends the same to a small file next to
+the job scripts, between the time the command started and its exit status.
+Once the job has finished run_stage records these, together with the time
+the job was submitted (giving the queue wait), the requested resources and
+the sizes of the input and output files, keyed by pipeline id, stage and
+sample.
+
+The "telemetry" subcommand of the pipeline summarises the database per
+stage and lists the slowest samples.
+'''
+
+from __future__ import print_function
+import argparse
+import os
+import sqlite3
+import tempfile
+import time
+
+try:
+    from shlex import quote
+except ImportError:
+    from pipes import quote
+
+# Default location of the telemetry database
+DEFAULT_TELEMETRY_DB = 'telemetry.sqlite'
+# Seconds to wait for other pipeline jobs holding the database lock
+LOCK_TIMEOUT = 600
+# Fields written by /usr/bin/time: wall, user and system seconds, maximum
+# resident set size in KB and exit status
+TIME_FORMAT = 'time %e %U %S %M %x'
+# Keys of the resource usage of a DRMAA JobInfo, which differ between
+# DRMAA libraries (SGE's first, where "mem" is not a size, then those built
+# on drmaa-utils, such as slurm-drmaa): times in seconds, memory in KB
+USAGE_START = ('start_time',)
+USAGE_END = ('end_time',)
+USAGE_WALL_TIME = ('ru_wallclock', 'walltime')
+USAGE_CPU_TIME = ('cpu',)
+USAGE_MAX_RSS_KB = ('ru_maxrss', 'mem')
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS jobs (
+    pipeline_id TEXT,
+    stage TEXT,
+    sample TEXT,
+    job_name TEXT,
+    local INTEGER,
+    cores INTEGER,
+    mem_requested_gb REAL,
+    walltime_requested TEXT,
+    submitted REAL,
+    started REAL,
+    finished REAL,
+    queue_wait REAL,
+    wall_time REAL,
+    cpu_time REAL,
+    max_rss_kb INTEGER,
+    exit_status INTEGER,
+    input_bytes INTEGER,
+    output_bytes INTEGER
+)
+'''
+
+
+def connect(db_path):
+    connection = sqlite3.connect(db_path, timeout=LOCK_TIMEOUT)
+    with connection:
+        connection.execute(SCHEMA)
+        connection.execute('CREATE INDEX IF NOT EXISTS jobs_stage '
+                           'ON jobs (pipeline_id, stage)')
+    return connection
+
+
+def sample_name(paths):
+    '''Name of the sample a job works on, taken from the file name of its
+    first output (or input), up to the first dot.
+    '''
+    for path in paths:
+        return os.path.basename(path).split('.')[0]
+    return None
+
+
+def total_bytes(paths):
+    '''Total size of the files in paths that exist'''
+    return sum(os.path.getsize(path) for path in paths if os.path.exists(path))
+
+
+def new_time_file(directory, job_name):
+    '''Create an empty file to receive the timings of a job'''
+    directory = os.path.join(directory, 'telemetry')
+    try:
+        os.makedirs(directory)
+    except OSError:
+        # Already exists, possibly created by another job
+        pass
+    handle, path = tempfile.mkstemp(prefix=job_name + '_', suffix='.time',
+                                    dir=directory)
+    os.close(handle)
+    return os.path.abspath(path)
+
+
+def timed_command(command, time_file):
+    '''Wrap a shell command so that its start time and resource usage are
+    written to time_file. Nodes without /usr/bin/time still record the
+    start time and exit status. The exit status of the command is preserved.
+    '''
+    return 'echo "start $(date +%s.%N)" > {time_file}\n' \
+           'if [ -x /usr/bin/time ]; then ' \
+           '/usr/bin/time -a -o {time_file} -f {time_format} sh -c {command}; ' \
+           'else sh -c {command}; fi\n' \
+           'status=$?\n' \
+           'echo "exit $status" >> {time_file}\n' \
+           'exit $status'.format(
+               time_file=time_file, time_format=quote(TIME_FORMAT),
+               command=quote(command))
+
+
+def read_time_file(time_file):
+    '''Parse a time file written by a command wrapped by timed_command'''
+    timings = {}
+    try:
+        with open(time_file) as handle:
+            for line in handle:
+                fields = line.split()
+                if fields and fields[0] == 'start':
+                    timings['started'] = float(fields[1])
+                elif fields and fields[0] == 'time' and len(fields) == 6:
+                    timings['wall_time'] = float(fields[1])
+                    timings['cpu_time'] = float(fields[2]) + float(fields[3])
+                    timings['max_rss_kb'] = int(fields[4])
+                elif fields and fields[0] == 'exit':
+                    timings['exit_status'] = int(fields[1])
+    except IOError:
+        # The job never started, or was killed before writing anything
+        pass
+    return timings
+
+
+def usage_value(usage, keys):
+    '''The first of keys in a DRMAA resource usage that holds a number'''
+    for key in keys:
+        try:
+            return float(usage[key])
+        except (KeyError, TypeError, ValueError):
+            pass
+    return None
+
+
+def read_job_info(job_info):
+    '''Timings of a cluster job from its DRMAA JobInfo, in the form of
+    read_time_file'''
+    timings = {}
+    if job_info is None:
+        # The outcome of the job is unknown
+        return timings
+    usage = job_info.resourceUsage or {}
+    started = usage_value(usage, USAGE_START)
+    ended = usage_value(usage, USAGE_END)
+    wall_time = usage_value(usage, USAGE_WALL_TIME)
+    if wall_time is None and started and ended:
+        wall_time = ended - started
+    cpu_time = usage_value(usage, USAGE_CPU_TIME)
+    max_rss_kb = usage_value(usage, USAGE_MAX_RSS_KB)
+    # Schedulers report zero for what they did not measure
+    if started:
+        timings['started'] = started
+    if wall_time is not None:
+        timings['wall_time'] = wall_time
+    if cpu_time is not None:
+        timings['cpu_time'] = cpu_time
+    if max_rss_kb:
+        timings['max_rss_kb'] = int(max_rss_kb)
+    if job_info.hasExited:
+        timings['exit_status'] = job_info.exitStatus
+    return timings
+
+
+def record_job(db_path, pipeline_id, stage, job_name, resources, submitted,
+               time_file, inputs, outputs, job_info=None):
+    '''Record the telemetry of a finished (or failed) job, from its time
+    file if it was run by timed_command, or else from its DRMAA JobInfo'''
+    if time_file is not None:
+        timings = read_time_file(time_file)
+    else:
+        timings = read_job_info(job_info)
+    started = timings.get('started')
+    finished = time.time()
+    if started and 'wall_time' not in timings and 'exit_status' in timings:
+        # Ran without /usr/bin/time: approximate the wall time
+        timings['wall_time'] = finished - started
+    inputs, outputs = list(inputs or []), list(outputs or [])
+    row = dict(pipeline_id=pipeline_id,
+               stage=stage,
+               sample=sample_name(outputs + inputs),
+               job_name=job_name,
+               local=int(bool(resources.get('local'))),
+               cores=resources.get('cores'),
+               mem_requested_gb=resources.get('mem'),
+               walltime_requested=resources.get('walltime'),
+               submitted=submitted,
+               started=started,
+               finished=finished,
+               queue_wait=(started - submitted) if started else None,
+               wall_time=timings.get('wall_time'),
+               cpu_time=timings.get('cpu_time'),
+               max_rss_kb=timings.get('max_rss_kb'),
+               exit_status=timings.get('exit_status'),
+               input_bytes=total_bytes(inputs),
+               output_bytes=total_bytes(outputs))
+    columns = sorted(row)
+    connection = connect(db_path)
+    try:
+        with connection:
+            connection.execute(
+                'INSERT INTO jobs ({}) VALUES ({})'.format(
+                    ', '.join(columns), ', '.join('?' for _ in columns)),
+                [row[column] for column in columns])
+    finally:
+        connection.close()
+    if time_file is not None:
+        try:
+            os.remove(time_file)
+        except OSError:
+            pass
+
+
+def stage_summaries(connection, pipeline_id=None):
+    '''Per-stage job counts, failures and resource usage'''
+    return connection.execute(
+        'SELECT stage, COUNT(*), '
+        'SUM(CASE WHEN exit_status IS NULL OR exit_status != 0 THEN 1 ELSE 0 END), '
+        'AVG(wall_time), MAX(wall_time), SUM(cpu_time) / 3600.0, '
+        'MAX(max_rss_kb) / 1048576.0, MAX(mem_requested_gb), AVG(queue_wait) '
+        'FROM jobs WHERE ? IS NULL OR pipeline_id = ? '
+        'GROUP BY stage ORDER BY SUM(wall_time) DESC',
+        (pipeline_id, pipeline_id)).fetchall()
+
+
+def slowest_samples(connection, pipeline_id=None, limit=10):
+    '''Samples with the largest total wall time over all their jobs'''
+    return connection.execute(
+        'SELECT sample, COUNT(*), SUM(wall_time), SUM(queue_wait) '
+        'FROM jobs WHERE ? IS NULL OR pipeline_id = ? '
+        'GROUP BY sample ORDER BY SUM(wall_time) DESC LIMIT ?',
+        (pipeline_id, pipeline_id, limit)).fetchall()
+
+
+def format_number(value, template='{:.1f}'):
+    return '-' if value is None else template.format(value)
+
+
+def print_report(connection, pipeline_id=None, limit=10):
+    '''Print per-stage summaries and the slowest samples'''
+    print('{:<28} {:>6} {:>6} {:>10} {:>10} {:>10} {:>9} {:>9} {:>10}'.format(
+        'stage', 'jobs', 'failed', 'mean wall', 'max wall', 'cpu hours',
+        'max rss', 'mem req', 'mean wait'))
+    for (stage, jobs, failed, mean_wall, max_wall, cpu_hours, max_rss,
+         mem_requested, mean_wait) in stage_summaries(connection, pipeline_id):
+        print('{:<28} {:>6} {:>6} {:>10} {:>10} {:>10} {:>9} {:>9} {:>10}'.format(
+            stage, jobs, failed, format_number(mean_wall),
+            format_number(max_wall), format_number(cpu_hours, '{:.2f}'),
+            format_number(max_rss, '{:.2f}G'),
+            format_number(mem_requested, '{:.0f}G'), format_number(mean_wait)))
+    print('')
+    print('{:<28} {:>6} {:>12} {:>12}'.format(
+        'slowest samples', 'jobs', 'total wall', 'total wait'))
+    for sample, jobs, total_wall, total_wait in \
+            slowest_samples(connection, pipeline_id, limit):
+        print('{:<28} {:>6} {:>12} {:>12}'.format(
+            sample, jobs, format_number(total_wall), format_number(total_wait)))
+
+
+def report_main(args):
+    '''Entry point of the "telemetry" subcommand'''
+    parser = argparse.ArgumentParser(prog='hiplexpipe_somatic telemetry',
+        description='Summarise the resource telemetry of pipeline jobs')
+    parser.add_argument('--db', type=str, default=DEFAULT_TELEMETRY_DB,
+        help='Telemetry database, defaults to {}'.format(DEFAULT_TELEMETRY_DB))
+    parser.add_argument('--pipeline_id', type=str, default=None,
+        help='Only report jobs of this pipeline id')
+    parser.add_argument('--slowest', type=int, default=10,
+        help='Number of slowest samples to list, defaults to 10')
+    options = parser.parse_args(args)
+    connection = connect(options.db)
+    try:
+        print_report(connection, options.pipeline_id, options.slowest)
+    finally:
+        connection.close()
@@ -0,0 +1,111 @@
+'''
+Plain text VCF reading, splitting and merging.
+
+These helpers work on the text of the VCF records and never parse INFO
+fields, so they are cheap enough to run inside the pipeline process.
+'''
+
+import os
+
+
+def read_vcf(vcf_path):
+    '''Read a VCF file, returning its header lines and record lines'''
+    header, records = [], []
+    with open(vcf_path) as vcf_file:
+        for line in vcf_file:
+            if line.startswith('#'):
+                header.append(line)
+            else:
+                records.append(line)
+    return header, records
+
+
+def has_records(vcf_path):
+    '''Whether a VCF file has any record lines after its header'''
+    with open(vcf_path) as vcf_file:
+        for line in vcf_file:
+            if not line.startswith('#'):
+                return True
+    return False
+
+
+def contig_order(header):
+    '''Map contig names to their position in the ##contig header lines'''
+    order = {}
+    for line in header:
+        if line.startswith('##contig=<'):
+            for field in line[len('##contig=<'):].rstrip('>\n').split(','):
+                if field.startswith('ID='):
+                    order.setdefault(field[len('ID='):], len(order))
+    return order
+
+
+def sort_records(header, records):
+    '''Sort record lines into coordinate order. Contigs are ordered as in
+    the header, or by first appearance when the header does not list them.
+    The sort is stable, so records at the same position keep their order.
+    '''
+    order = contig_order(header)
+
+    def coordinate(record):
+        chrom, pos = record.split('\t', 2)[:2]
+        return (order.setdefault(chrom, len(order)), int(pos))
+
+    return sorted(records, key=coordinate)
+
+
+def chunk_paths(prefix, num_chunks):
+    '''File names of the chunks of a split VCF, in chunk order'''
+    return ['{}.chunk_{:04d}.vt.vcf'.format(prefix, chunk)
+            for chunk in range(num_chunks)]
+
+
+def split_vcf(vcf_path, prefix, records_per_chunk):
+    '''Split a VCF into files of at most records_per_chunk records, each
+    with the full header. A VCF without records gives one header-only chunk.
+    Returns the chunk file names in order.
+    '''
+    header, records = read_vcf(vcf_path)
+    starts = range(0, len(records), records_per_chunk) or [0]
+    paths = chunk_paths(prefix, len(starts))
+    for path, start in zip(paths, starts):
+        with open(path, 'w') as chunk_file:
+            chunk_file.writelines(header)
+            chunk_file.writelines(records[start:start + records_per_chunk])
+    return paths
+
+
+def merge_vcfs(vcf_paths, vcf_out):
+    '''Concatenate VCFs that share a header into vcf_out in coordinate
+    order. The header is taken from the first file.
+    '''
+    header, records = None, []
+    for vcf_path in vcf_paths:
+        this_header, these_records = read_vcf(vcf_path)
+        if header is None:
+            header = this_header
+        records.extend(these_records)
+    header = header or []
+    write_vcf(vcf_out, header, sort_records(header, records))
+
+
+def write_vcf(vcf_out, header, records):
+    '''Write header and record lines to vcf_out. The output is only put in
+    place once it is complete, so an interrupted write never looks up to
+    date.
+    '''
+    tmp_out = vcf_out + '.tmp'
+    with open(tmp_out, 'w') as out_file:
+        out_file.writelines(header)
+        out_file.writelines(records)
+    os.rename(tmp_out, vcf_out)
+
+
+def add_header_lines(header, lines):
+    '''Insert the meta-information lines not already in header before its
+    #CHROM line'''
+    present = set(header)
+    new_lines = [line for line in lines if line not in present]
+    if header and header[-1].startswith('#CHROM'):
+        return header[:-1] + new_lines + header[-1:]
+    return header + new_lines
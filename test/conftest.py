@@ -0,0 +1,10 @@
+'''
+The pipeline modules import each other as top level modules, as they do
+when main.py runs from src, so the tests import them the same way.
+'''
+
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir, 'src'))
@@ -0,0 +1,91 @@
+'''Tests of the cross-run cache of variant annotations'''
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from annotation_cache import (AnnotationCache, added_annotation,
+                              record_key, with_annotation)
+
+RECORD = '1\t100\t.\tA\tT\t50\tPASS\tDP=20\n'
+ANNOTATED = '1\t100\t.\tA\tT\t50\tPASS\tDP=20;CSQ=missense;gnomAD=0.01\n'
+
+
+class RecordTest(unittest.TestCase):
+    def test_record_key(self):
+        self.assertEqual(record_key(RECORD), ('1', 100, 'A', 'T'))
+
+    def test_added_annotation(self):
+        self.assertEqual(added_annotation(RECORD, ANNOTATED),
+                         'CSQ=missense;gnomAD=0.01')
+
+    def test_with_annotation_restores_the_annotated_record(self):
+        self.assertEqual(with_annotation(RECORD, 'CSQ=missense;gnomAD=0.01'),
+                         ANNOTATED)
+        self.assertEqual(with_annotation(RECORD, ''), RECORD)
+
+    def test_with_annotation_of_empty_info(self):
+        record = '1\t100\t.\tA\tT\t50\tPASS\t.\n'
+        self.assertEqual(with_annotation(record, 'CSQ=missense'),
+                         '1\t100\t.\tA\tT\t50\tPASS\tCSQ=missense\n')
+
+
+class AnnotationCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'cache.sqlite')
+        self.caches = []
+
+    def tearDown(self):
+        for cache in self.caches:
+            cache.close()
+        shutil.rmtree(self.directory)
+
+    def cache(self, vep_version='92', anno_hash='abc', max_entries=100):
+        cache = AnnotationCache(self.path, vep_version, anno_hash, max_entries)
+        self.caches.append(cache)
+        return cache
+
+    def test_store_then_lookup(self):
+        self.cache().store({('1', 100, 'A', 'T'): 'CSQ=missense'})
+        self.assertEqual(
+            self.cache().lookup([('1', 100, 'A', 'T'), ('1', 100, 'A', 'G')]),
+            {('1', 100, 'A', 'T'): 'CSQ=missense'})
+
+    def test_keyed_by_vep_version_and_anno_hash(self):
+        self.cache().store({('1', 100, 'A', 'T'): 'CSQ=missense'})
+        key = [('1', 100, 'A', 'T')]
+        self.assertEqual(self.cache(vep_version='93').lookup(key), {})
+        self.assertEqual(self.cache(anno_hash='def').lookup(key), {})
+
+    def test_counters(self):
+        cache = self.cache()
+        cache.store({('1', 100, 'A', 'T'): 'CSQ=missense'})
+        cache.lookup([('1', 100, 'A', 'T'), ('1', 200, 'C', 'G')])
+        cache.lookup([('1', 100, 'A', 'T')])
+        self.assertEqual(cache.counters(), {'hits': 2, 'misses': 1})
+
+    def test_evicts_least_recently_used(self):
+        cache = self.cache(max_entries=2)
+        first, second, third = [('1', pos, 'A', 'T') for pos in (1, 2, 3)]
+        cache.store({first: 'CSQ=first'})
+        cache.store({second: 'CSQ=second'})
+        # Using the first allele makes the second the least recently used
+        cache.lookup([first])
+        cache.store({third: 'CSQ=third'})
+        self.assertEqual(sorted(cache.lookup([first, second, third])),
+                         [first, third])
+        self.assertEqual(cache.counters()['evictions'], 1)
+
+    def test_header_lines(self):
+        lines = ['##INFO=<ID=CSQ>\n', '##INFO=<ID=gnomAD>\n']
+        cache = self.cache()
+        cache.store_header(lines)
+        cache.store_header(lines[:1])
+        self.assertEqual(cache.header_lines(), lines)
+        self.assertEqual(self.cache(vep_version='93').header_lines(), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
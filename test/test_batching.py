@@ -0,0 +1,58 @@
+'''Tests of the grouping of jobs submitted by several threads'''
+
+import threading
+import unittest
+
+from batching import Batcher
+
+
+def add_in_threads(batcher, items, window, max_size):
+    '''Add each (key, item) from a thread of its own, and return the result
+    or exception of each'''
+    outcomes = [None] * len(items)
+
+    def add(index, key, item):
+        try:
+            outcomes[index] = batcher.add(key, item, window, max_size)
+        except Exception as error:
+            outcomes[index] = error
+    threads = [threading.Thread(target=add, args=(index, key, item))
+               for index, (key, item) in enumerate(items)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return outcomes
+
+
+class BatcherTest(unittest.TestCase):
+    def test_full_batch_is_flushed_once(self):
+        flushes = []
+
+        def flush(key, items):
+            flushes.append((key, sorted(items)))
+            return [item * 10 for item in items]
+        outcomes = add_in_threads(Batcher(flush), [('a', 1), ('a', 2)], 60, 2)
+        self.assertEqual(outcomes, [10, 20])
+        self.assertEqual(flushes, [('a', [1, 2])])
+
+    def test_keys_are_batched_apart(self):
+        flushes = []
+
+        def flush(key, items):
+            flushes.append((key, items))
+            return items
+        outcomes = add_in_threads(Batcher(flush), [('a', 1), ('b', 2)], 0.1, 10)
+        self.assertEqual(outcomes, [1, 2])
+        self.assertEqual(sorted(flushes), [('a', [1]), ('b', [2])])
+
+    def test_flush_error_reaches_every_item(self):
+        def flush(key, items):
+            raise ValueError('submission failed')
+        outcomes = add_in_threads(Batcher(flush), [('a', 1), ('a', 2)], 60, 2)
+        for outcome in outcomes:
+            self.assertIsInstance(outcome, ValueError)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,104 @@
+'''Tests of the classification of failed jobs'''
+
+import os
+import shutil
+import signal
+import tempfile
+import unittest
+
+from failures import classify, OUT_OF_MEMORY, TIMEOUT, NODE_FAILURE, \
+    KILLED, TOOL_ERROR, INFRASTRUCTURE_FAILURES
+
+
+class JobInfo(object):
+    '''The fields of a DRMAA JobInfo that classify reads'''
+    def __init__(self, wasAborted=False, hasSignal=False, terminatedSignal=None,
+                 hasExited=True, exitStatus=1):
+        self.wasAborted = wasAborted
+        self.hasSignal = hasSignal
+        self.terminatedSignal = terminatedSignal
+        self.hasExited = hasExited
+        self.exitStatus = exitStatus
+
+
+class Failure(Exception):
+    '''A failed job, with what job_monitor.JobFailed carries'''
+    def __init__(self, job_info=None, stderr=None, scheduler_stderr=None):
+        super(Failure, self).__init__('job failed')
+        self.job_info = job_info
+        self.stderr = stderr
+        self.scheduler_stderr = scheduler_stderr
+
+
+class ClassifyTest(unittest.TestCase):
+    def test_tool_error(self):
+        self.assertEqual(classify(Failure(JobInfo()), ['[E::bwa] fail\n']),
+                         TOOL_ERROR)
+        self.assertNotIn(TOOL_ERROR, INFRASTRUCTURE_FAILURES)
+
+    def test_error_without_job_info(self):
+        self.assertEqual(classify(Exception('failed')), TOOL_ERROR)
+
+    def test_messages(self):
+        messages = [
+            ('slurmstepd: error: *** JOB 12 CANCELLED AT 10:00 DUE TO TIME '
+             'LIMIT ***', TIMEOUT),
+            ('slurmstepd: error: Detected 1 oom-kill event(s)', OUT_OF_MEMORY),
+            ('Exception in thread "main" java.lang.OutOfMemoryError: Java '
+             'heap space', OUT_OF_MEMORY),
+            ("terminate called after throwing an instance of 'std::bad_alloc'",
+             OUT_OF_MEMORY),
+            ('*** JOB 12 CANCELLED AT 10:00 DUE TO NODE FAILURE ***',
+             NODE_FAILURE),
+        ]
+        for message, kind in messages:
+            self.assertEqual(classify(Failure(JobInfo()), [message]), kind)
+            self.assertEqual(classify(Exception(), [message]), kind)
+
+    def test_time_limit_before_memory(self):
+        lines = ['DUE TO TIME LIMIT', 'Cannot allocate memory']
+        self.assertEqual(classify(Failure(JobInfo()), lines), TIMEOUT)
+
+    def test_drmaa_stderr(self):
+        error = Failure(JobInfo(), stderr=['Exceeded job memory limit\n'])
+        self.assertEqual(classify(error), OUT_OF_MEMORY)
+
+    def test_aborted(self):
+        self.assertEqual(classify(Failure(JobInfo(wasAborted=True))), NODE_FAILURE)
+
+    def test_signals(self):
+        self.assertEqual(classify(Failure(JobInfo(
+            hasSignal=True, terminatedSignal='SIGXCPU'))), TIMEOUT)
+        self.assertEqual(classify(Failure(JobInfo(
+            hasSignal=True, terminatedSignal='SIGKILL'))), KILLED)
+        self.assertEqual(classify(Failure(JobInfo(
+            hasSignal=True, terminatedSignal=signal.SIGKILL))), KILLED)
+
+    def test_killed_shell(self):
+        self.assertEqual(classify(Failure(JobInfo(exitStatus=137))), KILLED)
+        self.assertIn(KILLED, INFRASTRUCTURE_FAILURES)
+
+
+class SchedulerStderrTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_scheduler_stderr(self):
+        stderr = os.path.join(self.directory, 'array.1.stderr')
+        with open(stderr, 'w') as stderr_file:
+            stderr_file.write('slurmstepd: error: *** JOB 12.1 ON node3 '
+                              'CANCELLED AT 10:00 DUE TO TIME LIMIT ***\n')
+        self.assertEqual(classify(Failure(JobInfo(), scheduler_stderr=stderr)),
+                         TIMEOUT)
+
+    def test_missing_scheduler_stderr(self):
+        stderr = os.path.join(self.directory, 'missing.stderr')
+        self.assertEqual(classify(Failure(JobInfo(), scheduler_stderr=stderr)),
+                         TOOL_ERROR)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,124 @@
+'''Tests of the balanced sharding of the panel BED file'''
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from intervals import read_bed, read_weights, balance_shards, \
+    shard_bed_paths, write_shards
+
+
+def region(chrom, start, end):
+    return ('{}\t{}\t{}'.format(chrom, start, end), chrom, start, end)
+
+
+def separate_regions(count):
+    '''Regions that neither overlap nor touch, 100 bases apart'''
+    return [region('chr1', start, start + 10)
+            for start in range(0, 100 * count, 100)]
+
+
+class BalanceShardsTest(unittest.TestCase):
+    def test_equal_weights_are_spread_evenly(self):
+        regions = separate_regions(10)
+        shards = balance_shards(regions, 3)
+        self.assertEqual(sorted(len(shard) for shard in shards), [3, 3, 4])
+        self.assertEqual(sorted(sum(shards, [])), sorted(regions))
+
+    def test_heaviest_regions_go_to_the_lightest_shard(self):
+        regions = separate_regions(5)
+        weights = dict(((chrom, start, end), weight) for (_line, chrom, start, end),
+                       weight in zip(regions, [7, 5, 4, 3, 1]))
+        shards = balance_shards(regions, 2, weights)
+        totals = [sum(weights[tuple(item[1:])] for item in shard)
+                  for shard in shards]
+        # 7 + 3 and 5 + 4 + 1, as the longest processing time first
+        # heuristic places them
+        self.assertEqual(sorted(totals), [10, 10])
+
+    def test_unweighted_regions_count_as_the_mean_weight(self):
+        regions = separate_regions(4)
+        weights = {('chr1', 0, 10): 9.0, ('chr1', 100, 110): 1.0}
+        shards = balance_shards(regions, 2, weights)
+        # The two regions without weights count as 5 each, so they make up
+        # one shard and the 9 and the 1 the other
+        self.assertEqual(sorted(shards), [regions[:2], regions[2:]])
+
+    def test_shards_keep_the_original_order(self):
+        regions = separate_regions(9)
+        for shard in balance_shards(regions, 4):
+            self.assertEqual(shard, sorted(shard, key=regions.index))
+
+    def test_too_few_regions(self):
+        with self.assertRaises(Exception):
+            balance_shards([region('chr1', 0, 10)], 2)
+
+    def test_overlapping_regions_share_a_shard(self):
+        # Three clusters: two overlapping amplicons, two adjacent ones and
+        # one on its own, listed out of order
+        regions = [region('chr1', 100, 250), region('chr1', 500, 600),
+                   region('chr1', 200, 350), region('chr1', 600, 700),
+                   region('chr2', 100, 250)]
+        shards = balance_shards(regions, 3)
+        self.assertIn([regions[0], regions[2]], shards)
+        self.assertIn([regions[1], regions[3]], shards)
+        self.assertIn([regions[4]], shards)
+
+    def test_clusters_are_weighed_as_a_whole(self):
+        regions = [region('chr1', 0, 20), region('chr1', 10, 30),
+                   region('chr1', 100, 120), region('chr1', 200, 220)]
+        weights = {('chr1', 0, 20): 2.0, ('chr1', 10, 30): 2.0,
+                   ('chr1', 100, 120): 3.0, ('chr1', 200, 220): 1.0}
+        shards = balance_shards(regions, 2, weights)
+        self.assertEqual(sorted(shards), [regions[:2], regions[2:]])
+
+    def test_too_few_clusters(self):
+        with self.assertRaises(Exception):
+            balance_shards([region('chr1', 0, 20), region('chr1', 10, 30)], 2)
+
+
+class ShardFilesTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write(self, name, text):
+        path = os.path.join(self.directory, name)
+        with open(path, 'w') as out_file:
+            out_file.write(text)
+        return path
+
+    def test_read_bed_skips_headers(self):
+        bed = self.write('panel.bed', 'track name=panel\n# comment\n\n'
+                                      'chr1\t10\t20\tamp1\nchr2\t5\t15\tamp2\n')
+        self.assertEqual(read_bed(bed), [('chr1\t10\t20\tamp1', 'chr1', 10, 20),
+                                         ('chr2\t5\t15\tamp2', 'chr2', 5, 15)])
+
+    def test_read_weights(self):
+        weights = self.write('weights.tsv', '# chrom start end seconds\n'
+                                            'chr1\t10\t20\t42.5\n')
+        self.assertEqual(read_weights(weights), {('chr1', 10, 20): 42.5})
+
+    def test_write_shards(self):
+        lines = [line + '\tamp{}'.format(number)
+                 for number, (line, _chrom, _start, _end)
+                 in enumerate(separate_regions(6))]
+        bed = self.write('panel.bed', ''.join(line + '\n' for line in lines))
+        paths = shard_bed_paths(self.directory, 3)
+        self.assertEqual([os.path.basename(path) for path in paths],
+                         ['shard_000.bed', 'shard_001.bed', 'shard_002.bed'])
+        write_shards(bed, paths)
+        written = []
+        for path in paths:
+            with open(path) as shard_file:
+                shard = shard_file.read().splitlines()
+            self.assertEqual(len(shard), 2)
+            written.extend(shard)
+        self.assertEqual(sorted(written), sorted(lines))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,73 @@
+'''Tests of the pool of local cores and memory'''
+
+import threading
+import time
+import unittest
+
+from local_executor import ResourcePool
+
+
+class ResourcePoolTest(unittest.TestCase):
+    def setUp(self):
+        self.pool = ResourcePool(4, 8)
+        self.started = []
+        self.threads = []
+
+    def tearDown(self):
+        for thread in self.threads:
+            thread.join(5)
+
+    def start_job(self, name, cores, mem, priority=0):
+        '''Reserve in a new thread, recording name once the job starts'''
+        def job():
+            with self.pool.reserve(cores, mem, priority):
+                self.started.append(name)
+        waiting = len(self.pool.waiting)
+        thread = threading.Thread(target=job)
+        thread.start()
+        self.threads.append(thread)
+        self.wait_for(lambda: len(self.pool.waiting) > waiting or
+                      name in self.started)
+
+    def wait_for(self, condition):
+        deadline = time.time() + 5
+        while not condition():
+            self.assertLess(time.time(), deadline)
+            time.sleep(0.001)
+
+    def test_reserve_and_release(self):
+        with self.pool.reserve(3, 6):
+            self.assertEqual((self.pool.free_cores, self.pool.free_mem), (1, 2))
+        self.assertEqual((self.pool.free_cores, self.pool.free_mem), (4, 8))
+
+    def test_capped_to_the_machine(self):
+        with self.pool.reserve(16, 64):
+            self.assertEqual((self.pool.free_cores, self.pool.free_mem), (0, 0))
+        self.assertEqual((self.pool.free_cores, self.pool.free_mem), (4, 8))
+
+    def test_waits_until_it_fits(self):
+        with self.pool.reserve(3, 1):
+            self.start_job('large', 2, 1)
+            self.assertEqual(self.started, [])
+        self.wait_for(lambda: self.started == ['large'])
+
+    def test_first_in_first_out(self):
+        with self.pool.reserve(4, 1):
+            self.start_job('large', 4, 1)
+            # Fits beside the large job, but waits its turn behind it
+            self.start_job('small', 1, 1)
+            self.assertEqual(self.started, [])
+        self.wait_for(lambda: len(self.started) == 2)
+        self.assertEqual(self.started, ['large', 'small'])
+
+    def test_lower_priority_value_goes_first(self):
+        with self.pool.reserve(4, 8):
+            self.start_job('late', 4, 8, priority=5)
+            self.start_job('early', 4, 8, priority=1)
+            self.start_job('also early', 4, 8, priority=1)
+        self.wait_for(lambda: len(self.started) == 3)
+        self.assertEqual(self.started, ['early', 'also early', 'late'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,169 @@
+'''Tests of the adaptive per-stage resource sizing'''
+
+import argparse
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+from failures import KILLED, NODE_FAILURE, OUT_OF_MEMORY, TIMEOUT
+from resources import (JAVA_MEM_MIN, KB_IN_GIGABYTE, MIN_HISTORY, escalate,
+                       fit_line, format_walltime, parse_walltime,
+                       stage_resources)
+from state import State
+
+
+class FakeConfig(object):
+    '''The stage options of a configuration file'''
+    def __init__(self, stages):
+        self.stages = stages
+
+    def get_stage_option(self, stage, option):
+        return self.stages[stage][option]
+
+    def get_optional_stage_option(self, stage, option, default):
+        return self.stages[stage].get(option, default)
+
+
+class FitLineTest(unittest.TestCase):
+    def test_exact_line(self):
+        slope, intercept, sd = fit_line([1.0, 2.0, 3.0], [3.0, 5.0, 7.0])
+        self.assertAlmostEqual(slope, 2.0)
+        self.assertAlmostEqual(intercept, 1.0)
+        self.assertAlmostEqual(sd, 0.0)
+
+    def test_constant_inputs(self):
+        slope, intercept, sd = fit_line([5.0, 5.0], [1.0, 3.0])
+        self.assertEqual(slope, 0.0)
+        self.assertAlmostEqual(intercept, 2.0)
+        self.assertAlmostEqual(sd, 1.0)
+
+
+class WalltimeTest(unittest.TestCase):
+    def test_round_trip(self):
+        self.assertEqual(parse_walltime('2:05'), 125)
+        self.assertEqual(format_walltime(125), '2:05')
+        # Partial minutes are rounded up
+        self.assertEqual(format_walltime(0.5), '0:01')
+
+
+class StageResourcesTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.telemetry = os.path.join(self.directory, 'telemetry.db')
+        self.bam = os.path.join(self.directory, 'sample.bam')
+        with open(self.bam, 'w') as bam:
+            bam.write('x' * 1000)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def record_jobs(self, stage, mem_in_gb, count=MIN_HISTORY):
+        '''Successful jobs of the stage that all used mem_in_gb and a minute'''
+        connection = sqlite3.connect(self.telemetry)
+        with connection:
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS jobs (stage TEXT, '
+                'exit_status INTEGER, input_bytes INTEGER, '
+                'max_rss_kb INTEGER, wall_time REAL, finished REAL)')
+            connection.executemany(
+                'INSERT INTO jobs VALUES (?, 0, ?, ?, 60, ?)',
+                [(stage, 1000, int(mem_in_gb * KB_IN_GIGABYTE), finished)
+                 for finished in range(count)])
+        connection.close()
+
+    def state(self, **options):
+        stage_options = {'mem': 16, 'walltime': '8:00', 'adaptive': True}
+        stage_options.update(options)
+        config = FakeConfig({'sort': stage_options})
+        return State(options=argparse.Namespace(telemetry=self.telemetry),
+                     config=config, logger=None, drmaa_session=None)
+
+    def test_static_without_adaptive(self):
+        self.record_jobs('sort', 0.5)
+        state = self.state(adaptive=False)
+        self.assertEqual(stage_resources(state, 'sort', [self.bam]),
+                         (16, '8:00'))
+
+    def test_static_without_enough_history(self):
+        self.record_jobs('sort', 0.5, count=MIN_HISTORY - 1)
+        self.assertEqual(stage_resources(self.state(), 'sort', [self.bam]),
+                         (16, '8:00'))
+
+    def test_predicted_from_history(self):
+        self.record_jobs('sort', 4)
+        # 4 GB and 1 minute with 20% headroom, walltime at walltime_min
+        self.assertEqual(stage_resources(self.state(), 'sort', [self.bam]),
+                         (5, '0:10'))
+
+    def test_mem_min(self):
+        self.record_jobs('sort', 0.5)
+        mem, _walltime = stage_resources(self.state(mem_min=2), 'sort',
+                                         [self.bam])
+        self.assertEqual(mem, 2)
+
+    def test_java_floor(self):
+        self.record_jobs('sort', 0.5)
+        state = self.state()
+        self.assertEqual(stage_resources(state, 'sort', [self.bam])[0], 1)
+        self.assertEqual(
+            stage_resources(state, 'sort', [self.bam], java=True)[0],
+            JAVA_MEM_MIN)
+
+    def test_ceiling_wins_over_java_floor(self):
+        self.record_jobs('sort', 0.5)
+        state = self.state(mem=2)
+        self.assertEqual(
+            stage_resources(state, 'sort', [self.bam], java=True)[0], 2)
+
+
+class EscalateTest(unittest.TestCase):
+    def state(self, **options):
+        return State(options=None, config=FakeConfig({'sort': options}),
+                     logger=None, drmaa_session=None)
+
+    def test_out_of_memory_doubles_mem(self):
+        self.assertEqual(escalate(self.state(), 'sort', 8, '1:00', 8, '1:00',
+                                  OUT_OF_MEMORY), (16, '1:00'))
+
+    def test_timeout_doubles_walltime(self):
+        self.assertEqual(escalate(self.state(), 'sort', 8, '1:30', 8, '1:30',
+                                  TIMEOUT), (8, '3:00'))
+
+    def test_killed_raises_both(self):
+        self.assertEqual(escalate(self.state(), 'sort', 8, '1:00', 8, '1:00',
+                                  KILLED), (16, '2:00'))
+
+    def test_node_failure_keeps_resources(self):
+        self.assertEqual(escalate(self.state(), 'sort', 8, '1:00', 8, '1:00',
+                                  NODE_FAILURE), (8, '1:00'))
+
+    def test_capped_at_four_times_the_first_request(self):
+        state = self.state()
+        self.assertEqual(escalate(state, 'sort', 24, '1:00', 8, '1:00',
+                                  OUT_OF_MEMORY), (32, '1:00'))
+        self.assertIsNone(escalate(state, 'sort', 32, '1:00', 8, '1:00',
+                                   OUT_OF_MEMORY))
+        self.assertIsNone(escalate(state, 'sort', 8, '4:00', 8, '1:00',
+                                   TIMEOUT))
+
+    def test_killed_raises_what_is_left(self):
+        self.assertEqual(escalate(self.state(), 'sort', 32, '1:00', 8, '1:00',
+                                  KILLED), (32, '2:00'))
+
+    def test_configured_factor_and_ceiling(self):
+        state = self.state(mem_factor=1.5, mem_ceiling=10,
+                           walltime_factor=3, walltime_ceiling='2:00')
+        self.assertEqual(escalate(state, 'sort', 4, '0:30', 4, '0:30',
+                                  OUT_OF_MEMORY), (6, '0:30'))
+        self.assertEqual(escalate(state, 'sort', 8, '0:30', 4, '0:30',
+                                  OUT_OF_MEMORY), (10, '0:30'))
+        self.assertEqual(escalate(state, 'sort', 4, '0:30', 4, '0:30',
+                                  TIMEOUT), (4, '1:30'))
+        self.assertEqual(escalate(state, 'sort', 4, '1:30', 4, '0:30',
+                                  TIMEOUT), (4, '2:00'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,98 @@
+'''Tests of the content-addressed cache of stage results'''
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from result_cache import ResultCache, file_checksum
+
+
+class ResultCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.cache = ResultCache(os.path.join(self.directory, 'cache'))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    def write(self, name, text):
+        path = self.path(name)
+        directory = os.path.dirname(path)
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        with open(path, 'w') as out_file:
+            out_file.write(text)
+        return path
+
+    def read(self, path):
+        with open(path) as in_file:
+            return in_file.read()
+
+    def test_key_follows_command_modules_and_input_contents(self):
+        reads = self.write('reads.fastq', '@read\nACGT\n+\nIIII\n')
+        key = self.cache.key('bwa mem', [reads], ['BWA/0.7.15'])
+        self.assertEqual(key, self.cache.key('bwa mem', [reads], ['BWA/0.7.15']))
+        self.assertNotEqual(key, self.cache.key('bwa mem -M', [reads],
+                                                ['BWA/0.7.15']))
+        self.assertNotEqual(key, self.cache.key('bwa mem', [reads],
+                                                ['BWA/0.7.17']))
+        self.write('reads.fastq', '@read\nACGA\n+\nIIII\n')
+        # A new modification time, as well as new contents
+        os.utime(reads, (0, 0))
+        self.assertNotEqual(key, self.cache.key('bwa mem', [reads],
+                                                ['BWA/0.7.15']))
+
+    def test_key_ignores_input_names(self):
+        first = self.write('first.fastq', 'same\n')
+        second = self.write('second.fastq', 'same\n')
+        self.assertEqual(file_checksum(first), file_checksum(second))
+        self.assertEqual(self.cache.key('cat', [first], []),
+                         self.cache.key('cat', [second], []))
+
+    def test_store_then_restore(self):
+        bam = self.write('out/sample.bam', 'alignments')
+        index = self.write('out/sample.bam.bai', 'index')
+        self.cache.store('ab' * 20, [bam, index])
+        shutil.rmtree(self.path('out'))
+        self.assertTrue(self.cache.restore('ab' * 20, [bam, index]))
+        self.assertEqual(self.read(bam), 'alignments')
+        self.assertEqual(self.read(index), 'index')
+
+    def test_restore_of_unknown_key(self):
+        bam = self.path('out/sample.bam')
+        self.assertFalse(self.cache.restore('cd' * 20, [bam]))
+        self.assertFalse(os.path.exists(bam))
+
+    def test_outputs_the_job_did_not_create_are_skipped(self):
+        bam = self.write('sample.bam', 'alignments')
+        self.cache.store('ef' * 20, [bam, self.path('sample.bam.bai')])
+        os.remove(bam)
+        self.assertTrue(self.cache.restore('ef' * 20,
+                                           [bam, self.path('sample.bam.bai')]))
+        self.assertFalse(os.path.exists(self.path('sample.bam.bai')))
+
+    def test_restore_needs_the_main_output(self):
+        index = self.write('sample.bam.bai', 'index')
+        self.cache.store('01' * 20, [index])
+        self.assertFalse(self.cache.restore('01' * 20,
+                                            [self.path('sample.bam'), index]))
+
+    def test_first_entry_of_a_key_is_kept(self):
+        vcf = self.write('sample.vcf', 'first')
+        self.cache.store('23' * 20, [vcf])
+        # run_stage removes the outputs, which may be links into the cache,
+        # before running a job
+        os.remove(vcf)
+        self.write('sample.vcf', 'second')
+        self.cache.store('23' * 20, [vcf])
+        os.remove(vcf)
+        self.cache.restore('23' * 20, [vcf])
+        self.assertEqual(self.read(vcf), 'first')
+
+
+if __name__ == '__main__':
+    unittest.main()
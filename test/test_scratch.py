@@ -0,0 +1,86 @@
+'''Tests of running jobs on node-local scratch space'''
+
+import os
+import shutil
+import subprocess
+import tempfile
+import unittest
+
+from scratch import redirect_paths, scratch_command, staged_paths
+
+
+class PathsTest(unittest.TestCase):
+    def test_only_relative_paths_are_staged(self):
+        self.assertEqual(staged_paths(['./a/b.bam', '/ref/hg19.fa',
+                                       '../c.bam', 'a/b.bam', 'd.vcf']),
+                         ['a/b.bam', 'd.vcf'])
+
+    def test_redirect_paths(self):
+        self.assertEqual(
+            redirect_paths('samtools sort -T a/b.bam.tmp -o a/b.bam ./in.bam',
+                           ['a/b.bam', 'in.bam']),
+            'samtools sort -T ${PIPELINE_SCRATCH}/a/b.bam.tmp '
+            '-o ${PIPELINE_SCRATCH}/a/b.bam ${PIPELINE_SCRATCH}/in.bam')
+
+    def test_redirect_longest_path_first(self):
+        self.assertEqual(redirect_paths('cat in.bam.bai', ['in.bam', 'in.bam.bai']),
+                         'cat ${PIPELINE_SCRATCH}/in.bam.bai')
+
+    def test_paths_within_words_are_left(self):
+        self.assertEqual(redirect_paths('cat main.bam', ['in.bam']),
+                         'cat main.bam')
+
+
+class ScratchCommandTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.scratch = os.path.join(self.directory, 'scratch')
+        os.mkdir(self.scratch)
+        os.mkdir(os.path.join(self.directory, 'in'))
+        self.write('in/sample.bam', 'reads\n')
+        self.write('in/sample.bam.bai', 'index\n')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write(self, name, text):
+        with open(os.path.join(self.directory, name), 'w') as out_file:
+            out_file.write(text)
+
+    def read(self, name):
+        with open(os.path.join(self.directory, name)) as in_file:
+            return in_file.read()
+
+    def run_command(self, command, inputs, outputs):
+        environment = dict(os.environ, TMPDIR=self.scratch)
+        return subprocess.call(
+            ['sh', '-c', scratch_command(command, inputs, outputs, 'job')],
+            cwd=self.directory, env=environment)
+
+    def test_runs_on_copies_and_copies_outputs_back(self):
+        command = 'cat in/sample.bam in/sample.bam.bai > out/sample.txt; ' \
+                  'echo "$TMPDIR" > out/tmpdir.txt'
+        status = self.run_command(command, ['in/sample.bam'],
+                                  ['out/sample.txt', 'out/tmpdir.txt'])
+        self.assertEqual(status, 0)
+        self.assertEqual(self.read('out/sample.txt'), 'reads\nindex\n')
+        self.assertTrue(self.read('out/tmpdir.txt').startswith(self.scratch))
+        # The scratch directory is removed when the job ends
+        self.assertEqual(os.listdir(self.scratch), [])
+
+    def test_failure_keeps_its_status_and_copies_nothing_back(self):
+        status = self.run_command('echo partial > out/sample.txt; exit 3',
+                                  ['in/sample.bam'], ['out/sample.txt'])
+        self.assertEqual(status, 3)
+        self.assertFalse(os.path.exists(os.path.join(self.directory, 'out')))
+        self.assertEqual(os.listdir(self.scratch), [])
+
+    def test_exit_in_command_still_copies_outputs_back(self):
+        status = self.run_command('echo done > out/sample.txt; exit 0',
+                                  ['in/sample.bam'], ['out/sample.txt'])
+        self.assertEqual(status, 0)
+        self.assertEqual(self.read('out/sample.txt'), 'done\n')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,95 @@
+'''Tests of the per-job resource telemetry'''
+
+from collections import namedtuple
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+from telemetry import read_job_info, read_time_file, record_job, sample_name
+
+# The fields of drmaa.JobInfo
+JobInfo = namedtuple('JobInfo', ['jobId', 'hasExited', 'hasSignal',
+                                 'terminatedSignal', 'hasCoreDump',
+                                 'wasAborted', 'exitStatus', 'resourceUsage'])
+
+
+def job_info(usage, exit_status=0):
+    return JobInfo('42', True, False, None, False, False, exit_status, usage)
+
+
+class ReadJobInfoTest(unittest.TestCase):
+    def test_slurm_drmaa(self):
+        usage = {'submission_time': '990', 'start_time': '1000',
+                 'end_time': '1090', 'cpu': '170', 'mem': '2048',
+                 'walltime': '90', 'hosts': 'node1'}
+        self.assertEqual(read_job_info(job_info(usage)),
+                         {'started': 1000.0, 'wall_time': 90.0,
+                          'cpu_time': 170.0, 'max_rss_kb': 2048,
+                          'exit_status': 0})
+
+    def test_sge(self):
+        usage = {'start_time': '1000.0000', 'ru_wallclock': '90.0000',
+                 'cpu': '170.0000', 'ru_maxrss': '2048.0000',
+                 'mem': '3.5000'}
+        self.assertEqual(read_job_info(job_info(usage, 1))['max_rss_kb'], 2048)
+        self.assertEqual(read_job_info(job_info(usage, 1))['exit_status'], 1)
+
+    def test_wall_time_from_start_and_end(self):
+        usage = {'start_time': '1000', 'end_time': '1060'}
+        self.assertEqual(read_job_info(job_info(usage))['wall_time'], 60.0)
+
+    def test_unmeasured_memory_is_left_out(self):
+        usage = {'start_time': '1000', 'walltime': '60', 'mem': '0'}
+        self.assertNotIn('max_rss_kb', read_job_info(job_info(usage)))
+
+    def test_unknown_outcome(self):
+        self.assertEqual(read_job_info(None), {})
+
+
+class RecordJobTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.db = os.path.join(self.directory, 'telemetry.sqlite')
+        self.bam = os.path.join(self.directory, 'sample1.sorted.bam')
+        with open(self.bam, 'w') as bam:
+            bam.write('x' * 100)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def recorded(self):
+        connection = sqlite3.connect(self.db)
+        try:
+            return connection.execute(
+                'SELECT stage, sample, started, queue_wait, wall_time, '
+                'max_rss_kb, exit_status, input_bytes FROM jobs').fetchall()
+        finally:
+            connection.close()
+
+    def test_from_time_file(self):
+        time_file = os.path.join(self.directory, 'job.time')
+        with open(time_file, 'w') as timings:
+            timings.write('start 1000.5\ntime 12.00 10.00 1.00 4096 0\nexit 0\n')
+        self.assertEqual(read_time_file(time_file)['cpu_time'], 11.0)
+        record_job(self.db, 'run', 'sort', 'job', {'local': True}, 1000.0,
+                   time_file, [self.bam], [])
+        self.assertEqual(self.recorded(),
+                         [('sort', 'sample1', 1000.5, 0.5, 12.0, 4096, 0, 100)])
+        self.assertFalse(os.path.exists(time_file))
+
+    def test_from_job_info(self):
+        usage = {'start_time': '1010', 'walltime': '30', 'mem': '1024'}
+        record_job(self.db, 'run', 'sort', 'job', {'local': False}, 1000.0,
+                   None, [self.bam], [], job_info(usage))
+        self.assertEqual(self.recorded(),
+                         [('sort', 'sample1', 1010.0, 10.0, 30.0, 1024, 0, 100)])
+
+    def test_sample_name(self):
+        self.assertEqual(sample_name(['out/sample1.sorted.bam']), 'sample1')
+        self.assertIsNone(sample_name([]))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,112 @@
+'''Tests of the splitting and merging of VCF files'''
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from vcf_io import read_vcf, sort_records, chunk_paths, split_vcf, \
+    merge_vcfs, add_header_lines, has_records
+
+HEADER = ['##fileformat=VCFv4.2\n',
+          '##contig=<ID=chr2,length=1000>\n',
+          '##contig=<ID=chr1,length=2000>\n',
+          '#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\n']
+
+
+def record(chrom, pos, alt='T'):
+    return '{}\t{}\t.\tA\t{}\t.\tPASS\t.\n'.format(chrom, pos, alt)
+
+
+class SortRecordsTest(unittest.TestCase):
+    def test_contigs_in_header_order(self):
+        records = [record('chr1', 5), record('chr2', 100), record('chr1', 3)]
+        self.assertEqual(sort_records(HEADER, records),
+                         [record('chr2', 100), record('chr1', 3),
+                          record('chr1', 5)])
+
+    def test_positions_sort_as_numbers(self):
+        records = [record('chr1', 100), record('chr1', 20)]
+        self.assertEqual(sort_records(HEADER, records),
+                         [record('chr1', 20), record('chr1', 100)])
+
+    def test_unlisted_contigs_by_first_appearance(self):
+        records = [record('chrY', 1), record('chrX', 1), record('chr1', 1)]
+        self.assertEqual(sort_records(HEADER, records),
+                         [record('chr1', 1), record('chrY', 1),
+                          record('chrX', 1)])
+
+    def test_stable_at_the_same_position(self):
+        records = [record('chr1', 7, 'G'), record('chr1', 7, 'C')]
+        self.assertEqual(sort_records(HEADER, records), records)
+
+
+class SplitMergeTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.prefix = os.path.join(self.directory, 'sample')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write_vcf(self, name, records):
+        path = os.path.join(self.directory, name)
+        with open(path, 'w') as vcf_file:
+            vcf_file.writelines(HEADER + records)
+        return path
+
+    def test_chunk_paths(self):
+        self.assertEqual(chunk_paths('out/sample', 2),
+                         ['out/sample.chunk_0000.vt.vcf',
+                          'out/sample.chunk_0001.vt.vcf'])
+
+    def test_split_gives_every_chunk_the_header(self):
+        records = [record('chr1', pos) for pos in range(1, 6)]
+        paths = split_vcf(self.write_vcf('in.vcf', records), self.prefix, 2)
+        self.assertEqual(paths, chunk_paths(self.prefix, 3))
+        chunks = [read_vcf(path) for path in paths]
+        for header, _records in chunks:
+            self.assertEqual(header, HEADER)
+        self.assertEqual([len(chunk_records) for _header, chunk_records in chunks],
+                         [2, 2, 1])
+        self.assertEqual(sum((chunk_records for _header, chunk_records in chunks), []),
+                         records)
+
+    def test_split_without_records(self):
+        paths = split_vcf(self.write_vcf('in.vcf', []), self.prefix, 2)
+        self.assertEqual(len(paths), 1)
+        self.assertEqual(read_vcf(paths[0]), (HEADER, []))
+
+    def test_has_records(self):
+        self.assertTrue(has_records(self.write_vcf('in.vcf', [record('chr1', 1)])))
+        self.assertFalse(has_records(self.write_vcf('empty.vcf', [])))
+
+    def test_merge_restores_coordinate_order(self):
+        records = [record('chr2', 10), record('chr1', 1), record('chr1', 30)]
+        first = self.write_vcf('first.vcf', [records[2]])
+        second = self.write_vcf('second.vcf', [records[0], records[1]])
+        merged = os.path.join(self.directory, 'merged.vcf')
+        merge_vcfs([first, second], merged)
+        self.assertEqual(read_vcf(merged), (HEADER, records))
+        self.assertFalse(os.path.exists(merged + '.tmp'))
+
+    def test_split_then_merge_round_trip(self):
+        records = [record('chr2', 10), record('chr1', 1), record('chr1', 30)]
+        paths = split_vcf(self.write_vcf('in.vcf', records), self.prefix, 1)
+        merged = os.path.join(self.directory, 'merged.vcf')
+        merge_vcfs(list(reversed(paths)), merged)
+        self.assertEqual(read_vcf(merged), (HEADER, records))
+
+
+class AddHeaderLinesTest(unittest.TestCase):
+    def test_inserted_before_chrom_line(self):
+        info = '##INFO=<ID=AF,Number=A,Type=Float,Description="AF">\n'
+        self.assertEqual(add_header_lines(HEADER, [info]),
+                         HEADER[:-1] + [info] + HEADER[-1:])
+
+    def test_present_lines_are_not_repeated(self):
+        self.assertEqual(add_header_lines(HEADER, [HEADER[1]]), HEADER)
+
+
+if __name__ == '__main__':
+    unittest.main()